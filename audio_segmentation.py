@@ -8,127 +8,269 @@
 import argparse
 import os
 import json
-from pydub import AudioSegment
 from collections import OrderedDict
 import glob
-from scipy.io.wavfile import write
+import heapq
+import io
+import struct
+import subprocess
 # import torchaudio
-import librosa
 import numpy as np
+import soundfile as sf
 
-class Segment:
+# Segmentation parameters of the chunks sent to the diarization (main.py, pipeline.py, benchmark.py)
+SEGMENT_PARAMS = {'min_duration': 20, 'max_duration': 30, 'threshold': 28.0, 'max_gap_duration': 1.0}
+
+class SegmentTable:
     """
-    Linked segments lists
+    Columnar segments table: one numpy array per field instead of a linked list of objects.
+    Times are in samples (silence splitting) or in ms (diarization results).
     """
-    def __init__(self, begin, end, filename):
-        self.begin = begin
-        self.end = end
-        self.text = ''
-        self.next = None
-        self.filename = filename
-        self.gap = 0 # gap between segments (current and next)
-
-    def set_next(self, next):
-        self.next = next
-        self.gap = next.begin - self.end
-
-    def set_filename_and_id(self, filename, id):
-        self.filename = filename
-        self.id = id
-
-    def merge_from(self, next):
-        # merge two segments (current and next)
-        self.next = next.next
-        self.gap = next.gap
-        self.end = next.end
+    def __init__(self, begin, end, label=None, track=None, text=None, uri=''):
+        self.begin = np.asarray(begin)
+        self.end = np.asarray(end)
+        n = len(self.begin)
+        self.label = np.asarray(label if label is not None else [''] * n, dtype=str)
+        self.track = np.asarray(track if track is not None else [''] * n, dtype=str)
+        self.text = np.asarray(text if text is not None else [''] * n, dtype=str)
+        self.uri = uri
+
+    @classmethod
+    def from_parts(cls, parts, uri=''):
+        parts = np.asarray(parts, dtype=np.int64).reshape(-1, 2)
+        return cls(parts[:, 0], parts[:, 1], uri=uri)
+
+    def __len__(self):
+        return len(self.begin)
+
+    @property
+    def gap(self):
+        # gap between segments (current and next), 0 for the last one
+        gap = np.zeros_like(self.begin)
+        gap[:-1] = self.begin[1:] - self.end[:-1]
+        return gap
+
+    def take(self, indices):
+        return SegmentTable(self.begin[indices], self.end[indices], self.label[indices], self.track[indices], self.text[indices], self.uri)
+
+    def merge_at(self, i):
+        # merge two segments (i and i + 1)
+        end = self.end.copy()
+        end[i] = end[i + 1]
+        table = SegmentTable(self.begin, end, self.label, self.track, self.text, self.uri)
+        return table.take(np.delete(np.arange(len(self)), i + 1))
 
     def duration(self, sample_rate):
         return (self.end - self.begin - 1) / sample_rate
 
+    def pad(self, seconds, sample_rate):
+        table = self.take(slice(None))
+        table.end = self.end + int(seconds * sample_rate)
+        return table
+
+    def filter_by_duration(self, sample_rate, min_duration=None, max_duration=None):
+        duration = self.duration(sample_rate)
+        mask = np.ones(len(self), dtype=bool)
+        if min_duration is not None:
+            mask &= duration >= min_duration
+        if max_duration is not None:
+            mask &= duration <= max_duration
+        return self.take(mask)
+
+    def stats(self, sample_rate):
+        duration = self.duration(sample_rate)
+        if len(duration) == 0:
+            return {'count': 0, 'total': 0.0, 'min': 0.0, 'max': 0.0, 'mean': 0.0}
+        return {'count': len(duration), 'total': float(duration.sum()), 'min': float(duration.min()),
+                'max': float(duration.max()), 'mean': float(duration.mean())}
+
+    def ids(self, prefix):
+        return ['%s-%04d' % (prefix, j) for j in range(len(self))]
+
+    def filename(self, i):
+        return '{}-{}-{}-{:04d}.wav'.format(self.uri, self.label[i], self.track[i], i)
+
 
 def create_segments_list_from_json(json_path):
     """
-    Creates a list of segments from the json file resulting from pyannote processing.
+    Creates a segments table from the json file resulting from pyannote processing.
     """
-
-    head = None
     with  open(json_path) as jfile :
         data = json.load(jfile)
-        wav_filename = data['uri'].split('.')[0]
-        for i, fragment in enumerate(data['content']):
-            begin = fragment['segment']['start']*1000
-            end   = fragment['segment']['end']*1000
-            filename = '{}-{}-{}-{:04d}.wav'.format(wav_filename, fragment['label'], fragment['track'], i)
-
-            # Build a segment list
-            segment = Segment(begin, end, filename)
-            if head is None:
-                head = segment
+    return create_segments_list_from_dict(data)
+
+
+def create_segments_list_from_dict(data):
+    """
+    Creates a segments table (times in ms) from the in-memory result of pyannote processing (Annotation.for_json()).
+    """
+    content = data['content']
+    begin = np.array([fragment['segment']['start'] for fragment in content], dtype=np.float64) * 1000
+    end = np.array([fragment['segment']['end'] for fragment in content], dtype=np.float64) * 1000
+    label = [fragment['label'] for fragment in content]
+    track = [fragment['track'] for fragment in content]
+    return SegmentTable(begin, end, label, track, uri=data['uri'].split('.')[0])
+
+
+def read_wav_header(wav_filepath):
+    """
+    Parse the RIFF chunks of a wav file, returning its format and the position of its data chunk,
+    or None if it isn't a PCM wav file.
+    """
+    with open(wav_filepath, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            return None
+        info = {}
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size + chunk_size % 2)
+                audio_format, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+                if audio_format != 1:
+                    return None
+                info.update(channels=channels, sample_rate=sample_rate, block_align=block_align, bits=bits)
+            elif chunk_id == b'data':
+                if not info:
+                    return None
+                data_offset = f.tell()
+                # Streamed wavs may leave the data size unset
+                data_size = min(chunk_size, os.path.getsize(wav_filepath) - data_offset)
+                info.update(data_offset=data_offset, data_size=data_size - data_size % info['block_align'])
+                return info
             else:
-                prev.set_next(segment)
-            prev = segment
+                f.seek(chunk_size + chunk_size % 2, 1)
+
 
-    return head
+def wav_header(data_size, channels, sample_rate, bits):
+    """
+    44 bytes header of a PCM wav file holding data_size bytes of samples.
+    """
+    block_align = channels * bits // 8
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, channels,
+                       sample_rate, sample_rate * block_align, block_align, bits, b'data', data_size)
 
 
-def create_audio_files_from_segments_list(audio_file, filenames_base, head_list, output_dir):
+def create_audio_files_from_segments_list(audio_file, filenames_base, segments, output_dir, shards = None):
     """
     Segments an audio file from a segment list, saving the files in a folder.
+    PCM wav sources are memory-mapped and each segment is written as a byte range copy behind a new header,
+    other formats are decoded with pydub.
         Parameters:
         audio_file (str): filepath of source audio file.
         filenames_base (str): Filename prefix of audio segmented files.
-        head_list (str): Reference of the linked list of segments.
+        segments (SegmentTable): segments table, times in ms.
         output_dir (str): Folder to save segmented audio files.
+        shards (ShardWriter): if given, the files are appended to its shards instead of output_dir.
 
         Returns:
         String: returns True or False
     """
 
-    if not os.path.exists(output_dir):
+    if shards is None and not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    info = read_wav_header(audio_file)
+    if info is None:
+        return create_audio_files_from_segments_list_pydub(audio_file, segments, output_dir, shards)
+
+    block_align = info['block_align']
+    data = np.memmap(audio_file, dtype=np.uint8, mode='r', offset=info['data_offset'], shape=(info['data_size'],))
+    # Same ms to frame conversion as pydub slicing
+    begins = np.clip((segments.begin * info['sample_rate'] / 1000).astype(np.int64) * block_align, 0, info['data_size'])
+    ends = np.clip((segments.end * info['sample_rate'] / 1000).astype(np.int64) * block_align, begins, info['data_size'])
+    for i, (begin, end) in enumerate(zip(begins, ends)):
+        filepath = os.path.join(output_dir, segments.filename(i))
+        try:
+            header = wav_header(int(end - begin), info['channels'], info['sample_rate'], info['bits'])
+            if shards is not None:
+                shards.add(segments.filename(i), header + data[begin:end].tobytes())
+                continue
+            with open(filepath, 'wb') as f:
+                f.write(header)
+                f.write(memoryview(data[begin:end]))
+        except IOError:
+          print("Error: Writing audio file {} problem.".format(filepath))
+          return False
+    return True
+
+
+def create_audio_files_from_segments_list_pydub(audio_file, segments, output_dir, shards = None):
+    """
+    Segments an audio file of any format decoded by pydub (ffmpeg), from a segments table (times in ms).
+    """
+    from pydub import AudioSegment
     sound = AudioSegment.from_file(audio_file)
-    curr = head_list
-    i = 1
-    while curr is not None:
-        begin = curr.begin
-        end = curr.end
-        text = curr.text
-        audio_segment = sound[begin:end]
-        #filename = '{}-{:04d}.wav'.format(filenames_base, i)
-        #filename = curr.filename + '.wav'
-        curr.set_filename_and_id(curr.filename, i)
-        filepath = os.path.join(output_dir, curr.filename)
+    for i in range(len(segments)):
+        audio_segment = sound[segments.begin[i]:segments.end[i]]
+        filepath = os.path.join(output_dir, segments.filename(i))
         try:
+            if shards is not None:
+                buf = io.BytesIO()
+                audio_segment.export(buf, 'wav')
+                shards.add(segments.filename(i), buf.getvalue())
+                continue
             audio_segment.export(filepath, 'wav')
         except IOError:
           print("Error: Writing audio file {} problem.".format(filepath))
           return False
-        else:
-            curr = curr.next
-            i += 1
     return True
 
 
-def create_metadata_from_segments_list(head_list, output_file):
+def create_audio_files_from_waveform(wav, sample_rate, segments, output_dir, shards = None):
+    """
+    Segments an in-memory waveform from a segment list, saving the files in a folder.
+        Parameters:
+        wav (numpy.ndarray): float waveform of the source audio.
+        sample_rate (int): sample rate of the waveform.
+        segments (SegmentTable): segments table, times in ms.
+        output_dir (str): Folder to save segmented audio files.
+        shards (ShardWriter): if given, the files are appended to its shards instead of output_dir.
+
+        Returns:
+        String: returns True or False
+    """
+
+    from scipy.io.wavfile import write
+    if shards is None and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    begins = (segments.begin * sample_rate / 1000).astype(np.int64)
+    ends = (segments.end * sample_rate / 1000).astype(np.int64)
+    for i, (begin, end) in enumerate(zip(begins, ends)):
+        audio_segment = (wav[begin:end] * 32767).astype(np.int16)
+        filepath = os.path.join(output_dir, segments.filename(i))
+        try:
+            if shards is not None:
+                shards.add(segments.filename(i), wav_header(audio_segment.nbytes, 1, sample_rate, 16) + audio_segment.tobytes())
+                continue
+            write(filepath, sample_rate, audio_segment)
+        except IOError:
+          print("Error: Writing audio file {} problem.".format(filepath))
+          return False
+    return True
+
+
+def create_metadata_from_segments_list(segments, output_file):
     """
     Creates a csv file following the template: "filename | text"
         Parameters:
-        head_list (str): Reference of the linked list of segments.
+        segments (SegmentTable): segments table.
         output_file (str): csv output filename.
 
         Returns:
         String: returns True or False
     """
     separator = '|'
-    curr = head_list
     try:
         f = open(output_file, "w")
-        while curr is not None:
-            text = curr.text
-            filename = curr.filename.replace('.mp3', '')
+        for i in range(len(segments)):
+            text = segments.text[i]
+            filename = segments.filename(i).replace('.mp3', '')
             f.write(filename + separator + text[0] + '\n')
-            curr = curr.next
         f.close()
     except IOError:
         print("Error: creating File {} problem.".format(output_file))
@@ -156,74 +298,420 @@ def segment_audio(audio_path, json_path, output_path, metadata_output_file, file
     return True
 
 
-def segment_wav(wav, threshold_db, filename):
+def split_librosa(wav, threshold_db, frame_length = 1024, hop_length = 256):
     '''
-    Segment audio file and return a segment linked list
+    Non-silent (begin, end) intervals in samples, from librosa.effects.split.
     '''
-    # Find gaps at a fine resolution:
-    parts = librosa.effects.split(wav, top_db=threshold_db, frame_length=1024, hop_length=256)
+    import librosa
+    return librosa.effects.split(wav, top_db=threshold_db, frame_length=frame_length, hop_length=hop_length)
 
-    # Build up a linked list of segments:
-    head = None
-    prev = None
 
-    for begin, end in parts:
-        segment = Segment(begin, end, filename)
-        if head is None:
-            head = segment
-        else:
-            prev.set_next(segment)
-        prev = segment
-
-    return head
+def split_numpy(wav, threshold_db, frame_length = 1024, hop_length = 256):
+    '''
+    NumPy-only equivalent of librosa.effects.split, with the same boundaries and without importing librosa.
+    Frame energies come from a cumulative sum over the centered (zero padded) signal, without any framed copy.
+    '''
+    amin = 1e-10
+    pad = np.zeros(frame_length // 2, dtype=np.float32)
+    power = frame_power(np.concatenate((pad, wav, pad)), frame_length, hop_length)
+    if not len(power):
+        return np.zeros((0, 2), dtype=int)
+    limit = max(amin, power.max()) * 10.0 ** (-threshold_db / 10.0)
+    non_silent = np.maximum(power, amin) > limit
+    edges = np.flatnonzero(np.diff(non_silent.astype(np.int8))) + 1
+    edges = [edges]
+    if non_silent[0]:
+        edges.insert(0, [0])
+    if non_silent[-1]:
+        edges.append([len(non_silent)])
+    edges = np.minimum(np.concatenate(edges) * hop_length, len(wav))
+    return edges.reshape((-1, 2))
+
+
+SPLITTERS = {
+    'librosa': split_librosa,
+    'numpy': split_numpy,
+}
+
+
+def segment_wav(wav, threshold_db, filename, splitter = 'librosa'):
+    '''
+    Segment audio file and return a segments table
+    '''
+    # Find gaps at a fine resolution:
+    parts = SPLITTERS[splitter](wav, threshold_db, frame_length=1024, hop_length=256)
+    return SegmentTable.from_parts(parts, uri=filename)
 
 
 def find_best_merge(segments, sample_rate, max_duration, max_gap_duration):
     '''
-    Find small segments that can be merged by analyzing max_duration and max_gap_duration
+    Find small segments that can be merged by analyzing max_duration and max_gap_duration.
+    Returns the index of the segment to merge with its next one, or None.
     '''
-    best = None
-    best_score = 0
-    s = segments
-    while s.next is not None:
-        gap_duration = s.gap / sample_rate
-        merged_duration = (s.next.end - s.begin) / sample_rate
-        if gap_duration <= max_gap_duration and merged_duration <= max_duration:
-            score = max_gap_duration - gap_duration
-            if score > best_score:
-                best = s
-                best_score = score
-        s = s.next
+    if len(segments) < 2:
+        return None
+    gap_duration = (segments.begin[1:] - segments.end[:-1]) / sample_rate
+    merged_duration = (segments.end[1:] - segments.begin[:-1]) / sample_rate
+    score = np.where((gap_duration <= max_gap_duration) & (merged_duration <= max_duration), max_gap_duration - gap_duration, 0)
+    best = int(np.argmax(score))
+    if score[best] <= 0:
+        return None
     return best
 
 
-def find_segments(filename, wav, sample_rate, min_duration, max_duration, max_gap_duration, threshold_db):
+def merge_segments_greedy(segments, sample_rate, max_duration, max_gap_duration):
     '''
-    Given an audio file, creates the best possible segment list
+    Merge segments until we can't merge any more, rescanning the whole table at every merge: O(n^2)
     '''
-
-    # Segment audio file
-    segments = segment_wav(wav, threshold_db, filename)
-    # Merge until we can't merge any more
     while True:
         best = find_best_merge(segments, sample_rate, max_duration, max_gap_duration)
         if best is None:
             break
-        best.merge_from(best.next)
-
-    # Convert to list
-    result = []
-    s = segments
-    while s is not None:
-        result.append(s)
-        # Create a errors file
-        if s.duration(sample_rate) < min_duration and s.duration(sample_rate) > max_duration:
-            with open(os.path.join(os.path.dirname(__file__), "erros.txt"), "a") as f:
-                f.write(filename+"\n")
-        # Extend the end by 0.2 sec as we sometimes lose the ends of words ending in unvoiced sounds.
-        s.end += int(0.2 * sample_rate)
-        s = s.next
-    return result
+        segments = segments.merge_at(best)
+    return segments
+
+
+def merge_segments_heap(segments, sample_rate, max_duration, max_gap_duration):
+    '''
+    Same merges as merge_segments_greedy, in O(n log n), using a priority queue of candidate gaps.
+    Stale candidates are lazily discarded when popped.
+    '''
+    n = len(segments)
+    begin = segments.begin.tolist()
+    end = segments.end.tolist()
+    nxt = list(range(1, n)) + [-1]
+    prev = list(range(-1, n - 1))
+    alive = [True] * n
+    version = [0] * n
+    heap = []
+
+    def push(i):
+        j = nxt[i]
+        if j < 0:
+            return
+        gap_duration = (begin[j] - end[i]) / sample_rate
+        merged_duration = (end[j] - begin[i]) / sample_rate
+        if gap_duration <= max_gap_duration and merged_duration <= max_duration:
+            score = max_gap_duration - gap_duration
+            if score > 0:
+                # Best score first, ties broken by table order as find_best_merge does
+                heapq.heappush(heap, (-score, i, version[i]))
+
+    for i in range(n):
+        push(i)
+
+    while heap:
+        _, i, v = heapq.heappop(heap)
+        j = nxt[i]
+        if not alive[i] or v != version[i] or j < 0:
+            continue
+        # Merged duration only grows as neighbours merge, so an invalid candidate stays invalid
+        if (end[j] - begin[i]) / sample_rate > max_duration:
+            continue
+        end[i] = end[j]
+        alive[j] = False
+        nxt[i] = nxt[j]
+        if nxt[i] >= 0:
+            prev[nxt[i]] = i
+        version[i] += 1
+        push(i)
+        if prev[i] >= 0:
+            version[prev[i]] += 1
+            push(prev[i])
+
+    keep = np.flatnonzero(alive)
+    table = segments.take(keep)
+    table.end = np.asarray(end, dtype=segments.end.dtype)[keep]
+    return table
+
+
+MERGE_METHODS = {
+    'greedy': merge_segments_greedy,
+    'heap': merge_segments_heap,
+}
+
+
+def find_segments(filename, wav, sample_rate, min_duration, max_duration, max_gap_duration, threshold_db, merge_method='heap', splitter='librosa'):
+    '''
+    Given an audio file, creates the best possible segments table
+    '''
+
+    # Segment audio file
+    segments = segment_wav(wav, threshold_db, filename, splitter)
+    # Merge until we can't merge any more
+    segments = MERGE_METHODS[merge_method](segments, sample_rate, max_duration, max_gap_duration)
+
+    return finish_segments(filename, segments, sample_rate, min_duration, max_duration)
+
+
+def finish_segments(filename, segments, sample_rate, min_duration, max_duration):
+    '''
+    Log out of range segments and pad the merged segments
+    '''
+    # Create a errors file
+    duration = segments.duration(sample_rate)
+    if np.any((duration < min_duration) & (duration > max_duration)):
+        with open(os.path.join(os.path.dirname(__file__), "erros.txt"), "a") as f:
+            f.write(filename+"\n")
+    # Extend the end by 0.2 sec as we sometimes lose the ends of words ending in unvoiced sounds.
+    return segments.pad(0.2, sample_rate)
+
+
+def frame_power(buf, frame_length, hop_length):
+    '''
+    Mean square energy of every complete frame of buf, computed from a cumulative sum (no framed copy).
+    '''
+    if len(buf) < frame_length:
+        return np.zeros(0)
+    n_frames = 1 + (len(buf) - frame_length) // hop_length
+    csum = np.empty(len(buf) + 1)
+    csum[0] = 0.0
+    np.cumsum(np.square(buf), dtype=np.float64, out=csum[1:])
+    if frame_length % hop_length == 0:
+        # Frame boundaries are a strided view of the cumulative sum
+        bounds = csum[::hop_length]
+        k = frame_length // hop_length
+        return (bounds[k:k + n_frames] - bounds[:n_frames]) / frame_length
+    starts = np.arange(n_frames) * hop_length
+    return (csum[starts + frame_length] - csum[starts]) / frame_length
+
+
+def stream_blocks(audio_filepath, block_duration = 60.0):
+    '''
+    Read a sound file block by block as mono float32 arrays, returning (sample_rate, blocks generator).
+    '''
+    info = sf.info(audio_filepath)
+    block_length = max(1, int(block_duration * info.samplerate))
+
+    def blocks():
+        for block in sf.blocks(audio_filepath, blocksize=block_length, dtype='float32', always_2d=True):
+            yield block.mean(axis=1)
+    return info.samplerate, blocks()
+
+
+def stream_frame_power(blocks, frame_length = 1024, hop_length = 256):
+    '''
+    Centered (zero padded) frame energies of a blocks stream, the same framing as librosa.feature.rms.
+    Only the frame_length - hop_length overlap is carried between blocks.
+    '''
+    pad = np.zeros(frame_length // 2, dtype=np.float32)
+    buf = pad
+    for block in blocks:
+        buf = np.concatenate((buf, block))
+        power = frame_power(buf, frame_length, hop_length)
+        if len(power):
+            yield power
+            buf = buf[len(power) * hop_length:]
+    power = frame_power(np.concatenate((buf, pad)), frame_length, hop_length)
+    if len(power):
+        yield power
+
+
+def stream_split(audio_filepath, threshold_db, frame_length = 1024, hop_length = 256, block_duration = 60.0):
+    '''
+    Streaming equivalent of librosa.effects.split, yielding non-silent (begin, end) intervals in samples.
+    The file is read twice: once for the reference (max) energy, once to split.
+    '''
+    amin = 1e-10
+    sample_rate, blocks = stream_blocks(audio_filepath, block_duration)
+    ref = max((power.max() for power in stream_frame_power(blocks, frame_length, hop_length)), default=0.0)
+    limit = max(amin, ref) * 10.0 ** (-threshold_db / 10.0)
+    num_samples = sf.info(audio_filepath).frames
+
+    sample_rate, blocks = stream_blocks(audio_filepath, block_duration)
+    frame = 0
+    begin = None
+    for power in stream_frame_power(blocks, frame_length, hop_length):
+        non_silent = np.maximum(power, amin) > limit
+        edges = np.flatnonzero(np.diff(non_silent.astype(np.int8))) + 1
+        if begin is None and non_silent[0]:
+            begin = frame
+        elif begin is not None and not non_silent[0]:
+            yield begin * hop_length, min(frame * hop_length, num_samples)
+            begin = None
+        for edge in edges:
+            if non_silent[edge]:
+                begin = frame + edge
+            else:
+                yield begin * hop_length, min((frame + edge) * hop_length, num_samples)
+                begin = None
+        frame += len(power)
+    if begin is not None:
+        yield begin * hop_length, min(frame * hop_length, num_samples)
+
+
+def stream_segments(audio_filepath, min_duration, max_duration, max_gap_duration, threshold_db, block_duration = 60.0):
+    '''
+    Streaming find_segments: yields the final (begin, end) segments of a sound file as soon as they are known.
+    Gaps of max_gap_duration or more can never be merged, so the parts between them are merged on their own.
+    '''
+    sample_rate = sf.info(audio_filepath).samplerate
+    group = []
+
+    def flush(group):
+        segments = merge_segments_heap(SegmentTable.from_parts(group), sample_rate, max_duration, max_gap_duration)
+        return finish_segments(audio_filepath, segments, sample_rate, min_duration, max_duration)
+
+    for begin, end in stream_split(audio_filepath, threshold_db, block_duration=block_duration):
+        if group and (begin - group[-1][1]) / sample_rate >= max_gap_duration:
+            segments = flush(group)
+            yield from zip(segments.begin.tolist(), segments.end.tolist())
+            group = []
+        group.append((begin, end))
+    if group:
+        segments = flush(group)
+        yield from zip(segments.begin.tolist(), segments.end.tolist())
+
+
+def build_segments_streaming(audio_filepath, output_folder, output_filename, min_duration = 15, max_duration = 30, threshold = 32.0, max_gap_duration = 5.0, block_duration = 60.0, sidecar = False):
+    '''
+    Build best segments of a single (long) wav file in bounded memory, writing every chunk as soon as it is final.
+    The file is segmented at its own sample rate.
+    '''
+    os.makedirs(output_folder, exist_ok=True)
+    sample_rate = sf.info(audio_filepath).samplerate
+    num_samples = sf.info(audio_filepath).frames
+    total_duration = 0
+    max_segment = 0
+    j = 0
+    manifest = ManifestWriter(output_folder, fsync_every=100, sidecar=sidecar)
+    for begin, end in stream_segments(audio_filepath, min_duration, max_duration, max_gap_duration, threshold, block_duration):
+        segment_id = '%s-%04d' % (output_filename, j)
+        chunk, _ = sf.read(audio_filepath, start=begin, stop=min(end, num_samples), dtype='float32', always_2d=True)
+        write_wav(os.path.join(output_folder, '%s.wav' % segment_id), chunk.mean(axis=1), sample_rate)
+        manifest.add([segment_id], audio_filepath, [begin], [end])
+        duration = (end - begin - 1) / sample_rate
+        total_duration += duration
+        max_segment = max(max_segment, duration)
+        j += 1
+    manifest.finalize()
+
+    print(' -> Segmented into %d parts (%.1f min)' % (j, total_duration / 60))
+    if j:
+        print('Mean: %f' %( total_duration / j ))
+        print('Max: %d' %( max_segment ))
+    return j
+
+
+def decode_audio(audio_filepath, sample_rate = 22050, duration = None):
+    '''
+    Decode and resample an audio file (mp3, wav, ...) in a single ffmpeg pass, returning a mono float32 buffer.
+    Only the first duration seconds are decoded if duration is given.
+    '''
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', audio_filepath]
+    if duration is not None:
+        command += ['-t', str(duration)]
+    command += ['-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', '1', '-ar', str(sample_rate), '-']
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return np.frombuffer(process.stdout, dtype=np.float32)
+
+
+def convert_audio(audio_filepath, wav_filepath, sample_rate = 22050):
+    '''
+    Convert an audio file to a mono 16 bits PCM wav file at sample_rate, without loading it in memory.
+    '''
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', audio_filepath,
+               '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate), wav_filepath]
+    subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return wav_filepath
+
+
+def write_wav(wav_filepath, wav, sample_rate):
+    '''
+    Write a float waveform as a 16 bits PCM wav file
+    '''
+    from scipy.io.wavfile import write
+    write(wav_filepath, sample_rate, (wav * 32767).astype(np.int16))
+
+
+class ManifestWriter:
+    """
+    Append-only writer of the segments.csv manifest ("id|source|begin|end").
+    Rows of a file are appended once the file is done, and fsync'ed every fsync_every files,
+    so an interrupted run leaves a manifest valid up to the last completed file.
+    """
+    def __init__(self, output_folder, filename = 'segments.csv', fsync_every = 10, sidecar = False):
+        self.path = os.path.join(output_folder, filename)
+        self.fsync_every = fsync_every
+        self.sidecar = sidecar
+        self.pending = 0
+        self.f = open(self.path, 'w')
+
+    def add(self, ids, source, begins, ends):
+        self.f.write(''.join('%s|%s|%d|%d\n' % (segment_id, source, begin, end)
+                             for segment_id, begin, end in zip(ids, begins, ends)))
+        self.f.flush()
+        self.pending += 1
+        if self.pending >= self.fsync_every:
+            os.fsync(self.f.fileno())
+            self.pending = 0
+
+    def finalize(self):
+        '''
+        Close the manifest, rewrite it sorted by id and write the optional .npz sidecar.
+        '''
+        self.f.close()
+        manifest = read_manifest_csv(self.path)
+        order = np.argsort(manifest['id'], kind='stable')
+        manifest = {column: values[order] for column, values in manifest.items()}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(''.join('%s|%s|%d|%d\n' % row for row in zip(manifest['id'], manifest['source'], manifest['begin'], manifest['end'])))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self.sidecar:
+            sources, source_index = np.unique(manifest['source'], return_inverse=True)
+            np.savez(os.path.splitext(self.path)[0] + '.npz', id=manifest['id'], begin=manifest['begin'], end=manifest['end'],
+                     sources=sources, source_index=source_index.astype(np.int32))
+        return self.path
+
+
+def read_manifest_csv(manifest_path):
+    '''
+    Parse a segments.csv manifest into id, source, begin and end columns.
+    '''
+    rows = []
+    with open(manifest_path) as f:
+        for line in f:
+            fields = line.rstrip('\n').rsplit('|', 2)
+            if len(fields) == 3 and '|' in fields[0]:
+                rows.append(fields[0].split('|', 1) + fields[1:])
+    if not rows:
+        return {'id': np.array([], dtype=str), 'source': np.array([], dtype=str),
+                'begin': np.array([], dtype=np.int64), 'end': np.array([], dtype=np.int64)}
+    ids, sources, begins, ends = zip(*rows)
+    return {'id': np.array(ids), 'source': np.array(sources),
+            'begin': np.array(begins, dtype=np.int64), 'end': np.array(ends, dtype=np.int64)}
+
+
+def load_manifest(output_folder, filename = 'segments.csv'):
+    '''
+    Load the id, source, begin and end columns of a manifest, from its .npz sidecar when there is one.
+    '''
+    path = os.path.join(output_folder, filename)
+    sidecar = os.path.splitext(path)[0] + '.npz'
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        with np.load(sidecar) as data:
+            return {'id': data['id'], 'source': data['sources'][data['source_index']],
+                    'begin': data['begin'], 'end': data['end']}
+    return read_manifest_csv(path)
+
+
+def load_wav(audio_filepath, sample_rate, splitter = 'librosa'):
+    '''
+    Load a mono float32 waveform at sample_rate. With the numpy splitter, librosa is only imported
+    when the file must be resampled.
+    '''
+    if splitter == 'numpy':
+        wav, sr = sf.read(audio_filepath, dtype='float32', always_2d=True)
+        wav = wav.mean(axis=1)
+        if sr == sample_rate:
+            return wav, sr
+        import librosa
+        return librosa.resample(wav, orig_sr=sr, target_sr=sample_rate), sample_rate
+    import librosa
+    return librosa.load(audio_filepath, sr=sample_rate)
 
 
 def load_filenames(input_folder):
@@ -237,61 +725,95 @@ def load_filenames(input_folder):
     return mappings
 
 
-def build_segments(input_folder, output_folder, output_filename, min_duration = 15, max_duration = 30, threshold = 32.0, max_gap_duration = 5.0, sample_rate = 22050):
+def build_chunks(filename, wav, sample_rate, output_filename, min_duration = 15, max_duration = 30, threshold = 32.0, max_gap_duration = 5.0, output_folder = None, merge_method = 'heap', segments = None, splitter = 'librosa'):
     '''
-    Build best segments of wav files
+    Split a loaded waveform into its best segments, returning a list of (chunk_id, waveform) pairs.
+    Chunks are only written to disk when output_folder is given. Already known segments can be given.
     '''
-    os.makedirs(output_folder, exist_ok=True)
-    # Initializes variables
-    avg_duration = 0
-    all_segments = []
-    total_duration = 0
-    filenames = load_filenames(input_folder)
+    if segments is None:
+        segments = find_segments(filename, wav, sample_rate, min_duration, max_duration, max_gap_duration, threshold, merge_method, splitter)
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
 
-    for i, (file_id, filename) in enumerate(filenames.items()):
-        print('Loading %s: %s (%d of %d)' % (file_id, filename, i+1, len(filenames)))
-        wav, sr = librosa.load(filename, sr=sample_rate)
-        print(' -> Loaded %.1f min of audio. Splitting...' % (len(wav) / sr / 60))
-
-        # Find best segments
-        segments = find_segments(filename, wav, sr, min_duration, max_duration, max_gap_duration, threshold)
-        duration = sum((s.duration(sr) for s in segments))
-        total_duration += duration
+    chunks = []
+    for chunk_id, begin, end in zip(segments.ids(output_filename), segments.begin, segments.end):
+        chunk = wav[begin:end]
+        if output_folder:
+            write_wav(os.path.join(output_folder, '%s.wav' % chunk_id), chunk, sample_rate)
+        chunks.append((chunk_id, chunk))
+    return chunks
 
-        # Create records for the segments
-        output_filename = output_filename if output_filename else file_id
-        j = 0
-        for s in segments:
-            all_segments.append(s)
-            s.set_filename_and_id(filename, '%s-%04d' % (output_filename, j))
-            j = j + 1
 
-        print(' -> Segmented into %d parts (%.1f min, %.2f sec avg)' % (
-            len(segments), duration / 60, duration / len(segments)))
-
-        # Write segments to disk:
-        for s in segments:
-            segment_wav = (wav[s.begin:s.end] * 32767).astype(np.int16)
-            out_path = os.path.join(output_folder, '%s.wav' % s.id)
-            write(out_path, sr, segment_wav)
-
-            duration += len(segment_wav) / sr
-            duration_segment = len(segment_wav) / sr
-            if duration_segment > max_duration:
-                max_duration = duration_segment
+def segment_file(filename, output_folder, output_filename, min_duration = 15, max_duration = 30, threshold = 32.0, max_gap_duration = 5.0, sample_rate = 22050, merge_method = 'heap', splitter = 'librosa'):
+    '''
+    Find the best segments of one wav file and write them to output_folder as <output_filename>-NNNN.wav.
+    Returns the sample rate, the number of loaded samples and the segments table (the waveform stays in the worker).
+    '''
+    wav, sr = load_wav(filename, sample_rate, splitter)
+    segments = find_segments(filename, wav, sr, min_duration, max_duration, max_gap_duration, threshold, merge_method, splitter)
+    for segment_id, begin, end in zip(segments.ids(output_filename), segments.begin, segments.end):
+        write_wav(os.path.join(output_folder, '%s.wav' % segment_id), wav[begin:end], sr)
+    return sr, len(wav), segments
 
-            avg_duration = avg_duration + duration_segment
-        print(' -> Wrote %d segment wav files' % len(segments))
-        print(' -> Progress: %d segments, %.2f hours, %.2f sec avg' % (
-            len(all_segments), total_duration / 3600, total_duration / len(all_segments)))
 
-        print('Writing metadata for %d segments (%.2f hours)' % (len(all_segments), total_duration / 3600))
-        with open(os.path.join(output_folder, 'segments.csv'), 'w') as f:
-            for s in all_segments:
-                f.write('%s|%s|%d|%d\n' % (s.id, s.filename, s.begin, s.end))
+def build_segments(input_folder, output_folder, output_filename, min_duration = 15, max_duration = 30, threshold = 32.0, max_gap_duration = 5.0, sample_rate = 22050, merge_method = 'heap', sidecar = False, splitter = 'librosa', workers = 1):
+    '''
+    Build best segments of wav files.
+    With workers > 1, the files are loaded, split and written by a process pool, and their results are collected
+    in the file order, so the stats, the manifest and the segment ids are the same as with a single process.
+    '''
+    os.makedirs(output_folder, exist_ok=True)
+    # Initializes variables
+    total_segments = 0
+    total_duration = 0
+    sum_duration = 0
+    max_segment = 0
+    filenames = load_filenames(input_folder)
+    manifest = ManifestWriter(output_folder, sidecar=sidecar)
+    # Segments of every file are named after the file, unless a name is given
+    prefixes = [output_filename if output_filename else file_id for file_id in filenames]
+    params = (min_duration, max_duration, threshold, max_gap_duration, sample_rate, merge_method, splitter)
+
+    executor = None
+    if workers > 1 and len(filenames) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(filenames)))
+        results = executor.map(segment_file, filenames.values(), [output_folder] * len(filenames), prefixes,
+                               *[[param] * len(filenames) for param in params])
+    else:
+        results = (segment_file(filename, output_folder, prefix, *params) for filename, prefix in zip(filenames.values(), prefixes))
 
-        print('Mean: %f' %( avg_duration / len(all_segments) ))
-        print('Max: %d' %(max_duration ))
+    try:
+        for i, ((file_id, filename), prefix, (sr, num_samples, segments)) in enumerate(zip(filenames.items(), prefixes, results)):
+            print('Loaded %s: %s (%d of %d), %.1f min of audio' % (file_id, filename, i+1, len(filenames), num_samples / sr / 60))
+            stats = segments.stats(sr)
+            duration = stats['total']
+            total_duration += duration
+
+            # Create records for the segments
+            ids = segments.ids(prefix)
+            total_segments += len(segments)
+
+            print(' -> Segmented into %d parts (%.1f min, %.2f sec avg)' % (
+                len(segments), duration / 60, duration / len(segments)))
+            print(' -> Wrote %d segment wav files' % len(segments))
+            print(' -> Progress: %d segments, %.2f hours, %.2f sec avg' % (
+                total_segments, total_duration / 3600, total_duration / total_segments))
+
+            print('Writing metadata for %d segments (%.2f hours)' % (total_segments, total_duration / 3600))
+            manifest.add(ids, filename, segments.begin, segments.end)
+
+            sum_duration += stats['total']
+            max_segment = max(max_segment, stats['max'])
+            print('Mean: %f' %( sum_duration / total_segments ))
+            print('Max: %d' %( max_segment ))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    manifest.finalize()
+    return {'files': len(filenames), 'segments': total_segments, 'total': total_duration,
+            'mean': sum_duration / total_segments if total_segments else 0.0, 'max': max_segment}
 
 
 def main():
@@ -302,8 +824,18 @@ def main():
     parser.add_argument('--json_file', default='teste.json', help='Filename of input json file')
     parser.add_argument('--output_dir', default='output', help='Output dir')
     parser.add_argument('--metadata_file', default='metadata.csv', help='Filename to metadata output file')
+    parser.add_argument('--input_folder', default=None, help='Folder of wav files: split all of them into chunks in output_dir, with build_segments')
+    parser.add_argument('--sample_rate', type=int, default=22050, help='Sample rate of the chunks (with input_folder)')
+    parser.add_argument('--splitter', default='librosa', choices=list(SPLITTERS), help='Silence detection (with input_folder)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes splitting the files (with input_folder)')
     args = parser.parse_args()
 
+    if args.input_folder:
+        stats = build_segments(args.input_folder, os.path.join(args.base_dir, args.output_dir), None, sample_rate=args.sample_rate,
+                               splitter=args.splitter, workers=args.workers)
+        print('%d files, %d segments, %.2f hours' % (stats['files'], stats['segments'], stats['total'] / 3600))
+        return
+
     audio_path = os.path.join(args.base_dir, args.audio_file)
     json_path = os.path.join(args.base_dir, args.json_file)
     output_dir = os.path.join(args.base_dir, args.output_dir)
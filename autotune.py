@@ -0,0 +1,148 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import json
+import os
+import time
+from os.path import dirname, exists
+import numpy as np
+import soundfile as sf
+from synthetic import synthetic_audio
+
+# Chunk durations (seconds) timed by the calibration
+DEFAULT_DURATIONS = [10, 20, 30, 45, 60]
+
+
+def calibration_sample(audio_filepath=None, sample_rate=16000, duration=60.0):
+    '''
+    Mono float32 calibration audio: the first duration seconds of a sound file (at its own sample rate),
+    or synthetic speech-like audio (synthetic.synthetic_audio) if no file is given.
+    Returns (waveform, sample_rate).
+    '''
+    if audio_filepath:
+        wav, sr = sf.read(audio_filepath, frames=int(duration * sf.info(audio_filepath).samplerate), dtype='float32', always_2d=True)
+        return wav.mean(axis=1), sr
+    wav, _ = synthetic_audio(duration, sample_rate, speakers=2, max_gap=1.0)
+    return wav, sample_rate
+
+
+def measure_latency(diarizer, wav, sample_rate, durations=DEFAULT_DURATIONS, repeat=2):
+    '''
+    Best wall time in seconds of the diarization of one chunk of every duration, cut from (or tiled over) wav.
+    Returns the list of latencies, or None if the diarization fails.
+    '''
+    latencies = []
+    for duration in durations:
+        num_samples = int(duration * sample_rate)
+        chunk = np.tile(wav, num_samples // len(wav) + 1)[:num_samples]
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            for _, _, data in diarizer.diarize_batch([('calibration-%d-%d' % (duration, i), chunk)], sample_rate, 1):
+                if not data:
+                    return None
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        latencies.append(best)
+    return latencies
+
+
+def best_duration(durations, latencies):
+    '''
+    Measured chunk duration maximizing the diarization throughput (audio seconds per second). The latencies
+    are fitted by a + b * d + c * d^2 (per call overhead, linear cost, superlinear clustering) to smooth out
+    the timing noise, and the duration with the best fitted throughput is picked among the measured ones,
+    so the choice only moves between a few values from run to run.
+    Returns the duration and the fitted (a, b, c).
+    '''
+    durations = np.asarray(durations, dtype=np.float64)
+    latencies = np.asarray(latencies, dtype=np.float64)
+    fit = np.linalg.lstsq(np.stack([np.ones_like(durations), durations, durations ** 2], axis=1), latencies, rcond=None)[0]
+    model = fit[0] + fit[1] * durations + fit[2] * durations ** 2
+    if not (model > 0).all():
+        # Unusable fit (too few or noisy points): measured latencies
+        model = latencies
+    return float(durations[np.argmax(durations / model)]), fit.tolist()
+
+
+def autotune_segment_params(diarizer, wav, sample_rate, durations=DEFAULT_DURATIONS, repeat=2, min_ratio=2.0 / 3):
+    '''
+    Profile the diarization latency against chunk duration, and pick the segmentation min/max_duration
+    maximizing the throughput on this machine (min_duration keeps min_ratio of max_duration, as 20/30 s).
+    Returns a dict of the chosen parameters and of the measurements, None if the calibration fails.
+    '''
+    start = time.time()
+    latencies = measure_latency(diarizer, wav, sample_rate, durations, repeat)
+    if latencies is None:
+        print('Warning: Unable to calibrate the chunk duration, keeping the default one.')
+        return None
+    duration, fit = best_duration(durations, latencies)
+    result = {'min_duration': int(round(duration * min_ratio)), 'max_duration': int(round(duration)),
+              'durations': list(durations), 'latencies': latencies, 'fit': fit,
+              'throughput': {str(d): d / t for d, t in zip(durations, latencies)}, 'calibration_time': time.time() - start}
+    print('Calibrated chunk duration in {:.1f} sec: min_duration {}, max_duration {} ({})'.format(
+        result['calibration_time'], result['min_duration'], result['max_duration'],
+        ', '.join('%ds: %.1fx' % (d, d / t) for d, t in zip(durations, latencies))))
+    return result
+
+
+def tuned_segment_params(diarizer, autotune_file=None, durations=DEFAULT_DURATIONS, calibration_file=None, sample_rate=16000, recalibrate=False, sample=None):
+    '''
+    Segmentation parameters chosen by autotune_segment_params, saved to autotune_file and reused by the next runs
+    (so their cache keys and chunk ids don't change with the timing noise), unless recalibrate is set or the
+    calibration setup (durations, calibration file, sample rate, model) changed. Returns None if the calibration fails.
+    Without calibration_file, the waveform timed is the one returned by sample(duration) (ex. the start of the
+    first downloaded video), synthetic audio if sample is None. It is only loaded if a calibration is needed.
+    '''
+    setup = {'durations': list(durations), 'calibration_file': calibration_file, 'sample_rate': sample_rate, 'model': diarizer.model_name}
+    if autotune_file and exists(autotune_file) and not recalibrate:
+        with open(autotune_file) as f:
+            tuned = json.load(f)
+        if tuned.get('setup') == setup:
+            print('Chunk duration calibrated on {}: min_duration {}, max_duration {} (from {})'.format(
+                time.ctime(tuned['time']), tuned['min_duration'], tuned['max_duration'], autotune_file))
+            return tuned
+    if calibration_file is None and sample is not None:
+        try:
+            wav, sr = sample(max(durations)), sample_rate
+        except Exception:
+            print('Warning: Unable to load the calibration audio, keeping the default chunk duration.')
+            return None
+    else:
+        wav, sr = calibration_sample(calibration_file, sample_rate, max(durations))
+    tuned = autotune_segment_params(diarizer, wav, sr, durations)
+    if tuned is not None and autotune_file:
+        tuned.update(setup=setup, time=time.time())
+        if dirname(autotune_file):
+            os.makedirs(dirname(autotune_file), exist_ok=True)
+        with open(autotune_file + '.tmp', 'w') as f:
+            json.dump(tuned, f, indent=2)
+        os.replace(autotune_file + '.tmp', autotune_file)
+    return tuned
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the diarization throughput against the chunk duration on this machine.')
+    parser.add_argument('--calibration_file', default=None, help='Sound file used for the calibration (synthetic audio if none).')
+    parser.add_argument('--durations', nargs='+', type=float, default=DEFAULT_DURATIONS, help='Chunk durations to time, in seconds.')
+    parser.add_argument('--repeat', type=int, default=2, help='Runs of every duration, the best time is kept.')
+    parser.add_argument('--output', default=None, help='Json file to save the results.')
+    args = parser.parse_args()
+
+    from diarization import Diarizer
+    diarizer = Diarizer()
+    diarizer.warm_up()
+    wav, sample_rate = calibration_sample(args.calibration_file, diarizer.sample_rate, max(args.durations))
+    result = autotune_segment_params(diarizer, wav, sample_rate, args.durations, args.repeat)
+    if result is not None and args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return result is not None
+
+
+if __name__ == '__main__':
+    main()
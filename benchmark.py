@@ -0,0 +1,291 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from glob import glob
+from os.path import basename, join
+import numpy as np
+import soundfile as sf
+from audio_segmentation import SEGMENT_PARAMS, SPLITTERS, segment_wav, find_best_merge, find_segments, build_segments, create_segments_list_from_json, create_audio_files_from_segments_list, load_manifest
+from diarization import Diarizer, MockAnnotation, MockPipeline, WindowedDiarizer, execute_diarization, match_labels, overlap_matrix
+from synthetic import synthetic_audio
+
+CASES = ['segment_wav', 'find_best_merge', 'find_segments', 'build_segments', 'diarize_stub', 'diarize_windowed', 'create_segments_list_from_json', 'create_audio_files_from_segments_list']
+DURATIONS = ['1m', '10m', '1h', '10h']
+UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(label):
+    '''
+    Duration in seconds of a label like 90s, 10m or 2h.
+    '''
+    if label[-1] in UNITS:
+        return float(label[:-1]) * UNITS[label[-1]]
+    return float(label)
+
+
+class TonePipeline:
+    """
+    Stub diarization pipeline for the synthetic audio: frames are labelled by their dominant pitch, and labels
+    are numbered in order of appearance, so they restart in every chunk or window like a real pipeline's.
+    """
+    def __init__(self, frame_duration = 0.1, base_pitch = 120.0, pitch_step = 60.0):
+        # Speaker pitches of synthetic_audio
+        self.frame_duration = frame_duration
+        self.base_pitch = base_pitch
+        self.pitch_step = pitch_step
+
+    def __call__(self, audio):
+        if isinstance(audio, dict):
+            uri = audio.get('uri', 'waveform')
+            wav = np.asarray(audio['waveform']).reshape(-1)
+            sample_rate = audio['sample_rate']
+        else:
+            uri = basename(audio)
+            wav, sample_rate = sf.read(audio, dtype='float32')
+        frame = int(self.frame_duration * sample_rate)
+        frames = wav[:len(wav) // frame * frame].reshape(-1, frame)
+        spectrum = np.abs(np.fft.rfft(frames, axis=1))
+        pitch = np.argmax(spectrum, axis=1) * sample_rate / frame
+        energy = np.square(frames).mean(axis=1)
+        voiced = (energy > energy.max(initial=0) * 1e-3) & (pitch >= self.base_pitch - self.pitch_step / 2)
+        band = np.where(voiced, np.floor((pitch - self.base_pitch) / self.pitch_step + 0.5), -1).astype(int)
+        labels = {}
+        turns = []
+        edges = np.flatnonzero(np.diff(band)) + 1
+        for begin, end in zip(np.concatenate(([0], edges)), np.concatenate((edges, [len(band)]))):
+            if band[begin] < 0:
+                continue
+            label = labels.setdefault(band[begin], 'SPEAKER_%02d' % len(labels))
+            turns.append((begin * self.frame_duration, end * self.frame_duration, chr(ord('A') + len(turns) % 26), label))
+        return MockAnnotation(uri, turns)
+
+    def to(self, device):
+        return self
+
+
+class StubDiarizer(Diarizer):
+    """
+    Diarizer over a stub pipeline (TonePipeline, MockPipeline), handing it numpy waveforms: no torch needed.
+    """
+    def __init__(self, pipeline, model_name='stub'):
+        super().__init__(model_name=model_name, pipeline=pipeline)
+
+    def diarize_waveform(self, waveform, sample_rate, uri):
+        return self.pipeline({'waveform': np.asarray(waveform), 'sample_rate': sample_rate, 'uri': uri}).for_json()
+
+
+def label_consistency(reference, hypothesis):
+    '''
+    Fraction of the reference speech time labelled consistently by the hypothesis, under the best one to one
+    mapping of their labels over the whole recording. Both are (start, end, label) lists in absolute seconds.
+    '''
+    matrix, _, _ = overlap_matrix(reference, hypothesis)
+    total = sum(end - start for start, end, _ in reference)
+    matched = sum(matrix[i, j] for i, j in match_labels(matrix).items())
+    return matched / total if total else 0.0
+
+
+def measure(func, repeat, setup = None):
+    '''
+    Best wall time in seconds of repeat runs of func, setup being called (untimed) before every run.
+    '''
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def reset_folder(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+
+def run_duration(label, cases, work_dir, sample_rate, repeat, audio_params, turn_duration, splitter = 'librosa', window_duration = 60.0, window_step = 50.0):
+    '''
+    Run the benchmark cases over a synthetic audio of the given duration label.
+    Returns a dict case: best wall time in seconds, and with diarize_windowed a dict of the label consistency
+    with the synthetic turns of the chunked and windowed diarizations (TonePipeline).
+    '''
+    duration = parse_duration(label)
+    wav, truth = synthetic_audio(duration, sample_rate, **audio_params)
+    input_folder = join(work_dir, label)
+    wavs_folder = join(input_folder, 'wavs')
+    json_folder = join(input_folder, 'json')
+    result_folder = join(input_folder, 'result')
+    reset_folder(input_folder)
+    sf.write(join(input_folder, 'bench.wav'), wav, sample_rate, subtype='PCM_16')
+    threshold = SEGMENT_PARAMS['threshold']
+    results = {}
+    consistency = {}
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        segments = segment_wav(wav, threshold, 'bench', splitter)
+        if 'segment_wav' in cases:
+            results['segment_wav'] = measure(lambda: segment_wav(wav, threshold, 'bench', splitter), repeat)
+        if 'find_best_merge' in cases:
+            results['find_best_merge'] = measure(lambda: find_best_merge(segments, sample_rate, SEGMENT_PARAMS['max_duration'], SEGMENT_PARAMS['max_gap_duration']), repeat)
+        if 'find_segments' in cases:
+            results['find_segments'] = measure(lambda: find_segments('bench', wav, sample_rate, SEGMENT_PARAMS['min_duration'], SEGMENT_PARAMS['max_duration'],
+                                                                     SEGMENT_PARAMS['max_gap_duration'], threshold, splitter=splitter), repeat)
+        del wav
+
+        # The following cases work on the chunks written by build_segments
+        build = lambda: build_segments(input_folder, wavs_folder, 'bench', sample_rate=sample_rate, splitter=splitter, **SEGMENT_PARAMS)
+        elapsed = measure(build, repeat if 'build_segments' in cases else 1, lambda: reset_folder(wavs_folder))
+        if 'build_segments' in cases:
+            results['build_segments'] = elapsed
+        chunks = sorted(glob(join(wavs_folder, '*.wav')))
+
+        diarizer = Diarizer(pipeline=MockPipeline(turn_duration, audio_params['speakers']))
+        def diarize():
+            for chunk in chunks:
+                execute_diarization(chunk, diarizer, join(json_folder, basename(chunk).replace('.wav', '.json')))
+        elapsed = measure(diarize, repeat if 'diarize_stub' in cases else 1, lambda: reset_folder(json_folder))
+        if 'diarize_stub' in cases:
+            results['diarize_stub'] = elapsed
+        json_paths = [join(json_folder, basename(chunk).replace('.wav', '.json')) for chunk in chunks]
+
+        if 'diarize_windowed' in cases:
+            windowed = WindowedDiarizer(StubDiarizer(TonePipeline()), window_duration, window_step)
+            data = {}
+            def diarize_windowed():
+                data['windowed'] = windowed(join(input_folder, 'bench.wav'))
+            results['diarize_windowed'] = measure(diarize_windowed, repeat)
+            consistency['windowed'] = label_consistency(truth, [(fragment['segment']['start'], fragment['segment']['end'], fragment['label'])
+                                                                    for fragment in data['windowed']['content']])
+            # Chunk labels are only consistent inside their chunk
+            manifest = load_manifest(wavs_folder)
+            offsets = dict(zip(manifest['id'].tolist(), (manifest['begin'] / sample_rate).tolist()))
+            tone = Diarizer(pipeline=TonePipeline())
+            chunked = []
+            for chunk in chunks:
+                chunk_id = basename(chunk).replace('.wav', '')
+                for fragment in tone(chunk).for_json()['content']:
+                    chunked.append((offsets[chunk_id] + fragment['segment']['start'], offsets[chunk_id] + fragment['segment']['end'],
+                                    chunk_id + fragment['label']))
+            consistency['chunked'] = label_consistency(truth, chunked)
+
+        segments_lists = [create_segments_list_from_json(json_path) for json_path in json_paths]
+        if 'create_segments_list_from_json' in cases:
+            results['create_segments_list_from_json'] = measure(lambda: [create_segments_list_from_json(json_path) for json_path in json_paths], repeat)
+        if 'create_audio_files_from_segments_list' in cases:
+            export = lambda: [create_audio_files_from_segments_list(chunk, basename(chunk), segments_list, result_folder) for chunk, segments_list in zip(chunks, segments_lists)]
+            results['create_audio_files_from_segments_list'] = measure(export, repeat, lambda: reset_folder(result_folder))
+
+    shutil.rmtree(input_folder, ignore_errors=True)
+    return results, consistency
+
+
+def compare(results, baseline, tolerance = 1.25, min_delta = 0.01):
+    '''
+    Compare results with a baseline, returning the list of (case, duration, baseline, current) regressions:
+    slower than tolerance times the baseline, and by more than min_delta seconds.
+    '''
+    regressions = []
+    for case, timings in results['results'].items():
+        for label, current in timings.items():
+            reference = baseline['results'].get(case, {}).get(label)
+            if reference is None:
+                continue
+            if current > reference * tolerance and current - reference > min_delta:
+                regressions.append((case, label, reference, current))
+    return regressions
+
+
+def print_results(results, baseline = None):
+    print('%-40s %8s %10s %10s %10s' % ('case', 'audio', 'seconds', 'x realtime', 'baseline'))
+    for case, timings in results['results'].items():
+        for label, elapsed in timings.items():
+            reference = baseline['results'].get(case, {}).get(label) if baseline else None
+            print('%-40s %8s %10.4f %10.1f %10s' % (case, label, elapsed, parse_duration(label) / max(elapsed, 1e-9),
+                                                  '%.2fx' % (elapsed / reference) if reference else '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark segmentation, merge, diarization (stub pipeline) and export over synthetic audio.')
+    parser.add_argument('--durations', nargs='+', default=DURATIONS, help='Audio durations to benchmark, ex. 90s 10m 2h.')
+    parser.add_argument('--cases', nargs='+', default=CASES, choices=CASES, help='Benchmark cases to run.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every case, the best time is kept.')
+    parser.add_argument('--sample_rate', type=int, default=16000, help='Sample rate of the synthetic audio.')
+    parser.add_argument('--speakers', type=int, default=2, help='Number of synthetic speakers.')
+    parser.add_argument('--min_burst', type=float, default=0.5, help='Minimum tone burst duration in seconds.')
+    parser.add_argument('--max_burst', type=float, default=8.0, help='Maximum tone burst duration in seconds.')
+    parser.add_argument('--min_gap', type=float, default=0.1, help='Minimum silence duration in seconds.')
+    parser.add_argument('--max_gap', type=float, default=2.0, help='Maximum silence duration in seconds.')
+    parser.add_argument('--gap_distribution', default='uniform', choices=['uniform', 'exponential'], help='Distribution of the silence durations.')
+    parser.add_argument('--splitter', default='librosa', choices=list(SPLITTERS), help='Silence detection of the segmentation.')
+    parser.add_argument('--turn_duration', type=float, default=5.0, help='Turn duration of the stub diarization pipeline.')
+    parser.add_argument('--window_duration', type=float, default=60.0, help='Window duration of the windowed diarization.')
+    parser.add_argument('--window_step', type=float, default=50.0, help='Window step of the windowed diarization.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic audio.')
+    parser.add_argument('--work_dir', default=None, help='Folder of the temporary audio files (a temporary folder by default).')
+    parser.add_argument('--output', default='benchmark_results.json', help='Json file to save the results.')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='Json file of the baseline results.')
+    parser.add_argument('--save_baseline', action='store_true', help='Save the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='Slowdown ratio over the baseline reported as a regression.')
+    args = parser.parse_args()
+
+    audio_params = {'speakers': args.speakers, 'min_burst': args.min_burst, 'max_burst': args.max_burst, 'min_gap': args.min_gap,
+                    'max_gap': args.max_gap, 'gap_distribution': args.gap_distribution, 'seed': args.seed}
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark-')
+    results = {'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                               'processor': platform.processor(), 'cpus': os.cpu_count()},
+               'params': dict(audio_params, sample_rate=args.sample_rate, repeat=args.repeat, turn_duration=args.turn_duration, splitter=args.splitter,
+                                window_duration=args.window_duration, window_step=args.window_step),
+               'time': time.time(), 'results': {case: {} for case in args.cases}, 'consistency': {}}
+    try:
+        for label in args.durations:
+            print('Benchmarking %s of audio...' % label)
+            timings, consistency = run_duration(label, args.cases, work_dir, args.sample_rate, args.repeat, audio_params, args.turn_duration,
+                                                args.splitter, args.window_duration, args.window_step)
+            for case, elapsed in timings.items():
+                results['results'][case][label] = elapsed
+            if consistency:
+                results['consistency'][label] = consistency
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print('Saved baseline {}'.format(args.baseline))
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['params'] != results['params']:
+            print('Warning: baseline {} was run with other parameters.'.format(args.baseline))
+    print_results(results, baseline)
+    for label, consistency in results['consistency'].items():
+        print('Label consistency (%s): chunked %.3f, windowed %.3f' % (label, consistency['chunked'], consistency['windowed']))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for case, label, reference, current in regressions:
+            print('REGRESSION {} ({}): {:.4f}s -> {:.4f}s ({:.2f}x)'.format(case, label, reference, current, current / reference))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
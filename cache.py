@@ -0,0 +1,129 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+from os.path import basename, exists, getsize, isdir, join
+
+STAGES = ['download', 'segment', 'diarize', 'export']
+
+
+def file_hash(filepath, block_size = 1 << 20):
+    '''
+    sha256 of a file content, read block by block.
+    '''
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of stage results. An entry is a folder named by the hash of the
+    stage name and its key parameters, holding a result.json and optional artifact files.
+    The least recently used entries are evicted when the cache grows over max_size bytes.
+    """
+    def __init__(self, cache_dir, max_size = 50 * 2**30, force = ()):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.force = set(STAGES) if 'all' in force else set(force)
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, stage, **params):
+        params = json.dumps(dict(params, stage=stage), sort_keys=True)
+        return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+    def get(self, stage, **params):
+        '''
+        Returns (result, entry folder) of a cached stage result, or (None, None) on a miss or when stage is forced.
+        '''
+        if stage in self.force:
+            return None, None
+        entry = join(self.cache_dir, self.key(stage, **params))
+        try:
+            with open(join(entry, 'result.json')) as f:
+                result = json.load(f)
+        except (IOError, ValueError):
+            return None, None
+        # Mark as recently used
+        os.utime(entry)
+        return result, entry
+
+    def put(self, stage, result, files = (), **params):
+        '''
+        Store a json serializable stage result and artifact files (copied in the entry folder).
+        '''
+        entry = join(self.cache_dir, self.key(stage, **params))
+        tmp = entry + '.tmp%d' % threading.get_ident()
+        os.makedirs(tmp, exist_ok=True)
+        for filepath in files:
+            link_or_copy(filepath, join(tmp, basename(filepath)))
+        with open(join(tmp, 'result.json'), 'w') as f:
+            json.dump(result, f, ensure_ascii=False)
+        with self.lock:
+            if exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+            self.evict()
+        return entry
+
+    def size(self):
+        return sum(entry_size for _, entry_size, _ in self.entries())
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = join(self.cache_dir, name)
+            if isdir(entry) and '.tmp' not in name:
+                entry_size = sum(getsize(join(entry, f)) for f in os.listdir(entry))
+                entries.append((entry, entry_size, os.stat(entry).st_mtime))
+        return entries
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits in max_size.
+        '''
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(entry_size for _, entry_size, _ in entries)
+        for entry, entry_size, _ in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= entry_size
+
+
+def link_or_copy(src, dst):
+    '''
+    Hard link src to dst when possible (same filesystem), copy otherwise.
+    '''
+    if exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache_dir', default='cache', help='Cache folder.')
+    parser.add_argument('--max_size', type=float, default=50, help='Maximum cache size in GB.')
+    args = parser.parse_args()
+    cache = ResultCache(args.cache_dir, int(args.max_size * 2**30))
+    before = cache.size()
+    cache.evict()
+    print('Cache {}: {} entries, {:.2f} GB (was {:.2f} GB)'.format(args.cache_dir, len(cache.entries()), cache.size() / 2**30, before / 2**30))
+
+
+if __name__ == '__main__':
+    main()
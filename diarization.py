@@ -8,29 +8,439 @@
 from os.path import basename, dirname, join
 import json
 import argparse
-from pyannote.audio import Pipeline
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-def execute_diarization(audio_filepath):
+DEFAULT_MODEL = "pyannote/speaker-diarization"
+
+# Loaded pipelines, keyed by (model name, device)
+_pipelines = {}
+
+
+def load_pipeline(model_name=DEFAULT_MODEL, device=None):
+    '''
+    Load a pyannote pipeline only once, returning the cached instance for later calls.
+    '''
+    key = (model_name, device)
+    if key not in _pipelines:
+        start = time.time()
+        from pyannote.audio import Pipeline
+        pipeline = Pipeline.from_pretrained(model_name)
+        if device is not None:
+            import torch
+            pipeline.to(torch.device(device))
+        _pipelines[key] = pipeline
+        print('Loaded diarization pipeline {} in {:.2f} sec'.format(model_name, time.time() - start))
+    return _pipelines[key]
+
+
+class Diarizer:
+    """
+    Long-lived diarization pipeline, reused across every chunk and video.
+    """
+    def __init__(self, model_name=DEFAULT_MODEL, device=None, sample_rate=16000, pipeline=None):
+        self.model_name = model_name
+        self.device = device
+        self.sample_rate = sample_rate
+        self.pipeline = pipeline if pipeline is not None else load_pipeline(model_name, device)
+
+    def warm_up(self, duration=2.0):
+        '''
+        Run the pipeline over a short synthetic signal so the first chunk doesn't pay the cold-start cost.
+        '''
+        import torch
+        start = time.time()
+        num_samples = int(duration * self.sample_rate)
+        noise = 0.01 * np.random.RandomState(0).randn(1, num_samples).astype(np.float32)
+        try:
+            self.pipeline({'waveform': torch.from_numpy(noise), 'sample_rate': self.sample_rate, 'uri': 'warm_up'})
+        except Exception:
+            print("Warning: Unable to warm up diarization pipeline.")
+            return False
+        print('Warmed up diarization pipeline in {:.2f} sec'.format(time.time() - start))
+        return True
+
+    def __call__(self, audio_filepath):
+        return self.pipeline(audio_filepath)
+
+    def diarize_waveform(self, waveform, sample_rate, uri):
+        '''
+        Diarize an in-memory mono waveform, returning the pyannote json-like dict.
+        '''
+        import torch
+        waveform = torch.from_numpy(np.ascontiguousarray(waveform, dtype=np.float32)).unsqueeze(0)
+        diarization = self.pipeline({'waveform': waveform, 'sample_rate': sample_rate, 'uri': uri})
+        return diarization.for_json()
+
+    def diarize_batch(self, chunks, sample_rate, batch_size=8):
+        '''
+        Diarize (chunk_id, waveform) pairs one at a time, without any disk round-trip: the pipeline has
+        no multi-chunk batching (it batches the frames of a chunk internally), so batch_size is unused here,
+        it only sets the chunks per task of a ParallelDiarizer.
+        Yields (chunk_id, waveform, data) tuples, data being False when diarization fails.
+        '''
+        for chunk_id, waveform in chunks:
+            try:
+                data = self.diarize_waveform(waveform, sample_rate, chunk_id)
+            except Exception:
+                print("Error: Unable to execute diarization pipeline on {}.".format(chunk_id))
+                data = False
+            yield chunk_id, waveform, data
+
+
+class MockAnnotation:
+    """
+    Minimal stand-in for pyannote.core.Annotation, as returned by MockPipeline.
+    """
+    def __init__(self, uri, turns):
+        self.uri = uri
+        self.turns = turns
+
+    def for_json(self):
+        content = [{'segment': {'start': start, 'end': end}, 'track': track, 'label': label}
+                   for start, end, track, label in self.turns]
+        return {'pyannote': 'Annotation', 'content': content, 'uri': self.uri, 'modality': 'speaker'}
+
+
+class MockPipeline:
+    """
+    Fake diarization pipeline for tests: alternates num_speakers speakers every turn_duration seconds,
+    without loading any model weights.
+    """
+    def __init__(self, turn_duration=5.0, num_speakers=2):
+        self.turn_duration = turn_duration
+        self.num_speakers = num_speakers
+
+    def __call__(self, audio):
+        if isinstance(audio, dict):
+            uri = audio.get('uri', 'waveform')
+            duration = audio['waveform'].shape[-1] / audio['sample_rate']
+        else:
+            import soundfile as sf
+            uri = basename(audio)
+            duration = sf.info(audio).duration
+        turns = []
+        for i, start in enumerate(np.arange(0, duration, self.turn_duration)):
+            end = min(start + self.turn_duration, duration)
+            turns.append((float(start), float(end), chr(ord('A') + i % 26), 'SPEAKER_%02d' % (i % self.num_speakers)))
+        return MockAnnotation(uri, turns)
+
+    def to(self, device):
+        return self
+
+
+# Diarization pipeline of a ParallelDiarizer worker process
+_worker_diarizer = None
+
+
+def init_worker(model_name, device, torch_threads, pipeline_factory):
+    '''
+    Process pool initializer: limit the torch intra-op threads and load the pipeline once per worker.
+    '''
+    global _worker_diarizer
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        pass
+    pipeline = pipeline_factory() if pipeline_factory is not None else None
+    _worker_diarizer = Diarizer(model_name, device, pipeline=pipeline)
+    if pipeline is None:
+        _worker_diarizer.warm_up()
+
+
+def ready_worker(_):
+    return _worker_diarizer is not None
+
+
+def diarize_file_worker(audio_filepath):
+    try:
+        return _worker_diarizer(audio_filepath).for_json()
+    except Exception:
+        print("Error: Unable to execute diarization pipeline on {}.".format(audio_filepath))
+        return False
+
+
+def diarize_waveform_worker(task):
+    chunk_id, waveform, sample_rate = task
+    try:
+        return _worker_diarizer.diarize_waveform(waveform, sample_rate, chunk_id)
+    except Exception:
+        print("Error: Unable to execute diarization pipeline on {}.".format(chunk_id))
+        return False
+
+
+class ParallelDiarizer:
+    """
+    Diarize chunks on a process pool, each worker loading the pipeline once. workers * torch_threads
+    should not exceed the number of cores. Results are returned in chunk order.
+    """
+    def __init__(self, workers=2, torch_threads=1, model_name=DEFAULT_MODEL, device=None, pipeline_factory=None):
+        self.model_name = model_name
+        self.workers = workers
+        self.torch_threads = torch_threads
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                            initargs=(model_name, device, torch_threads, pipeline_factory))
+
+    def warm_up(self):
+        '''
+        Start the workers, so they load and warm up their pipeline before the first chunk.
+        '''
+        return all(self.executor.map(ready_worker, range(self.workers)))
+
+    def map(self, audio_filepaths):
+        '''
+        Diarize audio files, returning their json-like results (False on failure) in the same order.
+        '''
+        return list(self.executor.map(diarize_file_worker, audio_filepaths))
+
+    def diarize_batch(self, chunks, sample_rate, batch_size=8):
+        '''
+        Diarize (chunk_id, waveform) pairs on the workers, batch_size chunks per task (each worker still
+        diarizes them one by one), yielding (chunk_id, waveform, data) tuples in chunk order.
+        '''
+        chunks = list(chunks)
+        tasks = ((chunk_id, waveform, sample_rate) for chunk_id, waveform in chunks)
+        for (chunk_id, waveform), data in zip(chunks, self.executor.map(diarize_waveform_worker, tasks, chunksize=batch_size)):
+            yield chunk_id, waveform, data
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def stream_windows(audio_filepath, window_duration=60.0, step_duration=50.0):
+    '''
+    Read a sound file as overlapping mono float32 windows, yielding (offset in seconds, window).
+    Only one window is held in memory, the overlap is carried over instead of being read again.
+    '''
+    import soundfile as sf
+    with sf.SoundFile(audio_filepath) as f:
+        window = int(window_duration * f.samplerate)
+        step = min(int(step_duration * f.samplerate), window)
+        offset = 0
+        buf = f.read(window, dtype='float32', always_2d=True).mean(axis=1)
+        while len(buf):
+            yield offset / f.samplerate, buf
+            if len(buf) < window:
+                break
+            block = f.read(step, dtype='float32', always_2d=True).mean(axis=1)
+            if not len(block):
+                break
+            buf = np.concatenate((buf[step:], block))
+            offset += step
+
+
+def overlap_matrix(a, b):
+    '''
+    Total overlap duration of every (label of a, label of b) pair, a and b being (start, end, label) turn lists.
+    Returns the matrix and the labels of a and b.
+    '''
+    a_labels = sorted(set(label for _, _, label in a))
+    b_labels = sorted(set(label for _, _, label in b))
+    matrix = np.zeros((len(a_labels), len(b_labels)))
+    if not a or not b:
+        return matrix, a_labels, b_labels
+    a_times = np.array([(start, end) for start, end, _ in a])
+    b_times = np.array([(start, end) for start, end, _ in b])
+    overlap = np.maximum(0, np.minimum(a_times[:, None, 1], b_times[None, :, 1]) - np.maximum(a_times[:, None, 0], b_times[None, :, 0]))
+    a_index = np.array([a_labels.index(label) for _, _, label in a])
+    b_index = np.array([b_labels.index(label) for _, _, label in b])
+    np.add.at(matrix, (a_index[:, None], b_index[None, :]), overlap)
+    return matrix, a_labels, b_labels
+
+
+def match_labels(matrix):
+    '''
+    One to one (row, column) matching of an overlap matrix, largest overlaps first.
+    '''
+    pairs = {}
+    used = set()
+    for flat in np.argsort(-matrix, axis=None):
+        i, j = np.unravel_index(flat, matrix.shape)
+        if matrix[i, j] <= 0:
+            break
+        if i not in pairs and j not in used:
+            pairs[int(i)] = int(j)
+            used.add(j)
+    return pairs
+
+
+class WindowStitcher:
+    """
+    Stitch the diarization of overlapping windows into one timeline. The labels of a window are mapped to the
+    timeline labels by their overlap with the previous window in the shared region, and the timeline switches
+    from a window to the next one at the middle of their overlap.
+    With a SpeakerIndex, the labels without overlap evidence (ex. a speaker coming back after a silence)
+    are matched by their embeddings against all the speakers seen so far.
+    """
+    def __init__(self, index=None):
+        self.index = index
+        self.final = []
+        self.pending = []
+        self.previous = []
+        self.previous_end = 0.0
+        self.labels = []
+        # Embeddings of the window turns, the turns refer to them by row (-1 for none)
+        self.rows = []
+        self.embeddings = None
+
+    def speaker_id(self, k):
+        return self.index.speaker_id(k) if self.index is not None else 'SPEAKER_%02d' % k
+
+    def add(self, offset, duration, turns, embeddings=None, weights=None, turn_embeddings=None):
+        '''
+        Add the (start, end, label) turns of a window, times relative to the window start.
+        With an index, embeddings (and speech durations as weights) are given per window label, in sorted label order.
+        turn_embeddings (one row per turn, NaN for the turns without one) are carried to the timeline turns.
+        '''
+        rows = [-1] * len(turns)
+        if turn_embeddings is not None:
+            for i, embedding in enumerate(turn_embeddings):
+                if not np.isnan(embedding).any():
+                    rows[i] = len(self.rows)
+                    self.rows.append(embedding)
+        turns = [(start + offset, end + offset, label) for start, end, label in turns]
+        shared = [(max(start, offset), min(end, self.previous_end), label) for start, end, label in turns if start < self.previous_end]
+        previous = [(max(start, offset), min(end, self.previous_end), label) for start, end, label, _ in self.previous if end > offset]
+        matrix, local_labels, global_labels = overlap_matrix(shared, previous)
+        mapping = {local_labels[i]: global_labels[j] for i, j in match_labels(matrix).items()}
+        labels = sorted(set(label for _, _, label in turns))
+        assigned = [self.labels.index(mapping[label]) if label in mapping else None for label in labels]
+        if self.index is not None and embeddings is not None and labels:
+            assigned = self.index.assign(embeddings, weights, assigned)
+        for label, k in zip(labels, assigned):
+            if k is None:
+                k = len(self.labels)
+            while k >= len(self.labels):
+                self.labels.append(self.speaker_id(len(self.labels)))
+            mapping[label] = self.labels[k]
+        turns = [(start, end, mapping[label], row) for (start, end, label), row in zip(turns, rows)]
+
+        # Only the turns kept from the previous window can still be cut
+        cut = (offset + self.previous_end) / 2 if self.previous else offset
+        self.final.extend((start, min(end, cut), label, row) for start, end, label, row in self.pending if start < cut)
+        self.pending = [(max(start, cut), end, label, row) for start, end, label, row in turns if end > cut]
+        self.previous = turns
+        self.previous_end = offset + duration
+
+    def finish(self, max_gap=0.0):
+        '''
+        Timeline turns, sorted, the adjacent turns of a same speaker (ex. cut at a window switch) merged.
+        With turn embeddings, self.embeddings gets one row per timeline turn: the normalized, duration weighted
+        average of the embeddings of its window turns (NaN if none has one).
+        '''
+        merged = []
+        pieces = []
+        last = {}
+        for start, end, label, row in sorted(self.final + self.pending):
+            if end <= start:
+                continue
+            i = last.get(label)
+            if i is not None and start - merged[i][1] <= max_gap:
+                merged[i] = (merged[i][0], max(end, merged[i][1]), label)
+            else:
+                last[label] = len(merged)
+                merged.append((start, end, label))
+                pieces.append([])
+                i = len(merged) - 1
+            if row >= 0:
+                pieces[i].append((row, end - start))
+        if self.rows:
+            self.embeddings = np.full((len(merged), len(self.rows[0])), np.nan)
+            for i, turn_pieces in enumerate(pieces):
+                if turn_pieces:
+                    rows, durations = zip(*turn_pieces)
+                    embedding = np.average([self.rows[row] for row in rows], axis=0, weights=np.asarray(durations) + 1e-6)
+                    self.embeddings[i] = embedding / max(np.linalg.norm(embedding), 1e-12)
+        return merged
+
+
+class WindowedDiarizer:
+    """
+    Diarize a whole recording in one pass: overlapping windows are streamed through the loaded pipeline(s)
+    (Diarizer or ParallelDiarizer, the latter holding all the windows at once), and stitched into one timeline.
+    Drop-in replacement of the segmentation + chunk diarization steps.
+    With a speakers.SpeakerLinker, the window labels are also matched by their embeddings, the timeline
+    is labelled with the global speaker ids of its index, and self.embeddings holds the embeddings of its turns.
+    """
+    def __init__(self, diarizer, window_duration=60.0, step_duration=50.0, batch_size=4, linker=None):
+        self.diarizer = diarizer
+        self.linker = linker
+        self.model_name = diarizer.model_name
+        self.window_duration = window_duration
+        self.step_duration = step_duration
+        self.batch_size = batch_size
+        self.embeddings = None
+
+    def __call__(self, audio_filepath, uri=None):
+        '''
+        Diarize a sound file, returning the json-like dict of the whole timeline, or False if a window failed.
+        '''
+        import soundfile as sf
+        self.embeddings = None
+        sample_rate = sf.info(audio_filepath).samplerate
+        uri = uri or basename(audio_filepath).split('.')[0]
+        windows = []
+
+        def chunks():
+            for offset, window in stream_windows(audio_filepath, self.window_duration, self.step_duration):
+                windows.append((offset, window))
+                yield '%s-window-%05d' % (uri, len(windows) - 1), window
+
+        stitcher = WindowStitcher(self.linker.index if self.linker else None)
+        for i, (_, _, data) in enumerate(self.diarizer.diarize_batch(chunks(), sample_rate, self.batch_size)):
+            if not data:
+                return False
+            offset, window = windows[i]
+            # Only the last window is kept
+            windows[i] = (offset, None)
+            turns = [(fragment['segment']['start'], fragment['segment']['end'], fragment['label']) for fragment in data['content']]
+            embeddings, weights, turn_embeddings = None, None, None
+            if self.linker and turns:
+                begins = np.asarray([int(start * sample_rate) for start, _, _ in turns])
+                ends = np.minimum([int(end * sample_rate) for _, end, _ in turns], len(window))
+                _, embeddings, weights, turn_embeddings = self.linker.embed_labels(window, sample_rate, begins, ends, [label for _, _, label in turns])
+            stitcher.add(offset, len(window) / sample_rate, turns, embeddings, weights, turn_embeddings)
+        if self.linker and self.linker.index_filepath:
+            self.linker.index.save(self.linker.index_filepath)
+        content = [{'segment': {'start': start, 'end': end}, 'track': chr(ord('A') + i % 26), 'label': label}
+                   for i, (start, end, label) in enumerate(stitcher.finish())]
+        self.embeddings = stitcher.embeddings
+        return {'pyannote': 'Annotation', 'content': content, 'uri': uri, 'modality': 'speaker'}
+
+
+def execute_diarization(audio_filepath, diarizer=None, output_json=None):
     """
     Execute diarization pipeline using pyannote-audio. Source: https://github.com/pyannote/pyannote-audio
         Parameters:
         audio_filepath (str): mp3 audio filepath.
+        diarizer (Diarizer): loaded diarization pipeline. If None, the cached default pipeline is used.
+        output_json (str): json filepath of the result, segments.json next to the audio file if None.
 
         Returns:
         String: returns json filepath or False.
     """
     #pipeline = torch.hub.load('pyannote/pyannote-audio', 'dia_ami')
-    pipeline = Pipeline.from_pretrained("pyannote/speaker-diarization")
+    if diarizer is None:
+        diarizer = Diarizer()
 
     filename = basename(audio_filepath)
     folder = dirname(audio_filepath)
-    output_json = join(folder, 'segments.json')
+    if output_json is None:
+        output_json = join(folder, 'segments.json')
 
     #input_diarization_file = {'uri': filename, 'audio': audio_filepath}
 
     try:
         #diarization = pipeline(input_diarization_file)
-        diarization = pipeline(audio_filepath)
+        diarization = diarizer(audio_filepath)
         data = diarization.for_json()
 
     except:
@@ -52,8 +462,11 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_file', default='', help="mp3 filepath")
+    parser.add_argument('--model', default=DEFAULT_MODEL, help="pyannote pretrained pipeline name")
+    parser.add_argument('--device', default=None, help="torch device, ex. cpu or cuda")
     args = parser.parse_args()
-    execute_diarization(args.input_file)
+    diarizer = Diarizer(args.model, args.device)
+    execute_diarization(args.input_file, diarizer)
 
 
 if __name__ == '__main__':
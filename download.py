@@ -7,13 +7,16 @@
 import argparse
 import sys
 from os import makedirs
-from os.path import join, exists, split
+from os.path import basename, dirname, join, exists, split
 import time
-import youtube_dl
-from youtube_transcript_api import YouTubeTranscriptApi
 from pathlib import Path
 from urllib.parse import parse_qs, urlparse
-from random import randint
+from random import randint, uniform
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cache import link_or_copy
+from metrics import metrics
 
 
 def my_progress(d):
@@ -24,7 +27,122 @@ def my_progress(d):
         print('Done downloading, now converting ...')
 
 
-def download_from_youtube(yt_url, output_path, video_download = False, transcript_download = False): # function for ingesting when given a url
+class RateLimiter:
+    """
+    Jittered rate limit shared by the download workers (generic cell rate algorithm, a token bucket
+    variant): one request every uniform(min_interval, max_interval) seconds, allowing bursts of burst requests.
+    """
+    def __init__(self, min_interval=30, max_interval=60, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.tolerance = (burst - 1) * (min_interval + max_interval) / 2
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tat = 0 # theoretical arrival time of the next request
+
+    def reserve(self):
+        '''
+        Reserve the next request slot, returning the time to wait before the request (without waiting).
+        '''
+        with self.lock:
+            now = self.clock()
+            start = max(now, self.tat - self.tolerance)
+            self.tat = max(self.tat, start) + uniform(self.min_interval, self.max_interval)
+        return start - now
+
+    def acquire(self):
+        '''
+        Block until the next request is allowed, returning the time waited.
+        '''
+        wait = self.reserve()
+        if wait > 0:
+            print('Waiting %.1f seconds ...'%(wait))
+            self.sleep(wait)
+        return wait
+
+
+class DownloadScheduler:
+    """
+    Download youtube links on a small pool of threads, prefetching up to queue_depth links
+    ahead of the consumer, under a shared rate limit. Results are yielded in links order.
+    Downloads recorded in the journal (whose mp3 is still there) or in the cache are not requested again.
+    """
+    def __init__(self, links, output_path, workers=2, queue_depth=2, rate_limiter=None, ydl_class=None, cache=None, journal=None, **download_kwargs):
+        self.links = [link for link in links if link.startswith('https://')]
+        self.output_path = output_path
+        self.cache = cache
+        self.journal = journal
+        self.queue_depth = max(1, queue_depth)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.ydl_class = ydl_class
+        self.download_kwargs = download_kwargs
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def download(self, link):
+        vid = get_video_id(link)
+        if self.journal is not None:
+            # Downloaded by a previous (interrupted) run
+            audio_filepath = self.journal.artifact(vid, 'download')
+            if audio_filepath and exists(audio_filepath):
+                return audio_filepath
+        if self.cache is not None:
+            result, entry = self.cache.get('download', video_id=vid)
+            if result:
+                # Restore the cached mp3, without any youtube request
+                audio_filepath = get_audio_filepath(link, self.output_path)
+                makedirs(dirname(audio_filepath), exist_ok=True)
+                link_or_copy(join(entry, basename(audio_filepath)), audio_filepath)
+                return audio_filepath
+
+        self.rate_limiter.acquire()
+        with metrics.stage('download', vid):
+            audio_filepath = download_from_youtube(link, self.output_path, wait=False, ydl_class=self.ydl_class, **self.download_kwargs)
+        if audio_filepath and self.cache is not None and exists(audio_filepath):
+            self.cache.put('download', {'video_id': vid}, [audio_filepath], video_id=vid)
+        return audio_filepath
+
+    def __iter__(self):
+        pending = deque()
+        links = iter(self.links)
+        for link in links:
+            pending.append((link, self.executor.submit(self.download, link)))
+            if len(pending) >= self.queue_depth:
+                break
+        while pending:
+            link, future = pending.popleft()
+            for next_link in links:
+                pending.append((next_link, self.executor.submit(self.download, next_link)))
+                break
+            yield link, future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_video_id(yt_url):
+    '''
+    Video id (v parameter) of a youtube URL, None if there is none.
+    '''
+    vids = parse_qs(urlparse(yt_url).query, keep_blank_values=True).get('v')
+    return None if vids == None else vids[0].strip()
+
+
+def get_audio_filepath(yt_url, output_path):
+    '''
+    Filepath of the mp3 downloaded by download_from_youtube.
+    '''
+    vid = get_video_id(yt_url)
+    return join(output_path, str(vid), str(vid) + '.mp3')
+
+
+def download_from_youtube(yt_url, output_path, video_download = False, transcript_download = False, wait = True, ydl_class = None): # function for ingesting when given a url
     '''
     Download audio and subtitle from a youtube video given a url.
         Parameters:
@@ -32,14 +150,15 @@ def download_from_youtube(yt_url, output_path, video_download = False, transcrip
         output_path (str): folder to save youtube audio.
         video_download (Boolean): True for downloading video mp4.
         transcript_download (Boolean): True for transcription from youtube.
+        wait (Boolean): random 30-60 sec wait before downloading (False when a RateLimiter is used).
+        ydl_class (class): youtube_dl.YoutubeDL compatible class, youtube_dl.YoutubeDL if None.
 
         Returns:
         String: returns True or False
 
     '''
     # Use vid as the diretory name for download and processing
-    vids = parse_qs(urlparse(yt_url).query, keep_blank_values=True).get('v')
-    vid = None if vids == None else vids[0]
+    vid = get_video_id(yt_url)
 
     video_dir = join(output_path, str(vid).strip())
 
@@ -54,12 +173,17 @@ def download_from_youtube(yt_url, output_path, video_download = False, transcrip
     #if exists(audio.replace('.webm', '.mp3')) and exists(subtitle):
     #    return False
 
+    if ydl_class is None:
+        import youtube_dl
+        ydl_class = youtube_dl.YoutubeDL
+
     # Get information on the YouTube content
     try:
         # Random time do waiting to avoid youtube access blocking
-        t = randint(30,60)
-        print('Waiting %d seconds ...'%(t))
-        time.sleep(t) # Overcome YouTube blocking
+        if wait:
+            t = randint(30,60)
+            print('Waiting %d seconds ...'%(t))
+            time.sleep(t) # Overcome YouTube blocking
 
         if not (exists(video_dir)):
             makedirs(video_dir)
@@ -79,7 +203,7 @@ def download_from_youtube(yt_url, output_path, video_download = False, transcrip
             'progress_hooks': [my_progress],  
         }
         # Download audio stream and convert to mp3
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+        with ydl_class(ydl_opts) as ydl:
             ydl.download([yt_url])
 
 
@@ -95,7 +219,7 @@ def download_from_youtube(yt_url, output_path, video_download = False, transcrip
                 'progress_hooks': [my_progress]
             }
             # Download audio stream and convert to mp3
-            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            with ydl_class(ydl_opts) as ydl:
                 ydl.download([yt_url])
 
         #####################################################################################
@@ -105,6 +229,7 @@ def download_from_youtube(yt_url, output_path, video_download = False, transcrip
             # get video_id from youtube_uri
             video_id = yt_url.replace('https://www.youtube.com/watch?v=','')
             # Download subtitle and write to an .srt file
+            from youtube_transcript_api import YouTubeTranscriptApi
             transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
             '''
             # filter first for manually created transcripts and second for automatically generated ones
@@ -147,6 +272,9 @@ def main():
     parser.add_argument('--input_file', default='links.txt', help="Input txt file.")
     #parser.add_argument('--youtube_url', help="URL of the youtube video.")
     parser.add_argument('--output_dir', default='videos', help='Directory to save downloaded audio and transcript files.')
+    parser.add_argument('--workers', type=int, default=2, help='Number of concurrent downloads.')
+    parser.add_argument('--min_wait', type=float, default=30, help='Minimum interval in seconds between two requests.')
+    parser.add_argument('--max_wait', type=float, default=60, help='Maximum interval in seconds between two requests.')
 
     args = parser.parse_args()
 
@@ -159,10 +287,10 @@ def main():
     else:
         f.close()
 
-    for youtube_link in content_file:
-
-        if youtube_link.startswith('https://'):
-            download_from_youtube(youtube_link, args.output_dir)
+    rate_limiter = RateLimiter(args.min_wait, args.max_wait)
+    with DownloadScheduler(content_file, args.output_dir, args.workers, args.workers, rate_limiter) as downloads:
+        for youtube_link, result in downloads:
+            pass
 
         #else:
         #    print("URL of the video file should start with https://")
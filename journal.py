@@ -0,0 +1,101 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import sqlite3
+import threading
+import time
+from os import makedirs
+from os.path import dirname
+
+# Video level stages, in pipeline order. Chunk level rows use the 'export' stage.
+STAGES = ['download', 'segment', 'export', 'done']
+
+
+class Journal:
+    """
+    Durable per-video and per-chunk state of a pipeline run, in a small SQLite file.
+    Every mark is committed at once, so a crashed run can resume from its last completed step.
+    """
+    def __init__(self, journal_path):
+        if dirname(journal_path):
+            makedirs(dirname(journal_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(journal_path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, link TEXT, status TEXT, updated REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS stages (video_id TEXT, chunk_id TEXT, stage TEXT, artifact TEXT, updated REAL, '
+                        'PRIMARY KEY (video_id, chunk_id, stage))')
+        self.db.commit()
+
+    def set_video(self, video_id, link, status):
+        with self.lock:
+            self.db.execute('INSERT INTO videos VALUES (?, ?, ?, ?) ON CONFLICT(video_id) DO UPDATE SET '
+                            'link=excluded.link, status=excluded.status, updated=excluded.updated',
+                            (video_id, link.strip(), status, time.time()))
+            self.db.commit()
+
+    def mark(self, video_id, stage, chunk_id='', artifact=None):
+        '''
+        Record that stage is completed for a video (or one of its chunks), with its artifact path.
+        '''
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)', (video_id, chunk_id, stage, artifact, time.time()))
+            self.db.commit()
+
+    def done(self, video_id, stage, chunk_id=''):
+        return self.artifact(video_id, stage, chunk_id) is not False
+
+    def artifact(self, video_id, stage, chunk_id=''):
+        '''
+        Artifact path of a completed stage, False if the stage isn't completed.
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT artifact FROM stages WHERE video_id=? AND chunk_id=? AND stage=?',
+                                  (video_id, chunk_id, stage)).fetchone()
+        return False if row is None else row[0]
+
+    def done_chunks(self, video_id, stage='export'):
+        with self.lock:
+            rows = self.db.execute("SELECT chunk_id FROM stages WHERE video_id=? AND stage=? AND chunk_id != ''",
+                                   (video_id, stage)).fetchall()
+        return set(row[0] for row in rows)
+
+    def status(self):
+        '''
+        Summary of the run: number of videos per status, and of diarized chunks.
+        '''
+        with self.lock:
+            videos = dict(self.db.execute('SELECT status, COUNT(*) FROM videos GROUP BY status').fetchall())
+            chunks = self.db.execute("SELECT COUNT(*) FROM stages WHERE stage='export' AND chunk_id != ''").fetchone()[0]
+            partial = self.db.execute("SELECT v.video_id, COUNT(s.chunk_id) FROM videos v JOIN stages s ON v.video_id = s.video_id "
+                                      "WHERE v.status != 'done' AND s.stage = 'export' AND s.chunk_id != '' GROUP BY v.video_id").fetchall()
+        return {'videos': videos, 'chunks': chunks, 'partial': dict(partial)}
+
+    def print_status(self):
+        status = self.status()
+        print('Videos: {}'.format(sum(status['videos'].values())))
+        for video_status, count in sorted(status['videos'].items()):
+            print('  {}: {}'.format(video_status, count))
+        print('Diarized chunks: {}'.format(status['chunks']))
+        for video_id, count in sorted(status['partial'].items()):
+            print('  {} (in progress): {} chunks'.format(video_id, count))
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--journal', default='output/journal.db', help='Journal filepath.')
+    args = parser.parse_args()
+    journal = Journal(args.journal)
+    journal.print_status()
+    journal.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,21 +6,166 @@
 #
 import argparse
 import json
+import os
+import subprocess
+import sys
+import time
 from glob import glob
 from tqdm import tqdm
-from os.path import basename, dirname, join
-from pydub import AudioSegment
-from download import download_from_youtube
-from diarization import execute_diarization
-from audio_segmentation import create_segments_list_from_json, create_audio_files_from_segments_list, build_segments
+import numpy as np
+import soundfile as sf
+from os.path import basename, dirname, exists, join
+from autotune import DEFAULT_DURATIONS, tuned_segment_params
+from cache import ResultCache, STAGES, file_hash
+from download import DownloadScheduler, RateLimiter, get_video_id
+from journal import Journal
+from metadata import YoutubeTranscript, prefetch_metadata
+from metrics import metrics
+from pipeline import execute_staged_pipeline
+from speakers import DEFAULT_EMBEDDING_MODEL, EmbeddingModel, SpeakerLinker
+from shards import ShardWriter
+from timeline import TimelineWriter
+from turn_index import TurnIndex
+from diarization import Diarizer, ParallelDiarizer, WindowedDiarizer, execute_diarization
+from audio_segmentation import create_segments_list_from_json, create_segments_list_from_dict, create_audio_files_from_segments_list, create_audio_files_from_waveform, build_segments, build_segments_streaming, build_chunks, convert_audio, decode_audio, find_segments, load_manifest, write_wav, ManifestWriter, SegmentTable, SEGMENT_PARAMS
+# Config keys the staged pipeline doesn't support, rejected with staged
+STAGED_UNSUPPORTED = ['cache_dir', 'link_speakers', 'turn_index', 'shards', 'timeline', 'autotune', 'windowed', 'streaming', 'write_chunks', 'write_full_wav']
 
 
-def execute_pipeline(youtube_links_filepath, output_dir):
+def audio_duration(audio_filepath):
+    '''
+    Duration in seconds of a wav file, read from its header.
+    '''
+    return sf.info(audio_filepath).duration
+
+
+def diarize_in_memory(audio_filepath, wav, sr, output_filename, diarizer, output_segments_path, batch_size=8, output_wavs_folder=None, cache=None, audio_hash=None, done_chunks=(), on_chunk_done=None, video_id=None, splitter='librosa', linker=None, shards=None, manifest_folder=None, segment_params=None):
+    """
+    Segment and diarize a decoded waveform without the wavs/ and segments.json disk round-trips.
+        Parameters:
+        audio_filepath (str): source audio filepath.
+        wav (numpy.ndarray): decoded float32 waveform, shared by segmentation, diarization and export.
+        sr (int): sample rate of the waveform. The diarization pipeline resamples it to the model rate.
+        output_filename (str): prefix of the chunk ids.
+        diarizer (Diarizer or ParallelDiarizer): loaded diarization pipeline(s).
+        output_segments_path (str): folder to save the diarized audio files.
+        batch_size (int): number of chunks sent per task to the diarize_workers processes.
+        output_wavs_folder (str): if given, chunks are also written to this folder.
+        cache (ResultCache): if given, segmentation and diarization results are looked up there first.
+        audio_hash (str): content hash of audio_filepath, cache key.
+        done_chunks (set): ids of the chunks already exported by a previous run, skipped.
+        on_chunk_done (function): called with the chunk id, its segments table and turn embeddings (or None) once a chunk is exported.
+        video_id (str): id of the video in the metrics records.
+        splitter (str): silence detection of the segmentation, 'librosa' or 'numpy'.
+        linker (SpeakerLinker): if given, the chunk speaker labels are replaced by global speaker ids.
+        shards (ShardWriter): if given, the diarized audio files are appended to its shards instead of output_segments_path.
+        manifest_folder (str): if given, the chunk boundaries are written there (segments.csv), even if the chunks are not.
+        segment_params (dict): segmentation parameters, SEGMENT_PARAMS if None.
+
+        Returns:
+        List: diarized audio filenames (of the chunks not done before), or False if a chunk failed.
+    """
+    params = dict(segment_params or SEGMENT_PARAMS, sample_rate=sr)
+    segments = None
+    if cache is not None:
+        result, _ = cache.get('segment', audio_hash=audio_hash, **params)
+        if result:
+            segments = SegmentTable(result['begin'], result['end'])
+    if segments is None:
+        with metrics.stage('segment', video_id):
+            segments = find_segments(audio_filepath, wav, sr, params['min_duration'], params['max_duration'], params['max_gap_duration'], params['threshold'], splitter=splitter)
+        if cache is not None:
+            cache.put('segment', {'begin': segments.begin.tolist(), 'end': segments.end.tolist()}, audio_hash=audio_hash, **params)
+    chunks = build_chunks(audio_filepath, wav, sr, output_filename, output_folder=output_wavs_folder, segments=segments)
+    if manifest_folder:
+        os.makedirs(manifest_folder, exist_ok=True)
+        manifest = ManifestWriter(manifest_folder)
+        manifest.add(segments.ids(output_filename), audio_filepath, segments.begin, segments.end)
+        manifest.finalize()
+    if done_chunks:
+        # Resume from the chunks not exported yet, the diarization cache holds whole videos only
+        chunks = [(chunk_id, chunk) for chunk_id, chunk in chunks if chunk_id not in done_chunks]
+        cache = None
+
+    diarization = None
+    if cache is not None:
+        diarization, _ = cache.get('diarize', audio_hash=audio_hash, model=diarizer.model_name, **params)
+    if diarization is None:
+        with metrics.stage('diarize', video_id, audio_seconds=sum(len(chunk) for _, chunk in chunks) / sr):
+            diarization = [data for _, _, data in tqdm(diarizer.diarize_batch(chunks, sr, batch_size), total=len(chunks))]
+        if cache is not None and all(diarization):
+            cache.put('diarize', diarization, audio_hash=audio_hash, model=diarizer.model_name, **params)
+    else:
+        # Entries are keyed by content, they may come from another video with the same audio (ex. a re-upload)
+        for (chunk_id, _), data in zip(chunks, diarization):
+            data['uri'] = chunk_id
+
+    files = []
+    failed = False
+    for (chunk_id, chunk), data in zip(chunks, diarization):
+        if not data:
+            failed = True
+            continue
+        segments_list = create_segments_list_from_dict(data)
+        embeddings = None
+        if linker is not None:
+            with metrics.stage('link', video_id, chunk_id, len(chunk) / sr):
+                embeddings = linker.link(chunk, sr, segments_list)
+        with metrics.stage('export', video_id, chunk_id, len(chunk) / sr):
+            exported = create_audio_files_from_waveform(chunk, sr, segments_list, output_segments_path, shards)
+        if not exported:
+            print("Error: Unable to create audio segments list.")
+            failed = True
+            continue
+        files.extend(segments_list.filename(i) for i in range(len(segments_list)))
+        if on_chunk_done is not None:
+            on_chunk_done(chunk_id, segments_list, embeddings)
+    return False if failed else files
+
+
+def execute_pipeline(youtube_links_filepath, output_dir, in_memory=False, batch_size=8, write_chunks=False, write_full_wav=False, sample_rate=22050, streaming=False, block_duration=60.0,
+                     download_workers=2, download_queue_depth=2, min_wait=30, max_wait=60, diarize_workers=1, torch_threads=1, cache=None, journal=None, splitter='librosa',
+                     embedding_model=None, speaker_index=None, speaker_threshold=0.5, turn_index=None, windowed=False, window_duration=60.0, window_step=50.0, shards=None,
+                     metadata_file=None, metadata_concurrency=8, metadata_min_wait=0.5, metadata_max_wait=1.5, transcript_languages=None,
+                     timeline=False, timeline_max_gap=0.5, autotune=False, autotune_durations=DEFAULT_DURATIONS, calibration_file=None, autotune_file=None, recalibrate=False):
     """
     Execute diarization pipeline. (1) Download mp3 audio from youtube;, (2) Convert mp3 to wav; (3) Audio diarization; (4) Audio segmentation.
         Parameters:
         youtube_links_filepath (str): filepath of source file with youtube links list.
         output_dir (str): output folder.
+        in_memory (bool): diarize the chunks as in-memory waveforms instead of wav/json files.
+        batch_size (int): number of chunks sent per task to the diarize_workers processes (in_memory and windowed modes).
+        write_chunks (bool): also write the chunks to wavs/ (in_memory mode).
+        write_full_wav (bool): write the full-length wav in in_memory mode (always written otherwise).
+        sample_rate (int): sample rate of the decoded audio.
+        streaming (bool): convert and segment the audio in bounded memory, block by block (not with in_memory).
+        block_duration (float): duration in seconds of the blocks read in streaming mode.
+        download_workers (int): number of concurrent downloads.
+        download_queue_depth (int): number of links downloaded ahead of the processing.
+        min_wait, max_wait (float): jittered interval in seconds between two youtube requests.
+        diarize_workers (int): number of diarization processes, chunks are diarized in the main process if 1.
+        torch_threads (int): torch intra-op threads of each diarization process.
+        cache (ResultCache): if given, stages look up their results there before doing any work.
+        journal (Journal): if given, finished videos and chunks are recorded there and skipped on the next runs.
+        splitter (str): silence detection of the segmentation: 'librosa', or 'numpy' (same boundaries, without importing librosa).
+        embedding_model (EmbeddingModel): if given, the speakers of the chunks are linked, and named by global ids in the output files.
+        speaker_index (str): speaker index file shared by all the videos (ex. of a same channel), one per video folder if None.
+        speaker_threshold (float): minimum cosine similarity of a chunk speaker to a known speaker.
+        turn_index (TurnIndex): if given, every exported turn is recorded there, with its embedding when speakers are linked.
+        windowed (bool): diarize the whole wav in one pass of overlapping windows instead of segmenting it into chunks (not with in_memory).
+        window_duration, window_step (float): duration and step in seconds of the windowed diarization windows.
+        shards (ShardWriter): if given, the diarized audio files are appended to its shards instead of the result/ folders.
+        metadata_file (str): if given, the info (and transcripts) of all the links are fetched there first, and unavailable or duplicate videos are dropped.
+        metadata_concurrency (int): number of videos whose metadata is fetched at a time.
+        metadata_min_wait, metadata_max_wait (float): jittered interval in seconds between two metadata requests.
+        transcript_languages (list): languages of the manually created transcripts fetched with the metadata, none if None.
+        timeline (bool): write the absolute timeline of every video (timeline.csv and <video_id>.rttm in its folder).
+        timeline_max_gap (float): maximum silence in seconds between two turns of a speaker merged in the timeline.
+        autotune (bool): time the diarization of chunks of autotune_durations seconds at startup, and segment the videos
+            into the chunk durations with the best throughput on this machine.
+        calibration_file (str): sound file timed by autotune, the start of the first downloaded video if None.
+        autotune_file (str): if given, the autotune parameters are saved there, and reused by the next runs with the same calibration setup.
+        recalibrate (bool): calibrate again even if autotune_file holds parameters.
 
         Returns:
         Boolean: returns True or False
@@ -35,86 +180,629 @@ def execute_pipeline(youtube_links_filepath, output_dir):
     else:
         f.close()
 
-    for youtube_link in youtube_links_list:
-        #
-        # (1) Download audio from youtube
-        #
-        if youtube_link.startswith('https://'):
-            print('STEP (1/4): Downloading from youtube: {}...'.format(youtube_link))
-            mp3_audio_filepath = download_from_youtube(youtube_link, output_dir)
+    # Load the diarization pipeline only once (per worker), reusing it for every chunk and video
+    if diarize_workers > 1:
+        diarizer = ParallelDiarizer(diarize_workers, torch_threads)
+    else:
+        diarizer = Diarizer()
+    diarizer.warm_up()
+
+    segment_params = dict(SEGMENT_PARAMS)
+
+    def calibrate(sample=None):
+        tuned = None
+        if autotune and not windowed:
+            tuned = tuned_segment_params(diarizer, autotune_file, autotune_durations, calibration_file, sample_rate, recalibrate, sample)
+        if tuned is not None:
+            segment_params.update(min_duration=tuned['min_duration'], max_duration=tuned['max_duration'])
+        # Run metadata, next to the stage metrics
+        metrics.write({'run': youtube_links_filepath, 'time': time.time(), 'segment_params': segment_params, 'sample_rate': sample_rate,
+                       'model': diarizer.model_name, 'autotune': tuned})
+
+    # Without a calibration file, the chunk duration is calibrated on the first downloaded video
+    calibrating = autotune and not windowed and not calibration_file
+    if not calibrating:
+        calibrate()
+
+    if journal is not None:
+        youtube_links_list = [link for link in youtube_links_list
+                              if not (link.startswith('https://') and journal.done(get_video_id(link), 'done'))]
+
+    # Light requests for all the links before any download
+    youtube_links_list = prefetch_links(youtube_links_list, metadata_file, metadata_concurrency, metadata_min_wait, metadata_max_wait, transcript_languages)
+
+    # Downloads run ahead of the processing, under a shared rate limit
+    rate_limiter = RateLimiter(min_wait, max_wait)
+    with DownloadScheduler(youtube_links_list, output_dir, download_workers, download_queue_depth, rate_limiter, cache=cache, journal=journal) as downloads:
+        for youtube_link, mp3_audio_filepath in downloads:
+            if calibrating and mp3_audio_filepath:
+                calibrating = False
+                calibrate(lambda duration: decode_audio(mp3_audio_filepath, sample_rate, duration))
+            r = process_video(youtube_link, mp3_audio_filepath, diarizer, in_memory, batch_size, write_chunks, write_full_wav, sample_rate, streaming, block_duration, cache, journal, splitter,
+                              embedding_model, speaker_index, speaker_threshold, turn_index, windowed, window_duration, window_step, shards, timeline, timeline_max_gap,
+                              segment_params)
+            if youtube_link.startswith('https://'):
+                metrics.end_video(get_video_id(youtube_link))
+            if not r:
+                return False
+
+    return True
+
+
+def process_video(youtube_link, mp3_audio_filepath, diarizer, in_memory, batch_size, write_chunks, write_full_wav, sample_rate, streaming, block_duration, cache=None, journal=None, splitter='librosa',
+                  embedding_model=None, speaker_index=None, speaker_threshold=0.5, turn_index=None, windowed=False, window_duration=60.0, window_step=50.0, shards=None,
+                  timeline=False, timeline_max_gap=0.5, segment_params=None):
+    """
+    Steps (2) to (5) of the pipeline for one downloaded video.
+    segment_params are the segmentation parameters of the run (SEGMENT_PARAMS if None).
+
+        Returns:
+        Boolean: returns False when the whole run must stop.
+    """
+    #
+    # (1) Audio downloaded from youtube by the DownloadScheduler
+    #
+    print('STEP (1/4): Downloaded from youtube: {}...'.format(youtube_link))
+    video_id = get_video_id(youtube_link)
+    if not mp3_audio_filepath:
+        print("Error: Unable to download mp3 from youtube.")
+        if journal is not None:
+            # Recorded, and the run goes on with the next video
+            journal.set_video(video_id, youtube_link, 'failed')
+            return True
+        return False
+    if journal is not None:
+        journal.set_video(video_id, youtube_link, 'running')
+        journal.mark(video_id, 'download', artifact=mp3_audio_filepath)
+    done_chunks = journal.done_chunks(video_id) if journal is not None else set()
+    segment_params = dict(segment_params or SEGMENT_PARAMS)
+    if journal is not None:
+        recorded = journal.artifact(video_id, 'segment_params')
+        if done_chunks and recorded:
+            # Chunk ids are positions in the segmentation of the first run, whatever the current parameters
+            segment_params = json.loads(recorded)
         else:
-            continue
+            journal.mark(video_id, 'segment_params', artifact=json.dumps(segment_params))
 
-        if not mp3_audio_filepath:
-            print("Error: Unable to download mp3 from youtube.")
-            return False
-        #
-        # (2) Converting mp3 to wav
-        #
+    def chunk_done(chunk_id, segments_list, embeddings=None):
+        output_folder = shards.folder if shards is not None else output_segments_path
+        if timeline_writer is not None:
+            timeline_writer.add(chunk_id, segments_list)
+        if turn_index is not None:
+            turn_index.add(video_id, chunk_id, segments_list, output_folder, embeddings)
+        if journal is not None:
+            journal.mark(video_id, 'export', chunk_id, output_folder)
+
+    def exported(filename):
+        return filename in shards if shards is not None else exists(join(output_segments_path, filename))
+
+    def video_done(manifest=None):
+        if timeline_writer is not None and manifest is not None:
+            # Chunk labels are global with linked speakers or a windowed diarization
+            timeline_writer.finish(manifest, sample_rate, video_id, linker is None and not windowed, timeline_max_gap)
+        if journal is not None:
+            journal.mark(video_id, 'done')
+            journal.set_video(video_id, youtube_link, 'done')
+
+    input_folder = dirname(mp3_audio_filepath)
+    output_segments_path = join(input_folder, 'result')
+    linker = None
+    if embedding_model is not None:
+        linker = SpeakerLinker(embedding_model, speaker_index or join(input_folder, 'speakers.npz'), speaker_threshold)
+    audio_hash = None
+    timeline_writer = None
+    if cache is not None:
+        # Skip the whole video if its diarized files were already exported with the same parameters
+        audio_hash = file_hash(mp3_audio_filepath)
+        export_key = dict(segment_params, video_id=video_id, audio_hash=audio_hash, sample_rate=sample_rate, model=diarizer.model_name)
+        if linker is not None:
+            export_key.update(speakers=linker.model_name, speaker_index=speaker_index)
+        if windowed and not in_memory:
+            export_key.update(windowed=[window_duration, window_step])
+        result, _ = cache.get('export', **export_key)
+        if result and all(exported(f) for f in result['files']):
+            print('Already processed (cache): {}'.format(mp3_audio_filepath))
+            video_done()
+            return True
+    output_wavs_folder = join(input_folder, 'wavs')
+    output_filename = basename(mp3_audio_filepath).split('.')[0]
+    timeline_writer = TimelineWriter(input_folder, resume=bool(done_chunks)) if timeline else None
+    # Chunks of a partially diarized video are still on disk
+    resume = journal is not None and not in_memory and not windowed and journal.done(video_id, 'segment') and exists(output_wavs_folder)
+    #
+    # (2) Decoding mp3 once, at the target sample rate
+    #
+    if resume:
+        print('Resuming {} from its remaining chunks ({} done)'.format(video_id, len(done_chunks)))
+    else:
         try:
-            print('STEP (2/4): Converting to wav...')
-            sound = AudioSegment.from_mp3(mp3_audio_filepath)
+            print('STEP (2/4): Decoding audio...')
             wav_audio_filepath = mp3_audio_filepath.replace('.mp3', '.wav')
-            sound.export(wav_audio_filepath, format="wav")
+            with metrics.stage('decode', video_id) as record:
+                if streaming and not in_memory:
+                    convert_audio(mp3_audio_filepath, wav_audio_filepath, sample_rate)
+                    wav = None
+                    record['audio_seconds'] = audio_duration(wav_audio_filepath)
+                else:
+                    wav = decode_audio(mp3_audio_filepath, sample_rate)
+                    record['audio_seconds'] = len(wav) / sample_rate
+                    if write_full_wav or not in_memory:
+                        write_wav(wav_audio_filepath, wav, sample_rate)
+            metrics.set_audio_seconds(video_id, record['audio_seconds'])
         except:
-            print("Error: Unable to convert mp3 to wav.")
-            continue
-        #
-        # (3) Segment audio files to fit at GPU memory
-        #
-        print('STEP (3/4): Segmenting audio files...')
-        input_folder = dirname(mp3_audio_filepath)
-        output_wavs_folder = join(input_folder, 'wavs')
-        output_filename = basename(mp3_audio_filepath).split('.')[0]
-
-        build_segments(input_folder, output_wavs_folder, output_filename, min_duration=20, max_duration=30, threshold=28.0, max_gap_duration=1.0, sample_rate=22050)
-        #
-        # (4) Audio diarization
-        #
-        print('STEP (4/4): Performing diarization...')
-        for wav_audio_filepath in tqdm(glob(output_wavs_folder + '/*.wav')):
+            print("Error: Unable to decode mp3.")
+            if journal is not None:
+                journal.set_video(video_id, youtube_link, 'failed')
+            return True
 
-            json_path = execute_diarization(wav_audio_filepath)
+    if in_memory:
+        print('STEP (3-4/4): Segmenting and performing in-memory diarization...')
+        files = diarize_in_memory(mp3_audio_filepath, wav, sample_rate, output_filename, diarizer, output_segments_path, batch_size,
+                                  output_wavs_folder if write_chunks else None, cache, audio_hash, done_chunks, chunk_done, video_id, splitter, linker, shards,
+                                  output_wavs_folder if timeline else None, segment_params)
+        if files is not False:
+            if cache is not None and not done_chunks:
+                cache.put('export', {'files': files}, **export_key)
+            video_done(load_manifest(output_wavs_folder) if timeline else None)
+        return True
 
-            if not json_path:
+    if windowed:
+        del wav
+        print('STEP (3-4/4): Performing windowed diarization...')
+        duration = audio_duration(wav_audio_filepath)
+        with metrics.stage('diarize', video_id, audio_seconds=duration):
+            windowed_diarizer = WindowedDiarizer(diarizer, window_duration, window_step, batch_size, linker)
+            data = windowed_diarizer(wav_audio_filepath, output_filename)
+        if not data:
+            print("Error: Unable to execute windowed diarization.")
+            if journal is not None:
+                journal.set_video(video_id, youtube_link, 'failed')
+            return True
+        segments_list = create_segments_list_from_dict(data)
+        with metrics.stage('export', video_id, output_filename, duration):
+            r = create_audio_files_from_segments_list(wav_audio_filepath, basename(wav_audio_filepath), segments_list, output_segments_path, shards)
+        if not r:
+            print("Error: Unable to create audio segments list.")
+            if journal is not None:
+                journal.set_video(video_id, youtube_link, 'failed')
+            return True
+        files = [segments_list.filename(i) for i in range(len(segments_list))]
+        chunk_done(output_filename, segments_list, windowed_diarizer.embeddings)
+        if cache is not None:
+            cache.put('export', {'files': files}, **export_key)
+        video_done({'id': np.array([output_filename]), 'begin': np.array([0])})
+        return True
+    #
+    # (3) Segment audio files to fit at GPU memory
+    #
+    if not resume:
+        del wav
+        print('STEP (3/4): Segmenting audio files...')
+        with metrics.stage('segment', video_id):
+            if streaming:
+                build_segments_streaming(wav_audio_filepath, output_wavs_folder, output_filename, block_duration=block_duration, **segment_params)
+            else:
+                build_segments(input_folder, output_wavs_folder, output_filename, sample_rate=sample_rate, splitter=splitter, **segment_params)
+        if journal is not None:
+            journal.mark(video_id, 'segment', artifact=output_wavs_folder)
+    #
+    # (4) Audio diarization
+    #
+    print('STEP (4/4): Performing diarization...')
+    files = []
+    failed = False
+    wav_audio_filepaths = [wav_audio_filepath for wav_audio_filepath in sorted(glob(output_wavs_folder + '/*.wav'))
+                           if basename(wav_audio_filepath).split('.')[0] not in done_chunks]
+    durations = [audio_duration(wav_audio_filepath) for wav_audio_filepath in wav_audio_filepaths]
+    if isinstance(diarizer, ParallelDiarizer):
+        with metrics.stage('diarize', video_id, audio_seconds=sum(durations)):
+            diarization = diarizer.map(wav_audio_filepaths)
+        for wav_audio_filepath, duration, data in zip(wav_audio_filepaths, durations, diarization):
+            if not data:
+                failed = True
                 continue
-            #
-            # (5) Audio segmentation folowing the diarization results
-            #
-            segments_list = create_segments_list_from_json(json_path)
-            filename_base = basename(wav_audio_filepath)
-
-            output_segments_path = join(dirname(mp3_audio_filepath), 'result')
-            r = create_audio_files_from_segments_list(wav_audio_filepath, filename_base, segments_list, output_segments_path)
+            segments_list = create_segments_list_from_dict(data)
+            embeddings = None
+            if linker is not None:
+                with metrics.stage('link', video_id, basename(wav_audio_filepath).split('.')[0], duration):
+                    embeddings = linker.link_file(wav_audio_filepath, segments_list)
+            with metrics.stage('export', video_id, basename(wav_audio_filepath).split('.')[0], duration):
+                r = create_audio_files_from_segments_list(wav_audio_filepath, basename(wav_audio_filepath), segments_list, output_segments_path, shards)
             if not r:
                 print("Error: Unable to create audio segments list.")
+                failed = True
                 continue
+            files.extend(segments_list.filename(i) for i in range(len(segments_list)))
+            chunk_done(basename(wav_audio_filepath).split('.')[0], segments_list, embeddings)
+        if not failed:
+            if cache is not None and not done_chunks:
+                cache.put('export', {'files': files}, **export_key)
+            video_done(load_manifest(output_wavs_folder) if timeline else None)
+        return True
+
+    for wav_audio_filepath, duration in tqdm(zip(wav_audio_filepaths, durations), total=len(wav_audio_filepaths)):
+        chunk_id = basename(wav_audio_filepath).split('.')[0]
 
+        with metrics.stage('diarize', video_id, chunk_id, duration):
+            json_path = execute_diarization(wav_audio_filepath, diarizer, wav_audio_filepath.replace('.wav', '.json'))
+
+        if not json_path:
+            failed = True
+            continue
+        #
+        # (5) Audio segmentation folowing the diarization results
+        #
+        segments_list = create_segments_list_from_json(json_path)
+        filename_base = basename(wav_audio_filepath)
+        embeddings = None
+        if linker is not None:
+            with metrics.stage('link', video_id, chunk_id, duration):
+                embeddings = linker.link_file(wav_audio_filepath, segments_list)
+
+        with metrics.stage('export', video_id, chunk_id, duration):
+            r = create_audio_files_from_segments_list(wav_audio_filepath, filename_base, segments_list, output_segments_path, shards)
+        if not r:
+            print("Error: Unable to create audio segments list.")
+            failed = True
+            continue
+        files.extend(segments_list.filename(i) for i in range(len(segments_list)))
+        chunk_done(chunk_id, segments_list, embeddings)
+
+    if not failed:
+        if cache is not None and not done_chunks:
+            cache.put('export', {'files': files}, **export_key)
+        video_done(load_manifest(output_wavs_folder) if timeline else None)
     return True
-        
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-c', '--config', default='config.json', help="Json config file.")
-    parser.add_argument('--output_dir', default='output', help='Directory to save downloaded audio and transcript files.')
 
-    args = parser.parse_args()
+def read_config(config_filepath):
     try:
-        with open(args.config, "r") as jsonfile:
+        with open(config_filepath, "r") as jsonfile:
             args_data = json.load(jsonfile)
-            print("Read {} successful".format(args.config))
+            print("Read {} successful".format(config_filepath))
 
     except IOError:
-      print("Error: File {} does not appear to exist.".format(args.config))
-      return False
+      print("Error: File {} does not appear to exist.".format(config_filepath))
+      return None
     else:
         jsonfile.close()
+    return args_data
+
+
+def open_cache(args_data, force=()):
+    if args_data.get('cache_dir'):
+        return ResultCache(args_data['cache_dir'], int(args_data.get('cache_max_size_gb', 50) * 2**30), force)
+    return None
+
+
+def open_diarizer(args_data):
+    if args_data.get('diarize_workers', 1) > 1:
+        diarizer = ParallelDiarizer(args_data['diarize_workers'], args_data.get('torch_threads', 1))
+    else:
+        diarizer = Diarizer()
+    diarizer.warm_up()
+    return diarizer
+
+
+def open_embedding_model(args_data):
+    if args_data.get('link_speakers', False):
+        return EmbeddingModel(args_data.get('embedding_model', DEFAULT_EMBEDDING_MODEL))
+    return None
 
+
+def open_shards(args_data):
+    if args_data.get('shards'):
+        return ShardWriter(args_data['shards'], int(args_data.get('shard_max_size_mb', 1024) * 2**20))
+    return None
+
+
+def run_command(args, args_data):
+    """
+    (run) Full pipeline, steps (1) to (5), for every link of the youtube list.
+    """
     output_dir = args_data['videos_folder']
     youtube_links_filepath = args_data['youtube_list']
+    journal = Journal(args_data['journal']) if args_data.get('journal') else None
+    if args.status:
+        if journal is None:
+            print("Error: No journal set in {}.".format(args.config))
+            return False
+        journal.print_status()
+        return True
 
-    r = execute_pipeline(youtube_links_filepath, output_dir)
+    in_memory = args_data.get('in_memory', False)
+    # batch_size is the former name of chunks_per_task
+    batch_size = args_data.get('chunks_per_task', args_data.get('batch_size', 8))
+    write_chunks = args_data.get('write_chunks', False)
+    write_full_wav = args_data.get('write_full_wav', False)
+    streaming = args_data.get('streaming', False)
+    block_duration = args_data.get('block_duration', 60.0)
+    download_workers = args_data.get('download_workers', 2)
+    download_queue_depth = args_data.get('download_queue_depth', 2)
+    min_wait = args_data.get('min_wait', 30)
+    max_wait = args_data.get('max_wait', 60)
+    diarize_workers = args_data.get('diarize_workers', 1)
+    torch_threads = args_data.get('torch_threads', 1)
+    splitter = args_data.get('splitter', 'librosa')
+
+    if args_data.get('staged', False):
+        unsupported = [key for key in STAGED_UNSUPPORTED if args_data.get(key)]
+        if unsupported:
+            print("Error: {} not supported in staged mode, set to null or false in {}.".format(', '.join(unsupported), args.config))
+            return False
+        with open(youtube_links_filepath) as f:
+            youtube_links = f.readlines()
+        youtube_links = prefetch_links(youtube_links, **metadata_params(args_data))
+        pipeline = execute_staged_pipeline(youtube_links, output_dir, args_data.get('stage_workers'), args_data.get('stage_queue_size', 2),
+                                           args_data.get('sample_rate', 22050), min_wait, max_wait, segment_params=SEGMENT_PARAMS,
+                                           splitter=splitter, journal=journal)
+        return pipeline.errors == 0
+
+    cache = open_cache(args_data, args.force)
+    embedding_model = open_embedding_model(args_data)
+    shards = open_shards(args_data)
+    try:
+        return execute_pipeline(youtube_links_filepath, output_dir, in_memory, batch_size, write_chunks, write_full_wav,
+                                streaming=streaming, block_duration=block_duration, download_workers=download_workers,
+                                download_queue_depth=download_queue_depth, min_wait=min_wait, max_wait=max_wait,
+                                diarize_workers=diarize_workers, torch_threads=torch_threads, cache=cache, journal=journal, splitter=splitter,
+                                embedding_model=embedding_model, speaker_index=args_data.get('speaker_index'), speaker_threshold=args_data.get('speaker_threshold', 0.5),
+                                turn_index=TurnIndex(args_data['turn_index']) if args_data.get('turn_index') else None,
+                                windowed=args_data.get('windowed', False), window_duration=args_data.get('window_duration', 60.0),
+                                window_step=args_data.get('window_step', 50.0), shards=shards, **metadata_params(args_data),
+                                timeline=args_data.get('timeline', False), timeline_max_gap=args_data.get('timeline_max_gap', 0.5),
+                                autotune=args_data.get('autotune', False), autotune_durations=args_data.get('autotune_durations', DEFAULT_DURATIONS),
+                                calibration_file=args_data.get('calibration_file'), autotune_file=args_data.get('autotune_file'),
+                                recalibrate=args.recalibrate)
+    finally:
+        if shards is not None:
+            shards.close()
+
+
+def prefetch_links(links, metadata_file=None, metadata_concurrency=8, metadata_min_wait=0.5, metadata_max_wait=1.5, transcript_languages=None):
+    '''
+    Links of the available videos after the metadata pre-pass, all the links if there is no metadata_file.
+    '''
+    if not metadata_file:
+        return links
+    return prefetch_metadata(links, metadata_file, transcript_client=YoutubeTranscript(transcript_languages) if transcript_languages else None,
+                             rate_limiter=RateLimiter(metadata_min_wait, metadata_max_wait), concurrency=metadata_concurrency)
+
+
+def metadata_params(args_data):
+    return {'metadata_file': args_data.get('metadata_file'), 'metadata_concurrency': args_data.get('metadata_concurrency', 8),
+            'metadata_min_wait': args_data.get('metadata_min_wait', 0.5), 'metadata_max_wait': args_data.get('metadata_max_wait', 1.5),
+            'transcript_languages': args_data.get('transcript_languages')}
+
+
+def metadata_command(args, args_data):
+    """
+    (metadata) Metadata pre-pass only: fetch the info and transcripts of the youtube links into the metadata file.
+    """
+    params = metadata_params(args_data)
+    if not params['metadata_file']:
+        print("Error: No metadata_file set in {}.".format(args.config))
+        return False
+    links = args.links
+    if not links:
+        with open(args_data['youtube_list']) as f:
+            links = f.readlines()
+    prefetch_links(links, **params)
+    return True
+
+
+def download_command(args, args_data):
+    """
+    (download) Step (1) only: download the mp3 audio of the youtube links.
+    """
+    links = args.links
+    if not links:
+        with open(args_data['youtube_list']) as f:
+            links = [link for link in f.readlines() if link.startswith('https://')]
+    rate_limiter = RateLimiter(args_data.get('min_wait', 30), args_data.get('max_wait', 60))
+    failed = False
+    with DownloadScheduler(links, args_data['videos_folder'], args_data.get('download_workers', 2), args_data.get('download_queue_depth', 2),
+                           rate_limiter, cache=open_cache(args_data, args.force)) as downloads:
+        for link, mp3_audio_filepath in downloads:
+            print('{} -> {}'.format(link.strip(), mp3_audio_filepath or 'Error: Unable to download mp3 from youtube.'))
+            failed = failed or not mp3_audio_filepath
+    return not failed
+
+
+def segment_command(args, args_data):
+    """
+    (segment) Steps (2) and (3): decode downloaded mp3 files, then split them into chunks in their wavs/ folder.
+    """
+    sample_rate = args_data.get('sample_rate', 22050)
+    splitter = args_data.get('splitter', 'librosa')
+    for audio_filepath in args.input:
+        input_folder = dirname(audio_filepath)
+        video_id = basename(audio_filepath).split('.')[0]
+        wav_audio_filepath = audio_filepath.replace('.mp3', '.wav')
+        if audio_filepath.endswith('.mp3'):
+            with metrics.stage('decode', video_id):
+                convert_audio(audio_filepath, wav_audio_filepath, sample_rate)
+        metrics.set_audio_seconds(video_id, audio_duration(wav_audio_filepath))
+        with metrics.stage('segment', video_id):
+            if args_data.get('streaming', False):
+                build_segments_streaming(wav_audio_filepath, join(input_folder, 'wavs'), video_id, block_duration=args_data.get('block_duration', 60.0), **SEGMENT_PARAMS)
+            else:
+                build_segments(input_folder, join(input_folder, 'wavs'), video_id, sample_rate=sample_rate, splitter=splitter, **SEGMENT_PARAMS)
+        metrics.end_video(video_id)
+    return True
+
+
+def diarize_command(args, args_data):
+    """
+    (diarize) Step (4): diarize the chunks of wavs/ folders, saving a <chunk>.json file next to every chunk.
+    """
+    diarizer = open_diarizer(args_data)
+    failed = False
+    for folder in args.input:
+        wav_audio_filepaths = [wav_audio_filepath for wav_audio_filepath in sorted(glob(join(folder, '*.wav')))
+                               if args.overwrite or not exists(wav_audio_filepath.replace('.wav', '.json'))]
+        if isinstance(diarizer, ParallelDiarizer):
+            results = diarizer.map(wav_audio_filepaths)
+        else:
+            # Every result is written to the json of its chunk
+            results = [execute_diarization(wav_audio_filepath, diarizer, wav_audio_filepath.replace('.wav', '.json'))
+                       for wav_audio_filepath in tqdm(wav_audio_filepaths)]
+        for wav_audio_filepath, result in zip(wav_audio_filepaths, results):
+            if not result:
+                failed = True
+            elif isinstance(result, dict):
+                with open(wav_audio_filepath.replace('.wav', '.json'), 'w') as f:
+                    json.dump(result, f)
+    if isinstance(diarizer, ParallelDiarizer):
+        diarizer.close()
+    return not failed
 
-if __name__ == '__main__':
-    main()
 
+def export_command(args, args_data):
+    """
+    (export) Step (5): cut the diarized turns of the chunks of video folders into their result/ folder.
+    """
+    failed = False
+    embedding_model = open_embedding_model(args_data)
+    turn_index = TurnIndex(args_data['turn_index']) if args_data.get('turn_index') else None
+    shards = open_shards(args_data)
+    for folder in args.input:
+        output_segments_path = join(folder, 'result')
+        linker = None
+        if embedding_model is not None:
+            linker = SpeakerLinker(embedding_model, args_data.get('speaker_index') or join(folder, 'speakers.npz'), args_data.get('speaker_threshold', 0.5))
+        timeline_writer = TimelineWriter(folder) if args_data.get('timeline', False) else None
+        # Results of the chunks only (not a segments.json left by older runs)
+        json_paths = [json_path for json_path in sorted(glob(join(folder, 'wavs', '*.json'))) if exists(json_path.replace('.json', '.wav'))]
+        for json_path in json_paths:
+            wav_audio_filepath = json_path.replace('.json', '.wav')
+            segments_list = create_segments_list_from_json(json_path)
+            embeddings = linker.link_file(wav_audio_filepath, segments_list) if linker is not None else None
+            if not create_audio_files_from_segments_list(wav_audio_filepath, basename(wav_audio_filepath), segments_list, output_segments_path, shards):
+                print("Error: Unable to create audio segments list.")
+                failed = True
+                continue
+            if turn_index is not None:
+                turn_index.add(basename(folder.rstrip('/')), basename(wav_audio_filepath).split('.')[0], segments_list,
+                               shards.folder if shards is not None else output_segments_path, embeddings)
+            if timeline_writer is not None:
+                timeline_writer.add(basename(wav_audio_filepath).split('.')[0], segments_list)
+        if timeline_writer is not None:
+            timeline_writer.finish(load_manifest(join(folder, 'wavs')), args_data.get('sample_rate', 22050), basename(folder.rstrip('/')),
+                                   linker is None, args_data.get('timeline_max_gap', 0.5))
+    if shards is not None:
+        shards.close()
+    return not failed
+
+
+# Heavy dependencies loaded by each subcommand, imported lazily by the stages that need them
+IMPORT_STACKS = {
+    'metadata': ['youtube_dl', 'youtube_transcript_api'],
+    'download': ['youtube_dl', 'youtube_transcript_api'],
+    'segment': ['numpy', 'soundfile', 'scipy.io.wavfile', 'librosa.effects'],
+    'diarize': ['torch', 'pyannote.audio'],
+    'export': ['pydub', 'pyannote.audio'],
+}
+
+
+def import_time(statement='pass', skip=()):
+    """
+    Run an import statement in a fresh interpreter with -X importtime.
+        Parameters:
+        statement (str): python statement, ex. 'import librosa.effects'.
+        skip (set): packages not counted, ex. those imported by the interpreter startup.
+
+        Returns:
+        Tuple: import time in seconds and list of (self time in seconds, package) pairs, slowest first, or None if the statement fails.
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], stderr=subprocess.PIPE, universal_newlines=True)
+    if p.returncode != 0:
+        return None
+    total = 0
+    packages = []
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if name.strip() in skip:
+            continue
+        packages.append((int(self_us) / 1e6, name.strip()))
+        if not name.startswith('  '):
+            # Top-level import, its cumulative time includes the nested ones
+            total += int(cumulative_us) / 1e6
+    packages.sort(reverse=True)
+    return total, packages
+
+
+def imports_command(args, args_data):
+    """
+    (imports) Report the import time of the CLI itself and of the heavy dependencies of every subcommand.
+    """
+    startup = set(package for _, package in import_time()[1])
+    stacks = [('cli', ['main'])] + [(command, IMPORT_STACKS[command]) for command in args.commands]
+    for command, modules in stacks:
+        for module in modules:
+            r = import_time('import %s' % module, startup)
+            if r is None:
+                print('%-10s %-40s not installed' % (command, module))
+                continue
+            total, packages = r
+            print('%-10s %-40s %8.3f s' % (command, module, total))
+            for self_time, package in packages[:args.top]:
+                print('%-10s   %-38s %8.3f s (self)' % ('', package, self_time))
+    return True
+
+
+COMMANDS = {
+    'run': run_command,
+    'metadata': metadata_command,
+    'download': download_command,
+    'segment': segment_command,
+    'diarize': diarize_command,
+    'export': export_command,
+    'imports': imports_command,
+}
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-c', '--config', default='config.json', help="Json config file.")
+    common.add_argument('--force', action='append', default=[], choices=STAGES + ['all'], help='Ignore the cached results of a stage (repeatable).')
+    parser = argparse.ArgumentParser(description='Youtube speaker diarization pipeline. Without subcommand, "run" is executed.')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', parents=[common], help='Download, segment, diarize and export every link of the youtube list.')
+    run_parser.add_argument('--output_dir', default='output', help='Directory to save downloaded audio and transcript files.')
+    run_parser.add_argument('--status', action='store_true', help='Print the progress recorded in the journal and exit.')
+    run_parser.add_argument('--recalibrate', action='store_true', help='Calibrate the chunk duration again (autotune), ignoring the autotune_file.')
+    metadata_parser = subparsers.add_parser('metadata', parents=[common], help='Fetch the info and transcripts of youtube links into the metadata file.')
+    metadata_parser.add_argument('links', nargs='*', help='Youtube links, those of the youtube list of the config if none.')
+    download_parser = subparsers.add_parser('download', parents=[common], help='Download the mp3 audio of youtube links.')
+    download_parser.add_argument('links', nargs='*', help='Youtube links, those of the youtube list of the config if none.')
+    segment_parser = subparsers.add_parser('segment', parents=[common], help='Decode and split downloaded audio files into chunks.')
+    segment_parser.add_argument('input', nargs='+', help='Downloaded mp3 (or decoded wav) files.')
+    diarize_parser = subparsers.add_parser('diarize', parents=[common], help='Diarize the chunks of wavs/ folders.')
+    diarize_parser.add_argument('input', nargs='+', help='Folders of chunks (<video folder>/wavs).')
+    diarize_parser.add_argument('--overwrite', action='store_true', help='Diarize the chunks already diarized too.')
+    export_parser = subparsers.add_parser('export', parents=[common], help='Cut the diarized turns of video folders.')
+    export_parser.add_argument('input', nargs='+', help='Video folders, holding a diarized wavs/ folder.')
+    imports_parser = subparsers.add_parser('imports', help='Report the import time of the CLI and of the subcommand dependencies.')
+    imports_parser.add_argument('commands', nargs='*', default=list(IMPORT_STACKS), choices=list(IMPORT_STACKS), help='Subcommands to report.')
+    imports_parser.add_argument('--top', type=int, default=5, help='Number of slowest packages listed per module.')
+
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in COMMANDS and argv[0] not in ('-h', '--help'):
+        # python main.py -c config.json
+        argv = ['run'] + argv
+    args = parser.parse_args(argv)
+
+    args_data = {}
+    if args.command != 'imports':
+        args_data = read_config(args.config)
+        if args_data is None:
+            return False
+        metrics.configure(args_data.get('metrics_file'), args_data.get('prometheus_file'))
+    return COMMANDS[args.command](args, args_data)
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
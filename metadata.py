@@ -0,0 +1,187 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import asyncio
+import json
+import time
+from os import makedirs
+from os.path import dirname, exists
+from download import RateLimiter, get_video_id
+
+# Fields of the youtube_dl info dict kept in the metadata file
+INFO_FIELDS = ['id', 'title', 'duration', 'uploader', 'channel_id', 'upload_date', 'language']
+
+
+class YoutubeDLInfo:
+    """
+    Video info lookup (no download) with youtube_dl. Raises an exception for unavailable videos.
+    """
+    def __init__(self, ydl_class=None):
+        self.ydl_class = ydl_class
+
+    def __call__(self, link):
+        ydl_class = self.ydl_class
+        if ydl_class is None:
+            import youtube_dl
+            ydl_class = youtube_dl.YoutubeDL
+        with ydl_class({'quiet': True, 'noplaylist': True, 'skip_download': True}) as ydl:
+            info = ydl.extract_info(link, download=False)
+        return {field: info.get(field) for field in INFO_FIELDS}
+
+
+class YoutubeTranscript:
+    """
+    Text of the manually created transcript of a video in one of languages, None if there is none.
+    """
+    def __init__(self, languages=('pt',)):
+        self.languages = list(languages)
+
+    def __call__(self, video_id):
+        from youtube_transcript_api import YouTubeTranscriptApi
+        transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
+        try:
+            transcript = transcript_list.find_manually_created_transcript(self.languages)
+        except Exception:
+            return None
+        return ' '.join(line['text'] for line in transcript.fetch())
+
+
+class MetadataStore:
+    """
+    Video metadata of the links, one json line per fetched video, appended as soon as it is fetched.
+    On load, the last line of every video wins.
+    """
+    def __init__(self, metadata_path):
+        if dirname(metadata_path):
+            makedirs(dirname(metadata_path), exist_ok=True)
+        self.records = {}
+        if exists(metadata_path):
+            with open(metadata_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted run
+                        continue
+                    self.records[record['video_id']] = record
+        self.f = open(metadata_path, 'a')
+
+    def get(self, video_id):
+        return self.records.get(video_id)
+
+    def put(self, record):
+        self.records[record['video_id']] = record
+        self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+async def call(client, *args):
+    '''
+    Await an async client, or run a blocking one in the default thread pool.
+    '''
+    if asyncio.iscoroutinefunction(client) or asyncio.iscoroutinefunction(getattr(client, '__call__', None)):
+        return await client(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, client, *args)
+
+
+async def limited(rate_limiter, client, *args):
+    await asyncio.sleep(max(0.0, rate_limiter.reserve()))
+    return await call(client, *args)
+
+
+async def fetch_video(link, video_id, info_client, transcript_client, rate_limiter, semaphore):
+    '''
+    Fetch the info and the transcript of a video concurrently, returning its metadata record.
+    '''
+    async with semaphore:
+        requests = [limited(rate_limiter, info_client, link)]
+        if transcript_client is not None:
+            requests.append(limited(rate_limiter, transcript_client, video_id))
+        results = await asyncio.gather(*requests, return_exceptions=True)
+    record = {'video_id': video_id, 'link': link, 'fetched': time.time()}
+    if isinstance(results[0], Exception):
+        record.update(status='unavailable', error='{}: {}'.format(type(results[0]).__name__, results[0]))
+        return record
+    record.update(status='ok', info=results[0])
+    if transcript_client is not None:
+        record['transcript'] = None if isinstance(results[1], Exception) else results[1]
+    return record
+
+
+async def fetch_metadata(links, store, info_client, transcript_client=None, rate_limiter=None, concurrency=8):
+    '''
+    Metadata pre-pass over youtube links: duplicate links (same video id) and links without video id are dropped,
+    the videos not already in the store (or unavailable last time) are fetched concurrently, at most concurrency
+    at a time, under the shared rate limit. Returns the links of the available videos, in links order.
+    '''
+    rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(0.5, 1.5)
+    semaphore = asyncio.Semaphore(concurrency)
+    videos = {}
+    duplicates = 0
+    for link in links:
+        link = link.strip()
+        video_id = get_video_id(link) if link.startswith('https://') else None
+        if not video_id:
+            continue
+        if video_id in videos:
+            duplicates += 1
+            continue
+        videos[video_id] = link
+
+    pending = [(video_id, link) for video_id, link in videos.items()
+               if store.get(video_id) is None or store.get(video_id)['status'] != 'ok']
+    tasks = [asyncio.ensure_future(fetch_video(link, video_id, info_client, transcript_client, rate_limiter, semaphore))
+             for video_id, link in pending]
+    for task in asyncio.as_completed(tasks):
+        store.put(await task)
+
+    available = [link for video_id, link in videos.items() if store.get(video_id)['status'] == 'ok']
+    print('Metadata: {} videos ({} fetched), {} available, {} unavailable, {} duplicate links dropped'.format(
+        len(videos), len(pending), len(available), len(videos) - len(available), duplicates))
+    return available
+
+
+def prefetch_metadata(links, metadata_path, info_client=None, transcript_client=None, rate_limiter=None, concurrency=8):
+    '''
+    Run the metadata pre-pass (fetch_metadata) and persist its records to metadata_path (json lines).
+    Clients are callables (blocking or async): info_client(link) returns an info dict and raises for unavailable
+    videos, transcript_client(video_id) returns the transcript text or None.
+    '''
+    store = MetadataStore(metadata_path)
+    try:
+        return asyncio.run(fetch_metadata(links, store, info_client if info_client is not None else YoutubeDLInfo(),
+                                          transcript_client, rate_limiter, concurrency))
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch the info and transcripts of youtube links, dropping unavailable and duplicate videos.')
+    parser.add_argument('--input_file', default='links.txt', help='Input txt file.')
+    parser.add_argument('--metadata_file', default='metadata.jsonl', help='Json lines file of the video metadata.')
+    parser.add_argument('--output_file', default=None, help='Txt file receiving the links of the available videos.')
+    parser.add_argument('--languages', nargs='*', default=['pt'], help='Transcript languages, no transcripts if empty.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of videos fetched at a time.')
+    parser.add_argument('--min_wait', type=float, default=0.5, help='Minimum interval in seconds between two requests.')
+    parser.add_argument('--max_wait', type=float, default=1.5, help='Maximum interval in seconds between two requests.')
+    args = parser.parse_args()
+
+    with open(args.input_file) as f:
+        links = f.readlines()
+    transcript_client = YoutubeTranscript(args.languages) if args.languages else None
+    available = prefetch_metadata(links, args.metadata_file, transcript_client=transcript_client,
+                                  rate_limiter=RateLimiter(args.min_wait, args.max_wait), concurrency=args.concurrency)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            f.write(''.join(link + '\n' for link in available))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import json
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Units of /proc/<pid>/stat
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def cpu_time():
+    '''
+    CPU time of the calling thread.
+    '''
+    return time.thread_time()
+
+
+def child_pids(pid):
+    '''
+    Pids of the live descendant processes of pid (Linux /proc), empty elsewhere.
+    '''
+    pids = []
+    try:
+        tasks = os.listdir('/proc/%d/task' % pid)
+    except OSError:
+        return pids
+    for task in tasks:
+        try:
+            with open('/proc/%d/task/%s/children' % (pid, task)) as f:
+                children = [int(child) for child in f.read().split()]
+        except OSError:
+            continue
+        for child in children:
+            pids.append(child)
+            pids.extend(child_pids(child))
+    return pids
+
+
+def proc_stat(pid):
+    '''
+    (CPU seconds, RSS in MB) of a live process, from /proc/<pid>/stat. None if it is gone.
+    '''
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    # utime, stime, cutime, cstime (clock ticks) and rss (pages), after the process name
+    cpu = sum(int(field) for field in fields[11:15]) / CLOCK_TICKS
+    return cpu, int(fields[21]) * PAGE_SIZE / 2.0**20
+
+
+def children_cpu_time():
+    '''
+    CPU time of all the child processes of the process: the live ones (pool workers) and the finished ones (ffmpeg).
+    '''
+    t = os.times()
+    cpu = t.children_user + t.children_system
+    for pid in child_pids(os.getpid()):
+        stat = proc_stat(pid)
+        if stat is not None:
+            cpu += stat[0]
+    return cpu
+
+
+def rss_mb():
+    '''
+    Current resident set size of the process plus the one of its live child processes, in MB.
+    Peak RSS of the process lifetime where /proc is not available.
+    '''
+    stat = proc_stat(os.getpid())
+    if stat is None:
+        return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+    return stat[1] + sum(child[1] for child in map(proc_stat, child_pids(os.getpid())) if child is not None)
+
+
+class RssSampler:
+    """
+    Peak RSS of the open stages: while a stage is open, a thread samples rss_mb() every interval seconds,
+    raising the peak of every open stage. Concurrent stages see the memory of each other.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peaks = {}
+        self.thread = None
+
+    def sample(self):
+        rss = rss_mb()
+        with self.lock:
+            for token in self.peaks:
+                self.peaks[token] = max(self.peaks[token], rss)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.peaks:
+                    self.thread = None
+                    return
+            self.sample()
+
+    def start(self):
+        token = object()
+        rss = rss_mb()
+        with self.lock:
+            self.peaks[token] = rss
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return token
+
+    def stop(self, token):
+        self.sample()
+        with self.lock:
+            return self.peaks.pop(token)
+
+
+class Metrics:
+    """
+    Per-stage and per-video timing, throughput and memory records, written as JSON lines.
+    Stage records hold wall time, CPU time of the stage thread, CPU time of the child processes, peak RSS during
+    the stage, audio seconds and real-time factor (wall / audio).
+    """
+    def __init__(self, metrics_path=None, prometheus_path=None):
+        self.lock = threading.Lock()
+        self.rss = RssSampler()
+        self.configure(metrics_path, prometheus_path)
+
+    def configure(self, metrics_path=None, prometheus_path=None):
+        self.metrics_path = metrics_path
+        self.prometheus_path = prometheus_path
+        self.audio_seconds = {}
+        self.videos = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+        self.totals = defaultdict(lambda: defaultdict(float))
+        if metrics_path and os.path.dirname(metrics_path):
+            os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+
+    def set_audio_seconds(self, video_id, seconds):
+        self.audio_seconds[video_id] = seconds
+
+    @contextmanager
+    def stage(self, name, video_id=None, chunk_id=None, audio_seconds=None):
+        '''
+        Measure the enclosed block. The yielded record can be updated, ex. record['audio_seconds'] = ...
+        '''
+        record = {'stage': name, 'video_id': video_id, 'chunk_id': chunk_id, 'audio_seconds': audio_seconds}
+        wall, cpu, children_cpu = time.time(), cpu_time(), children_cpu_time()
+        rss = self.rss.start()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.time() - wall
+            record['cpu'] = cpu_time() - cpu
+            record['children_cpu'] = children_cpu_time() - children_cpu
+            record['peak_rss_mb'] = self.rss.stop(rss)
+            if record['audio_seconds'] is None and chunk_id is None:
+                record['audio_seconds'] = self.audio_seconds.get(video_id)
+            record['rtf'] = record['wall'] / record['audio_seconds'] if record['audio_seconds'] else None
+            record['time'] = time.time()
+            self.add(record)
+
+    def add(self, record):
+        with self.lock:
+            for totals in (self.totals[record['stage']], self.videos[record['video_id']][record['stage']]):
+                totals['count'] += 1
+                totals['wall'] += record['wall']
+                totals['cpu'] += record['cpu']
+                totals['children_cpu'] += record['children_cpu']
+                totals['audio_seconds'] += record['audio_seconds'] or 0
+                totals['peak_rss_mb'] = max(totals['peak_rss_mb'], record['peak_rss_mb'])
+            self.write(record)
+
+    def end_video(self, video_id):
+        '''
+        Write the per-stage summary of a video, with its real-time factors over the whole video duration.
+        '''
+        with self.lock:
+            stages = self.videos.pop(video_id, {})
+            audio_seconds = self.audio_seconds.pop(video_id, None)
+            summary = {'video_id': video_id, 'audio_seconds': audio_seconds, 'stages': {}, 'time': time.time()}
+            for name, totals in stages.items():
+                summary['stages'][name] = dict(totals, rtf=totals['wall'] / audio_seconds if audio_seconds else None)
+            summary['wall'] = sum(totals['wall'] for totals in stages.values())
+            summary['rtf'] = summary['wall'] / audio_seconds if audio_seconds else None
+            self.write(summary)
+        self.write_prometheus()
+        return summary
+
+    def write(self, record):
+        if self.metrics_path:
+            with open(self.metrics_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def write_prometheus(self):
+        '''
+        Dump the per-stage totals in the Prometheus text exposition format.
+        '''
+        if not self.prometheus_path:
+            return
+        names = [('count', 'diarization_stage_runs_total', 'counter'),
+                 ('wall', 'diarization_stage_wall_seconds_total', 'counter'),
+                 ('cpu', 'diarization_stage_cpu_seconds_total', 'counter'),
+                 ('children_cpu', 'diarization_stage_children_cpu_seconds_total', 'counter'),
+                 ('audio_seconds', 'diarization_stage_audio_seconds_total', 'counter'),
+                 ('peak_rss_mb', 'diarization_stage_peak_rss_megabytes', 'gauge')]
+        lines = []
+        with self.lock:
+            for key, metric, metric_type in names:
+                lines.append('# TYPE %s %s' % (metric, metric_type))
+                for stage, totals in sorted(self.totals.items()):
+                    lines.append('%s{stage="%s"} %f' % (metric, stage, totals[key]))
+        tmp = self.prometheus_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prometheus_path)
+
+
+# Process wide metrics, configured by main
+metrics = Metrics()
@@ -0,0 +1,313 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os.path import basename, dirname, exists, join
+import numpy as np
+from download import RateLimiter, download_from_youtube, get_audio_filepath, get_video_id
+from diarization import Diarizer, DEFAULT_MODEL
+from metrics import metrics
+from audio_segmentation import SEGMENT_PARAMS, build_chunks, create_audio_files_from_waveform, create_segments_list_from_dict, decode_audio, find_segments
+
+
+class StageStats:
+    """
+    Counters of a pipeline stage, summed over its workers.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.blocked_in = 0.0 # waiting for upstream items (starved)
+        self.blocked_out = 0.0 # waiting for downstream room (backpressure)
+
+    def add(self, items=0, errors=0, busy=0.0, blocked_in=0.0, blocked_out=0.0):
+        with self.lock:
+            self.items += items
+            self.errors += errors
+            self.busy += busy
+            self.blocked_in += blocked_in
+            self.blocked_out += blocked_out
+
+
+class Stage:
+    """
+    One step of a StagedPipeline. func(item) returns a dict of item updates, or None to drop the item.
+    Process stages run func in a process pool (func must be picklable, and the item is pickled to the worker,
+    so items should hold paths rather than large buffers), thread stages run it in place.
+    """
+    def __init__(self, name, func, workers=1, processes=False, queue_size=2, initializer=None, initargs=()):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.processes = processes
+        self.queue_size = queue_size
+        self.initializer = initializer
+        self.initargs = initargs
+        self.stats = StageStats()
+
+
+class StagedPipeline:
+    """
+    Run items through stages connected by bounded queues, so the stages overlap across items
+    while the queue sizes bound the memory in flight. Every stage run is recorded in the metrics, under the
+    video_id of its item, and an audio_seconds update sets the audio duration of the video.
+    """
+    def __init__(self, stages):
+        self.stages = stages
+        self.elapsed = 0.0
+
+    def run(self, items):
+        '''
+        Push items through every stage, returning the items that reached the end.
+        '''
+        stages = self.stages
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages] + [queue.Queue()]
+        remaining = [stage.workers for stage in stages]
+        remaining_lock = threading.Lock()
+        pools = [ProcessPoolExecutor(max_workers=stage.workers, initializer=stage.initializer, initargs=stage.initargs)
+                 if stage.processes else None for stage in stages]
+
+        def worker(i):
+            stage, pool = stages[i], pools[i]
+            in_queue, out_queue = queues[i], queues[i + 1]
+            while True:
+                start = time.time()
+                item = in_queue.get()
+                stage.stats.add(blocked_in=time.time() - start)
+                if item is None:
+                    break
+                start = time.time()
+                with metrics.stage(stage.name, item.get('video_id')):
+                    try:
+                        updates = pool.submit(stage.func, item).result() if pool else stage.func(item)
+                    except Exception as e:
+                        print("Error: stage {} failed: {}".format(stage.name, e))
+                        updates = None
+                stage.stats.add(items=1, errors=updates is None, busy=time.time() - start)
+                if updates is None or i == len(stages) - 1:
+                    metrics.end_video(item.get('video_id'))
+                if updates is None:
+                    continue
+                if 'audio_seconds' in updates:
+                    metrics.set_audio_seconds(item.get('video_id'), updates['audio_seconds'])
+                item.update(updates)
+                start = time.time()
+                out_queue.put(item)
+                stage.stats.add(blocked_out=time.time() - start)
+            # The last worker of a stage closes the next one
+            with remaining_lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last:
+                for _ in range(stages[i + 1].workers if i + 1 < len(stages) else 1):
+                    out_queue.put(None)
+
+        start = time.time()
+        threads = [threading.Thread(target=worker, args=(i,), daemon=True)
+                   for i, stage in enumerate(stages) for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        for item in items:
+            queues[0].put(item)
+        for _ in range(stages[0].workers):
+            queues[0].put(None)
+
+        results = []
+        while True:
+            item = queues[-1].get()
+            if item is None:
+                break
+            results.append(item)
+        for thread in threads:
+            thread.join()
+        for pool in pools:
+            if pool:
+                pool.shutdown()
+        self.elapsed = time.time() - start
+        return results
+
+    @property
+    def errors(self):
+        return sum(stage.stats.errors for stage in self.stages)
+
+    def summary(self):
+        '''
+        Print per-stage throughput and blocked times. capacity/s is the throughput
+        the stage would reach if it was never blocked, items/s the one it actually had.
+        '''
+        print('%-10s %7s %6s %6s %9s %9s %9s %8s %11s' % ('stage', 'workers', 'items', 'errors', 'busy(s)', 'in(s)', 'out(s)', 'items/s', 'capacity/s'))
+        for stage in self.stages:
+            s = stage.stats
+            print('%-10s %7d %6d %6d %9.1f %9.1f %9.1f %8.3f %11.3f' % (
+                stage.name, stage.workers, s.items, s.errors, s.busy, s.blocked_in, s.blocked_out,
+                s.items / self.elapsed if self.elapsed else 0.0,
+                s.items * stage.workers / s.busy if s.busy else 0.0))
+        print('Total: %.1f sec' % self.elapsed)
+
+
+#####################################################################################
+# Diarization pipeline stages
+#####################################################################################
+
+def decoded_path(mp3_audio_filepath):
+    '''
+    Decoded waveform of a video (float32 .npy), memory mapped by the stages instead of being pickled to them.
+    '''
+    return mp3_audio_filepath.replace('.mp3', '.f32.npy')
+
+
+def download_stage(item, output_dir, rate_limiter, journal=None):
+    mp3_audio_filepath = journal.artifact(item['video_id'], 'download') if journal is not None else None
+    if mp3_audio_filepath and exists(mp3_audio_filepath):
+        # Downloaded by a previous (interrupted) run
+        return {'mp3': mp3_audio_filepath}
+    rate_limiter.acquire()
+    mp3_audio_filepath = download_from_youtube(item['link'], output_dir, wait=False)
+    if not mp3_audio_filepath:
+        print("Error: Unable to download mp3 from youtube.")
+        if journal is not None:
+            journal.set_video(item['video_id'], item['link'], 'failed')
+        return None
+    if journal is not None:
+        journal.set_video(item['video_id'], item['link'], 'running')
+        journal.mark(item['video_id'], 'download', artifact=mp3_audio_filepath)
+    return {'mp3': mp3_audio_filepath}
+
+
+def decode_stage(item, sample_rate):
+    wav = decode_audio(item['mp3'], sample_rate)
+    np.save(decoded_path(item['mp3']), wav)
+    return {'decoded': decoded_path(item['mp3']), 'audio_seconds': len(wav) / sample_rate}
+
+
+def segment_stage(item, sample_rate, segment_params, splitter='librosa'):
+    wav = np.load(item['decoded'], mmap_mode='r')
+    segments = find_segments(item['mp3'], wav, sample_rate, segment_params['min_duration'], segment_params['max_duration'],
+                             segment_params['max_gap_duration'], segment_params['threshold'], splitter=splitter)
+    # Only the chunk boundaries go back to the pipeline
+    return {'segments': segments}
+
+
+def load_chunks(item, sample_rate):
+    '''
+    (chunk_id, waveform) pairs of a segmented item, slices of its memory mapped waveform.
+    '''
+    wav = np.load(item['decoded'], mmap_mode='r')
+    return build_chunks(item['mp3'], wav, sample_rate, basename(item['mp3']).split('.')[0], segments=item['segments'])
+
+
+# Diarization pipeline of a process stage worker
+_diarizer = None
+
+
+def init_diarize_stage(model_name, device):
+    global _diarizer
+    _diarizer = Diarizer(model_name, device)
+    _diarizer.warm_up()
+
+
+def diarize_stage(item, sample_rate):
+    results = [data for _, _, data in _diarizer.diarize_batch(load_chunks(item, sample_rate), sample_rate)]
+    return {'diarization': results}
+
+
+def export_stage(item, sample_rate, journal=None):
+    output_segments_path = join(dirname(item['mp3']), 'result')
+    failed = False
+    for (chunk_id, chunk), data in zip(load_chunks(item, sample_rate), item['diarization']):
+        if not data:
+            failed = True
+            continue
+        segments_list = create_segments_list_from_dict(data)
+        if not create_audio_files_from_waveform(chunk, sample_rate, segments_list, output_segments_path):
+            print("Error: Unable to create audio segments list.")
+            failed = True
+            continue
+        if journal is not None:
+            journal.mark(item['video_id'], 'export', chunk_id, output_segments_path)
+    os.remove(item['decoded'])
+    if journal is not None:
+        if not failed:
+            journal.mark(item['video_id'], 'done')
+        journal.set_video(item['video_id'], item['link'], 'failed' if failed else 'done')
+    if failed:
+        return None
+    return {'decoded': None, 'segments': None, 'diarization': None}
+
+
+def execute_staged_pipeline(youtube_links, output_dir, workers=None, queue_size=2, sample_rate=22050, min_wait=30, max_wait=60, model_name=DEFAULT_MODEL, device=None,
+                            segment_params=None, splitter='librosa', journal=None):
+    """
+    Execute the diarization pipeline as overlapping stages: download, decode, segment, diarize and export.
+    The decoded waveform of a video is written once (<video_id>.f32.npy, removed after the export) and memory
+    mapped by the segment, diarize and export stages, so only paths, chunk boundaries and results cross processes.
+        Parameters:
+        youtube_links (list): youtube links.
+        output_dir (str): output folder.
+        workers (dict): number of workers per stage name.
+        queue_size (int): maximum number of videos waiting between two stages.
+        sample_rate (int): sample rate of the decoded audio.
+        min_wait, max_wait (float): jittered interval in seconds between two youtube requests.
+        model_name (str): pyannote pretrained pipeline name.
+        device (str): torch device of the diarization workers.
+        segment_params (dict): min_duration, max_duration, threshold and max_gap_duration of the segmentation.
+        splitter (str): silence detection of the segmentation, 'librosa' or 'numpy'.
+        journal (Journal): if given, finished videos are skipped, and the videos and chunks are recorded there.
+
+        Returns:
+        StagedPipeline: the finished pipeline, with its stages statistics (errors counts the dropped videos).
+    """
+    workers = dict({'download': 2, 'decode': 1, 'segment': 1, 'diarize': 1, 'export': 2}, **(workers or {}))
+    rate_limiter = RateLimiter(min_wait, max_wait)
+    pipeline = StagedPipeline([
+        Stage('download', partial(download_stage, output_dir=output_dir, rate_limiter=rate_limiter, journal=journal), workers['download'], queue_size=queue_size),
+        Stage('decode', partial(decode_stage, sample_rate=sample_rate), workers['decode'], processes=True, queue_size=queue_size),
+        Stage('segment', partial(segment_stage, sample_rate=sample_rate, segment_params=segment_params, splitter=splitter), workers['segment'],
+              processes=True, queue_size=queue_size),
+        Stage('diarize', partial(diarize_stage, sample_rate=sample_rate), workers['diarize'], processes=True, queue_size=queue_size,
+              initializer=init_diarize_stage, initargs=(model_name, device)),
+        Stage('export', partial(export_stage, sample_rate=sample_rate, journal=journal), workers['export'], queue_size=queue_size),
+    ])
+    links = [link.strip() for link in youtube_links if link.startswith('https://')]
+    if journal is not None:
+        links = [link for link in links if not journal.done(get_video_id(link), 'done')]
+    pipeline.run({'link': link, 'video_id': get_video_id(link)} for link in links)
+    # Videos dropped by a stage: decoded waveform left behind, and no done mark
+    for link in links:
+        path = decoded_path(get_audio_filepath(link, output_dir))
+        if exists(path):
+            os.remove(path)
+        if journal is not None and not journal.done(get_video_id(link), 'done'):
+            journal.set_video(get_video_id(link), link, 'failed')
+    pipeline.summary()
+    return pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default='config.json', help="Json config file.")
+    args = parser.parse_args()
+    with open(args.config) as jsonfile:
+        args_data = json.load(jsonfile)
+    with open(args_data['youtube_list']) as f:
+        youtube_links = f.readlines()
+    pipeline = execute_staged_pipeline(youtube_links, args_data['videos_folder'], args_data.get('stage_workers'), args_data.get('stage_queue_size', 2),
+                                       args_data.get('sample_rate', 22050), args_data.get('min_wait', 30), args_data.get('max_wait', 60),
+                                       segment_params=SEGMENT_PARAMS, splitter=args_data.get('splitter', 'librosa'))
+    return pipeline.errors == 0
+
+
+if __name__ == '__main__':
+    main()
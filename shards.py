@@ -0,0 +1,180 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import io
+import os
+import tarfile
+import threading
+import time
+from glob import glob
+from os.path import exists, getmtime, join
+import numpy as np
+
+INDEX_FILE = 'index.csv'
+
+
+class ShardWriter:
+    """
+    Packed output of the exported files: files are appended to uncompressed tar shards (<prefix>-NNNNNN.tar,
+    readable with tar or WebDataset-style loaders) of at most max_size bytes, instead of one file per turn.
+    Every file is recorded in index.csv ("key|shard|offset|size", offset of its data in the shard) as soon
+    as it is written. A new run opens new shards, so the shards of previous runs are never rewritten.
+    """
+    def __init__(self, folder, max_size=1 << 30, prefix='turns'):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_size = max_size
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.keys = set(read_index_csv(join(folder, INDEX_FILE))['key'].tolist()) if exists(join(folder, INDEX_FILE)) else set()
+        self.shard_id = len(glob(join(folder, '%s-*.tar' % prefix)))
+        self.tar = None
+        self.index = open(join(folder, INDEX_FILE), 'a')
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def _open_shard(self):
+        if self.tar is not None:
+            self._close_shard()
+        self.shard = '%s-%06d.tar' % (self.prefix, self.shard_id)
+        self.shard_id += 1
+        self.tar = tarfile.open(join(self.folder, self.shard), 'w', format=tarfile.GNU_FORMAT)
+
+    def _close_shard(self):
+        self.tar.close()
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.tar = None
+
+    def add(self, key, data):
+        '''
+        Append the bytes of a file to the current shard, starting a new shard when it would exceed max_size.
+        '''
+        info = tarfile.TarInfo(key)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        with self.lock:
+            if self.tar is None or (self.tar.offset and self.tar.offset + len(data) + 1024 > self.max_size):
+                self._open_shard()
+            self.tar.addfile(info, io.BytesIO(data))
+            # The tar offset is past the data, padded to 512 bytes blocks
+            offset = self.tar.offset - (len(data) + 511) // 512 * 512
+            self.index.write('%s|%s|%d|%d\n' % (key, self.shard, offset, len(data)))
+            self.index.flush()
+            self.keys.add(key)
+        return True
+
+    def close(self):
+        '''
+        Close the current shard and write the sorted index sidecar (index.npz) read by ShardReader.
+        '''
+        with self.lock:
+            if self.tar is not None:
+                self._close_shard()
+            self.index.close()
+            index = read_index_csv(join(self.folder, INDEX_FILE))
+            shards, shard_index = np.unique(index['shard'], return_inverse=True)
+            tmp = join(self.folder, 'index.tmp.npz')
+            np.savez(tmp, key=index['key'], shards=shards, shard_index=shard_index.astype(np.int32), offset=index['offset'], size=index['size'])
+            os.replace(tmp, join(self.folder, 'index.npz'))
+
+
+def read_index_csv(index_path):
+    '''
+    Parse an index.csv into key, shard, offset and size columns, sorted by key.
+    A key written several times (re-exported file) keeps its last entry.
+    '''
+    rows = {}
+    with open(index_path) as f:
+        for line in f:
+            fields = line.rstrip('\n').rsplit('|', 3)
+            if len(fields) == 4:
+                rows[fields[0]] = fields[1:]
+    keys = sorted(rows)
+    if not keys:
+        return {'key': np.array([], dtype=str), 'shard': np.array([], dtype=str),
+                'offset': np.array([], dtype=np.int64), 'size': np.array([], dtype=np.int64)}
+    shards, offsets, sizes = zip(*(rows[key] for key in keys))
+    return {'key': np.array(keys), 'shard': np.array(shards),
+            'offset': np.array(offsets, dtype=np.int64), 'size': np.array(sizes, dtype=np.int64)}
+
+
+class ShardReader:
+    """
+    Random access to the files of a ShardWriter folder by key: binary search in the sorted index,
+    then a slice of the memory mapped shard (no copy, no tar parsing).
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        index_path = join(folder, INDEX_FILE)
+        sidecar = join(folder, 'index.npz')
+        if exists(sidecar) and getmtime(sidecar) >= getmtime(index_path):
+            with np.load(sidecar) as data:
+                self.keys, self.offsets, self.sizes = data['key'], data['offset'], data['size']
+                self.shards, self.shard_index = data['shards'], data['shard_index']
+        else:
+            index = read_index_csv(index_path)
+            self.keys, self.offsets, self.sizes = index['key'], index['offset'], index['size']
+            self.shards, self.shard_index = np.unique(index['shard'], return_inverse=True)
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _find(self, key):
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return i
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        '''
+        Bytes of a file, as a read-only memoryview of its shard.
+        '''
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        shard = int(self.shard_index[i])
+        if shard not in self.maps:
+            self.maps[shard] = np.memmap(join(self.folder, str(self.shards[shard])), dtype=np.uint8, mode='r')
+        return memoryview(self.maps[shard][self.offsets[i]:self.offsets[i] + self.sizes[i]])
+
+    def read(self, key, dtype='float32'):
+        '''
+        Decode a wav file of the shards, returning (waveform, sample_rate).
+        '''
+        import soundfile as sf
+        return sf.read(io.BytesIO(self[key]), dtype=dtype)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and extract the files of packed output shards.')
+    parser.add_argument('--shards', required=True, help='Shards folder.')
+    parser.add_argument('--extract', nargs='*', default=None, help='Keys of the files to extract.')
+    parser.add_argument('--output_dir', default='.', help='Folder of the extracted files.')
+    args = parser.parse_args()
+
+    reader = ShardReader(args.shards)
+    if args.extract is None:
+        print('{}: {} files, {} shards, {:.2f} GB'.format(args.shards, len(reader), len(reader.shards), reader.sizes.sum() / 2**30))
+        return True
+    os.makedirs(args.output_dir, exist_ok=True)
+    for key in args.extract:
+        if key not in reader:
+            print('Error: {} not found.'.format(key))
+            return False
+        with open(join(args.output_dir, key), 'wb') as f:
+            f.write(reader[key])
+    return True
+
+
+if __name__ == '__main__':
+    main()
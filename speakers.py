@@ -0,0 +1,232 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import os
+import time
+from os.path import exists
+import numpy as np
+import soundfile as sf
+
+DEFAULT_EMBEDDING_MODEL = "pyannote/embedding"
+
+# Loaded embedding models, keyed by (model name, device)
+_models = {}
+
+
+class EmbeddingModel:
+    """
+    Speaker embedding of a mono waveform, from a pyannote model applied to the whole waveform.
+    """
+    def __init__(self, model_name=DEFAULT_EMBEDDING_MODEL, device=None):
+        key = (model_name, device)
+        if key not in _models:
+            start = time.time()
+            from pyannote.audio import Inference, Model
+            model = Model.from_pretrained(model_name)
+            inference = Inference(model, window='whole')
+            if device is not None:
+                import torch
+                inference.to(torch.device(device))
+            _models[key] = inference
+            print('Loaded embedding model {} in {:.2f} sec'.format(model_name, time.time() - start))
+        self.inference = _models[key]
+        self.model_name = model_name
+
+    def __call__(self, waveform, sample_rate):
+        import torch
+        waveform = torch.from_numpy(np.ascontiguousarray(waveform, dtype=np.float32)).unsqueeze(0)
+        return np.asarray(self.inference({'waveform': waveform, 'sample_rate': sample_rate})).reshape(-1)
+
+
+class MockEmbedding:
+    """
+    Fake embedding model for tests: normalized log-spaced band energies of the spectrum,
+    so that tones of different pitches (ex. synthetic.synthetic_audio speakers) get different embeddings.
+    """
+    def __init__(self, dimension=32, min_frequency=60.0, max_frequency=4000.0):
+        self.dimension = dimension
+        self.edges = np.geomspace(min_frequency, max_frequency, dimension + 1)
+        self.model_name = 'mock'
+
+    def __call__(self, waveform, sample_rate):
+        spectrum = np.abs(np.fft.rfft(waveform))
+        frequencies = np.fft.rfftfreq(len(waveform), 1.0 / sample_rate)
+        bands = np.searchsorted(self.edges, frequencies) - 1
+        valid = (bands >= 0) & (bands < self.dimension)
+        return np.bincount(bands[valid], weights=spectrum[valid], minlength=self.dimension)
+
+
+def normalize(x):
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norm, 1e-12)
+
+
+class SpeakerIndex:
+    """
+    Incremental clustering of speaker embeddings. Every global speaker is a centroid (duration weighted
+    sum of normalized embeddings) in a matrix, so matching a chunk against all speakers is one matrix product.
+    """
+    def __init__(self, dimension=None, threshold=0.5, prefix='SPK'):
+        self.threshold = threshold
+        self.prefix = prefix
+        self.count = 0
+        self.sums = np.zeros((0, dimension or 0))
+        self.weights = np.zeros(0)
+        self.centroids = np.zeros((0, dimension or 0))
+
+    def __len__(self):
+        return self.count
+
+    def speaker_id(self, k):
+        return '%s%04d' % (self.prefix, k)
+
+    def _grow(self, dimension):
+        if self.sums.shape[1] != dimension:
+            if self.count:
+                raise ValueError('Embedding dimension {} does not match the index ({})'.format(dimension, self.sums.shape[1]))
+            self.sums = np.zeros((0, dimension))
+            self.centroids = np.zeros((0, dimension))
+        if self.count == len(self.sums):
+            # Amortized growth, the matrices are not reallocated for every new speaker
+            capacity = max(16, 2 * len(self.sums))
+            sums, centroids, weights = np.zeros((capacity, dimension)), np.zeros((capacity, dimension)), np.zeros(capacity)
+            sums[:self.count], centroids[:self.count], weights[:self.count] = self.sums[:self.count], self.centroids[:self.count], self.weights[:self.count]
+            self.sums, self.centroids, self.weights = sums, centroids, weights
+
+    def similarity(self, embeddings):
+        '''
+        Cosine similarity of embeddings (n x dimension) with every speaker centroid (n x count).
+        '''
+        return normalize(np.atleast_2d(embeddings)) @ self.centroids[:self.count].T
+
+    def assign(self, embeddings, weights=None, assigned=None):
+        '''
+        Assign the speakers of one chunk (one embedding per local speaker) to global speakers.
+        Two local speakers of a chunk are never merged: the most similar (local, global) pairs are matched first,
+        one to one, and local speakers without a match over the threshold become new global speakers.
+        assigned can give the global speakers already known for some local speakers (None for the others).
+        Returns the list of global speaker indices.
+        '''
+        embeddings = normalize(np.atleast_2d(np.asarray(embeddings, dtype=np.float64)))
+        weights = np.ones(len(embeddings)) if weights is None else np.asarray(weights, dtype=np.float64)
+        assigned = [None] * len(embeddings) if assigned is None else list(assigned)
+        if self.count:
+            sims = self.similarity(embeddings)
+            used = set(k for k in assigned if k is not None)
+            # Only the candidate pairs over the threshold are sorted
+            rows, columns = np.nonzero(sims >= self.threshold)
+            for j in np.argsort(-sims[rows, columns], kind='stable'):
+                i, k = int(rows[j]), int(columns[j])
+                if assigned[i] is None and k not in used:
+                    assigned[i] = int(k)
+                    used.add(k)
+        for i, embedding in enumerate(embeddings):
+            if assigned[i] is None:
+                self._grow(len(embedding))
+                assigned[i] = self.count
+                self.count += 1
+            self.update(assigned[i], embedding, weights[i])
+        return assigned
+
+    def update(self, k, embedding, weight=1.0):
+        self.sums[k] += weight * embedding
+        self.weights[k] += weight
+        self.centroids[k] = normalize(self.sums[k])
+
+    def save(self, index_filepath):
+        tmp = index_filepath + '.tmp.npz'
+        np.savez(tmp, sums=self.sums[:self.count], weights=self.weights[:self.count], threshold=self.threshold, prefix=self.prefix)
+        os.replace(tmp, index_filepath)
+
+    @classmethod
+    def load(cls, index_filepath, threshold=None):
+        with np.load(index_filepath) as data:
+            index = cls(data['sums'].shape[1], float(data['threshold']) if threshold is None else threshold, str(data['prefix']))
+            index.count = len(data['sums'])
+            index.sums = data['sums'].copy()
+            index.weights = data['weights'].copy()
+        index.centroids = normalize(index.sums)
+        return index
+
+
+class SpeakerLinker:
+    """
+    Replace the per-chunk diarization labels (SPEAKER_00, ...) of segments tables by global speaker ids:
+    one embedding per turn, averaged per local label, matched against a SpeakerIndex.
+    The index is saved after every chunk when index_filepath is given, and reloaded from there.
+    """
+    def __init__(self, model, index_filepath=None, threshold=0.5, min_turn_duration=0.5):
+        self.model = model
+        self.model_name = model.model_name
+        self.index_filepath = index_filepath
+        self.min_turn_duration = min_turn_duration
+        if index_filepath and exists(index_filepath):
+            self.index = SpeakerIndex.load(index_filepath, threshold)
+        else:
+            self.index = SpeakerIndex(threshold=threshold)
+
+    def link(self, wav, sample_rate, segments):
+        '''
+        Relabel a segments table (times in ms) of a chunk waveform with global speaker ids, in place.
+        Returns the normalized embeddings of the turns (one row per turn, NaN for the unused short turns).
+        '''
+        if not len(segments):
+            return np.full((0, 0), np.nan)
+        begins = (segments.begin * sample_rate / 1000).astype(np.int64)
+        ends = np.minimum((segments.end * sample_rate / 1000).astype(np.int64), len(wav))
+        labels, label_embeddings, weights, embeddings = self.embed_labels(wav, sample_rate, begins, ends, segments.label)
+        assigned = self.index.assign(label_embeddings, weights)
+        mapping = {label: self.index.speaker_id(k) for label, k in zip(labels, assigned)}
+        segments.label = np.asarray([mapping[label] for label in segments.label.tolist()], dtype=str)
+        if self.index_filepath:
+            self.index.save(self.index_filepath)
+        return embeddings
+
+    def embed_labels(self, wav, sample_rate, begins, ends, labels):
+        '''
+        Embeddings of the turns (begin and end in samples) of a waveform, and their duration weighted average per label.
+        Returns the sorted labels, their embeddings and speech durations, and the turn embeddings
+        (one row per turn, NaN for the unused short turns).
+        '''
+        labels = np.asarray(labels)
+        durations = (ends - begins) / sample_rate
+        embeddings = np.full((len(labels), 0), np.nan)
+        label_embeddings = []
+        weights = []
+        for label in sorted(set(labels.tolist())):
+            turns = np.flatnonzero(labels == label)
+            long_turns = turns[durations[turns] >= self.min_turn_duration]
+            # Short turns give unreliable embeddings, the longest one is used if there are only short ones
+            turns = long_turns if len(long_turns) else turns[np.argmax(durations[turns])][None]
+            turn_embeddings = normalize(np.array([self.model(wav[begins[j]:ends[j]], sample_rate) for j in turns], dtype=np.float64))
+            if embeddings.shape[1] == 0:
+                embeddings = np.full((len(labels), turn_embeddings.shape[1]), np.nan)
+            embeddings[turns] = turn_embeddings
+            label_embeddings.append(np.average(turn_embeddings, axis=0, weights=durations[turns] + 1e-6))
+            weights.append(durations[turns].sum())
+        return sorted(set(labels.tolist())), label_embeddings, weights, embeddings
+
+    def link_file(self, audio_filepath, segments):
+        '''
+        Same as link, reading the chunk from a wav file.
+        '''
+        wav, sample_rate = sf.read(audio_filepath, dtype='float32', always_2d=True)
+        return self.link(wav.mean(axis=1), sample_rate, segments)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', required=True, help='Speaker index file (.npz).')
+    args = parser.parse_args()
+    index = SpeakerIndex.load(args.index)
+    print('{}: {} speakers, threshold {}'.format(args.index, len(index), index.threshold))
+    for k in np.argsort(-index.weights[:len(index)]):
+        print('{} {:10.1f} sec'.format(index.speaker_id(k), index.weights[k]))
+
+
+if __name__ == '__main__':
+    main()
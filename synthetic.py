@@ -0,0 +1,57 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import numpy as np
+import soundfile as sf
+
+
+def synthetic_audio(duration, sample_rate = 16000, speakers = 2, min_burst = 0.5, max_burst = 8.0, min_gap = 0.1, max_gap = 2.0, gap_distribution = 'uniform', seed = 0):
+    '''
+    Speech-like synthetic audio: tone bursts (one pitch per speaker, syllable-rate amplitude modulation)
+    separated by near silent gaps. Returns the float32 waveform and its ground truth (begin, end, speaker) turns.
+    '''
+    rng = np.random.default_rng(seed)
+    n = int(duration / (min_burst + min_gap)) + 1
+    bursts = rng.uniform(min_burst, max_burst, n)
+    if gap_distribution == 'exponential':
+        gaps = np.clip(rng.exponential((min_gap + max_gap) / 2, n), min_gap, max_gap)
+    else:
+        gaps = rng.uniform(min_gap, max_gap, n)
+    begins = np.concatenate([[0.0], np.cumsum(bursts + gaps)[:-1]]) + gaps[0]
+    ends = begins + bursts
+    keep = ends < duration
+    begins, ends = begins[keep], ends[keep]
+    labels = rng.integers(0, speakers, len(begins))
+
+    total = int(duration * sample_rate)
+    # Generated in float32: no float64 temporary twice the size of the waveform
+    wav = rng.standard_normal(total, dtype=np.float32)
+    wav *= 1e-4
+    for begin, end, speaker in zip((begins * sample_rate).astype(int), (ends * sample_rate).astype(int), labels):
+        t = np.arange(end - begin, dtype=np.float32) / sample_rate
+        pitch = 120.0 + 60.0 * speaker
+        envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 4.0 * t)
+        wav[begin:end] += 0.3 * envelope * (np.sin(2 * np.pi * pitch * t) + 0.5 * np.sin(4 * np.pi * pitch * t))
+    turns = [(float(b), float(e), 'SPEAKER_%02d' % s) for b, e, s in zip(begins, ends, labels)]
+    return wav, turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a speech-like synthetic wav file.')
+    parser.add_argument('--output', required=True, help='Output wav filepath.')
+    parser.add_argument('--duration', type=float, default=60.0, help='Duration in seconds.')
+    parser.add_argument('--sample_rate', type=int, default=16000, help='Sample rate.')
+    parser.add_argument('--speakers', type=int, default=2, help='Number of speakers (tone pitches).')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+    wav, turns = synthetic_audio(args.duration, args.sample_rate, args.speakers, seed=args.seed)
+    sf.write(args.output, wav, args.sample_rate, subtype='PCM_16')
+    print('{}: {:.1f} sec, {} turns'.format(args.output, args.duration, len(turns)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+import soundfile as sf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import StubDiarizer, TonePipeline  # noqa: E402
+from synthetic import synthetic_audio  # noqa: E402
+
+
+@pytest.fixture
+def diarizer():
+    return StubDiarizer(TonePipeline(), model_name='tone')
+
+
+@pytest.fixture
+def video(tmp_path, monkeypatch):
+    '''
+    Downloaded video folder holding a synthetic <video_id>.mp3 (wav content), decoded without ffmpeg.
+    Returns (youtube link, mp3 path, ground truth turns).
+    '''
+    import main
+    wav, truth = synthetic_audio(120, 16000, speakers=2, max_gap=1.0, seed=3)
+    folder = tmp_path / 'videos' / 'AAA'
+    folder.mkdir(parents=True)
+    mp3 = str(folder / 'AAA.mp3')
+    sf.write(mp3, wav, 16000, format='WAV', subtype='PCM_16')
+    monkeypatch.setattr(main, 'decode_audio', lambda path, sample_rate, duration=None: sf.read(path, -1 if duration is None else int(duration * sample_rate), dtype='float32')[0])
+    monkeypatch.setattr(main, 'convert_audio', lambda path, wav_path, sample_rate: sf.write(wav_path, sf.read(path)[0], sample_rate, subtype='PCM_16'))
+    return 'https://www.youtube.com/watch?v=AAA', mp3, truth
@@ -0,0 +1,89 @@
+import json
+
+import main
+from autotune import best_duration, tuned_segment_params
+from journal import Journal
+
+
+def test_best_duration_is_a_measured_duration():
+    durations = [10, 20, 30, 45, 60]
+    # Throughput peaks at sqrt(a / c) = 36.5 s, between two measured durations
+    latencies = [4.0 + 0.1 * d + 0.003 * d ** 2 for d in durations]
+    duration, fit = best_duration(durations, latencies)
+    assert duration in (30, 45)
+    assert len(fit) == 3
+    # Unusable fit: best measured throughput
+    assert best_duration([10, 20], [1.0, 1.5])[0] == 20
+
+
+def test_tuned_params_are_reused(diarizer, tmp_path, monkeypatch):
+    calls = []
+    diarize_waveform = diarizer.diarize_waveform
+    monkeypatch.setattr(diarizer, 'diarize_waveform', lambda *args: calls.append(args) or diarize_waveform(*args))
+    autotune_file = str(tmp_path / 'autotune.json')
+    tuned = tuned_segment_params(diarizer, autotune_file, [10, 20], sample_rate=16000)
+    assert tuned['max_duration'] in (10, 20) and calls
+    del calls[:]
+    assert tuned_segment_params(diarizer, autotune_file, [10, 20], sample_rate=16000)['max_duration'] == tuned['max_duration']
+    assert not calls
+    # Another calibration setup, or a requested recalibration, times the diarization again
+    tuned_segment_params(diarizer, autotune_file, [10, 30], sample_rate=16000)
+    assert calls
+    del calls[:]
+    tuned_segment_params(diarizer, autotune_file, [10, 30], sample_rate=16000, recalibrate=True)
+    assert calls
+
+
+def test_in_memory_resume_keeps_the_first_segmentation(video, diarizer, tmp_path, monkeypatch):
+    link, mp3, _ = video
+    journal = Journal(str(tmp_path / 'journal.db'))
+    assert main.process_video(link, mp3, diarizer, True, 4, False, False, 16000, False, 60.0, journal=journal, splitter='numpy')
+    first = json.loads(journal.artifact('AAA', 'segment_params'))
+    chunks = sorted(journal.done_chunks('AAA'))
+    # Crash before the last chunk, then a resumed run with other parameters (ex. recalibrated)
+    journal.db.execute("DELETE FROM stages WHERE video_id='AAA' AND chunk_id=?", (chunks[-1],))
+    journal.db.commit()
+    params = []
+    diarize_in_memory = main.diarize_in_memory
+    monkeypatch.setattr(main, 'diarize_in_memory', lambda *args: params.append(args[-1]) or diarize_in_memory(*args))
+    assert main.process_video(link, mp3, diarizer, True, 4, False, False, 16000, False, 60.0, journal=journal, splitter='numpy',
+                              segment_params=dict(main.SEGMENT_PARAMS, min_duration=5, max_duration=8))
+    assert params == [first]
+    assert sorted(journal.done_chunks('AAA')) == chunks
+
+
+class FakeScheduler:
+    """
+    DownloadScheduler stand-in yielding already downloaded videos.
+    """
+    def __init__(self, downloads):
+        self.downloads = downloads
+
+    def __call__(self, links, output_dir, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return iter(self.downloads)
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_tuned_params_do_not_leak_into_the_defaults(video, diarizer, tmp_path, monkeypatch):
+    link, mp3, _ = video
+    links_file = tmp_path / 'links.txt'
+    links_file.write_text(link + '\n')
+    monkeypatch.setattr(diarizer, 'warm_up', lambda: True)
+    monkeypatch.setattr(main, 'Diarizer', lambda: diarizer)
+    monkeypatch.setattr(main, 'DownloadScheduler', FakeScheduler([(link, mp3)]))
+    params = []
+    monkeypatch.setattr(main, 'process_video', lambda *args: params.append(args[-1]) or True)
+    decoded = []
+    decode_audio = main.decode_audio
+    monkeypatch.setattr(main, 'decode_audio', lambda *args: decoded.append(args) or decode_audio(*args))
+    defaults = dict(main.SEGMENT_PARAMS)
+    assert main.execute_pipeline(str(links_file), str(tmp_path / 'videos'), sample_rate=16000, autotune=True, autotune_durations=[5, 10])
+    # Calibrated on the start of the downloaded video
+    assert decoded == [(mp3, 16000, 10)]
+    assert params[0]['max_duration'] in (5, 10)
+    assert main.SEGMENT_PARAMS == defaults
@@ -0,0 +1,38 @@
+import json
+import os
+import tracemalloc
+
+import numpy as np
+
+import benchmark
+from synthetic import synthetic_audio
+
+BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark_baseline.json')
+
+
+def test_synthetic_audio_peak_memory():
+    tracemalloc.start()
+    try:
+        wav, _ = synthetic_audio(300, 16000)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert wav.dtype == np.float32
+    # No float64 copy of the whole waveform
+    assert peak < 1.5 * wav.nbytes
+
+
+def test_baseline_covers_the_short_durations():
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+    for case in benchmark.CASES:
+        assert set(baseline['results'][case]) >= {'1m', '10m'}
+
+
+def test_run_duration_without_model(tmp_path):
+    audio_params = {'speakers': 2, 'min_burst': 0.5, 'max_burst': 8.0, 'min_gap': 0.1, 'max_gap': 2.0, 'gap_distribution': 'uniform', 'seed': 0}
+    timings, consistency = benchmark.run_duration('1m', benchmark.CASES, str(tmp_path), 16000, 1, audio_params, 5.0, splitter='numpy')
+    assert set(timings) == set(benchmark.CASES)
+    assert consistency['windowed'] > 0.9
+    results = {'results': {case: {'1m': elapsed} for case, elapsed in timings.items()}}
+    assert benchmark.compare(results, results) == []
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+from download import DownloadScheduler, RateLimiter
+from journal import Journal
+
+
+class FakeYoutubeDL:
+    """
+    youtube_dl.YoutubeDL stand-in: "downloads" a link in 0.2 s, writing the mp3 the FFmpegExtractAudio
+    postprocessor would leave, and records the start time of every download.
+    """
+    lock = threading.Lock()
+    starts = []
+    active = 0
+    max_active = 0
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def download(self, links):
+        cls = FakeYoutubeDL
+        with cls.lock:
+            cls.starts.append(time.monotonic())
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(0.2)
+        with cls.lock:
+            cls.active -= 1
+        if 'v=BAD' in links[0]:
+            raise IOError('Video unavailable')
+        with open(self.opts['outtmpl'].replace('.tmp', '.mp3'), 'wb') as f:
+            f.write(b'mp3')
+
+
+def test_rate_limiter_spacing():
+    now = [0.0]
+    limiter = RateLimiter(2, 4, clock=lambda: now[0])
+    waits = [limiter.reserve() for _ in range(5)]
+    assert waits[0] == 0
+    assert all(2 <= b - a <= 4 for a, b in zip(waits, waits[1:]))
+    # Idle time is not accumulated as credit (burst of 1)
+    now[0] = 100.0
+    assert limiter.reserve() == 0 and 0 < limiter.reserve() <= 4
+
+
+def test_scheduler_with_fake_youtube_dl(tmp_path):
+    FakeYoutubeDL.starts, FakeYoutubeDL.max_active = [], 0
+    links = ['https://www.youtube.com/watch?v=V%d\n' % i for i in range(5)]
+    links.insert(2, 'https://www.youtube.com/watch?v=BAD\n')
+    links.append('not a link\n')
+    start = time.monotonic()
+    with DownloadScheduler(links, str(tmp_path), workers=3, queue_depth=3, rate_limiter=RateLimiter(0.05, 0.05),
+                           ydl_class=FakeYoutubeDL) as downloads:
+        results = list(downloads)
+    # Links order, the failed download yields False
+    assert [link for link, _ in results] == links[:-1]
+    for link, mp3 in results:
+        if 'BAD' in link:
+            assert mp3 is False
+        else:
+            assert os.path.exists(mp3) and mp3.endswith('.mp3')
+    # The k-th request waits for its slot, k intervals after the first one (a late thread only delays its own request)
+    starts = sorted(FakeYoutubeDL.starts)
+    assert all(s - start >= 0.05 * k - 0.005 for k, s in enumerate(starts))
+    # Prefetch: the downloads overlap
+    assert FakeYoutubeDL.max_active >= 2
+
+
+def test_scheduler_skips_journaled_downloads(tmp_path):
+    FakeYoutubeDL.starts = []
+    journal = Journal(str(tmp_path / 'journal.db'))
+    mp3 = tmp_path / 'V0' / 'V0.mp3'
+    mp3.parent.mkdir()
+    mp3.write_bytes(b'mp3')
+    journal.mark('V0', 'download', artifact=str(mp3))
+    # Recorded, but its mp3 was removed since
+    journal.mark('V1', 'download', artifact=str(tmp_path / 'V1' / 'V1.mp3'))
+    links = ['https://www.youtube.com/watch?v=V0', 'https://www.youtube.com/watch?v=V1']
+    with DownloadScheduler(links, str(tmp_path), rate_limiter=RateLimiter(0, 0), ydl_class=FakeYoutubeDL, journal=journal) as downloads:
+        results = list(downloads)
+    assert [result for _, result in results] == [str(mp3), str(tmp_path / 'V1' / 'V1.mp3')]
+    assert len(FakeYoutubeDL.starts) == 1
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from audio_segmentation import SegmentTable, merge_segments_greedy, merge_segments_heap
+
+
+def random_table(rng, n, sample_rate, ties=False):
+    '''
+    n split parts: durations of 0.2-8 s separated by gaps of 0-2 s (a few distinct gaps when ties is set).
+    '''
+    durations = rng.uniform(0.2, 8.0, n)
+    gaps = rng.choice([0.1, 0.25, 0.5, 1.0], n) if ties else rng.uniform(0.0, 2.0, n)
+    begin = np.round(np.cumsum(np.concatenate(([0.0], durations[:-1] + gaps[:-1]))) * sample_rate).astype(np.int64)
+    end = begin + np.round(durations * sample_rate).astype(np.int64)
+    return SegmentTable(begin, end)
+
+
+def assert_same_merge(segments, sample_rate=16000, max_duration=30, max_gap_duration=1.0):
+    greedy = merge_segments_greedy(segments, sample_rate, max_duration, max_gap_duration)
+    heap = merge_segments_heap(segments, sample_rate, max_duration, max_gap_duration)
+    np.testing.assert_array_equal(greedy.begin, heap.begin)
+    np.testing.assert_array_equal(greedy.end, heap.end)
+    return heap
+
+
+@pytest.mark.parametrize('ties', [False, True])
+@pytest.mark.parametrize('seed', range(20))
+def test_heap_merge_matches_greedy(seed, ties):
+    rng = np.random.default_rng(seed)
+    segments = random_table(rng, int(rng.integers(2, 300)), 16000, ties)
+    merged = assert_same_merge(segments, max_duration=float(rng.uniform(5, 40)), max_gap_duration=float(rng.uniform(0.2, 1.5)))
+    assert len(merged) <= len(segments)
+
+
+def test_merge_of_empty_and_single_tables():
+    assert len(assert_same_merge(SegmentTable(np.array([], dtype=np.int64), np.array([], dtype=np.int64)))) == 0
+    merged = assert_same_merge(SegmentTable([100], [16100]))
+    assert merged.begin.tolist() == [100] and merged.end.tolist() == [16100]
+
+
+def test_merge_of_equal_gaps():
+    # Every gap scores the same: merges go left to right in both
+    begin = np.arange(10) * 20000
+    merged = assert_same_merge(SegmentTable(begin, begin + 16000), max_duration=2.5)
+    assert merged.begin.tolist() == begin[::2].tolist()
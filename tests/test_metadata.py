@@ -0,0 +1,109 @@
+import asyncio
+import json
+import threading
+import time
+
+from download import RateLimiter
+from metadata import MetadataStore, prefetch_metadata
+
+
+class FakeInfo:
+    """
+    Blocking info client: unavailable videos raise, like youtube_dl. Records the links and start times of the requests.
+    """
+    def __init__(self, unavailable=()):
+        self.unavailable = set(unavailable)
+        self.lock = threading.Lock()
+        self.links = []
+        self.starts = []
+
+    def __call__(self, link):
+        with self.lock:
+            self.links.append(link)
+            self.starts.append(time.monotonic())
+        video_id = link.split('v=')[1]
+        if video_id in self.unavailable:
+            raise IOError('Video unavailable')
+        return {'id': video_id, 'title': 'Video ' + video_id, 'duration': 60}
+
+
+class FakeTranscript:
+    """
+    Async transcript client, recording the start times and the number of requests in flight.
+    """
+    def __init__(self):
+        self.starts = []
+        self.active = 0
+        self.max_active = 0
+
+    async def __call__(self, video_id):
+        self.starts.append(time.monotonic())
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.02)
+        self.active -= 1
+        return None if video_id == 'V1' else 'text of ' + video_id
+
+
+def links(*video_ids):
+    return ['https://www.youtube.com/watch?v=%s\n' % video_id for video_id in video_ids]
+
+
+def read_records(metadata_path):
+    with open(metadata_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_duplicates_and_unavailable_videos_are_dropped(tmp_path):
+    metadata_path = str(tmp_path / 'metadata.jsonl')
+    info = FakeInfo(unavailable=['BAD'])
+    available = prefetch_metadata(links('V0', 'V1', 'V0', 'BAD', 'V2') + ['not a link\n'], metadata_path, info, FakeTranscript(),
+                                  RateLimiter(0, 0))
+    # Links order, each video once
+    assert available == [link.strip() for link in links('V0', 'V1', 'V2')]
+    assert sorted(info.links) == sorted(link.strip() for link in links('V0', 'V1', 'BAD', 'V2'))
+    records = {record['video_id']: record for record in read_records(metadata_path)}
+    assert records['BAD']['status'] == 'unavailable' and 'Video unavailable' in records['BAD']['error']
+    assert records['V0']['info']['title'] == 'Video V0' and records['V0']['transcript'] == 'text of V0'
+    assert records['V1']['status'] == 'ok' and records['V1']['transcript'] is None
+
+
+def test_unavailable_videos_are_fetched_again(tmp_path):
+    metadata_path = str(tmp_path / 'metadata.jsonl')
+    prefetch_metadata(links('V0', 'BAD'), metadata_path, FakeInfo(unavailable=['BAD']), rate_limiter=RateLimiter(0, 0))
+    # Next run: the known video is not requested again, the unavailable one is (and is back)
+    info = FakeInfo()
+    available = prefetch_metadata(links('V0', 'BAD'), metadata_path, info, rate_limiter=RateLimiter(0, 0))
+    assert info.links == [links('BAD')[0].strip()]
+    assert available == [link.strip() for link in links('V0', 'BAD')]
+    assert [record['status'] for record in read_records(metadata_path) if record['video_id'] == 'BAD'] == ['unavailable', 'ok']
+
+
+def test_requests_share_the_rate_limit(tmp_path):
+    info, transcript = FakeInfo(), FakeTranscript()
+    start = time.monotonic()
+    prefetch_metadata(links(*('V%d' % i for i in range(6))), str(tmp_path / 'metadata.jsonl'), info, transcript,
+                      RateLimiter(0.02, 0.02), concurrency=3)
+    # Info and transcript requests take their slots from the same limiter: the k-th request waits k intervals
+    starts = sorted(info.starts + transcript.starts)
+    assert len(starts) == 12
+    assert all(s - start >= 0.02 * k - 0.005 for k, s in enumerate(starts))
+    assert 1 <= transcript.max_active <= 3
+
+
+def test_store_persistence_and_reload(tmp_path):
+    metadata_path = str(tmp_path / 'metadata' / 'metadata.jsonl')
+    store = MetadataStore(metadata_path)
+    store.put({'video_id': 'V0', 'status': 'unavailable'})
+    store.put({'video_id': 'V1', 'status': 'ok', 'info': {'title': 'Título'}})
+    store.put({'video_id': 'V0', 'status': 'ok'})
+    store.close()
+    # Interrupted while writing a line
+    with open(metadata_path, 'a') as f:
+        f.write('{"video_id": "V2", "sta')
+    store = MetadataStore(metadata_path)
+    # The last line of a video wins
+    assert store.get('V0') == {'video_id': 'V0', 'status': 'ok'}
+    assert store.get('V1')['info']['title'] == 'Título'
+    assert store.get('V2') is None
+    store.close()
@@ -0,0 +1,35 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from metrics import Metrics
+
+
+def spin(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+    return True
+
+
+def test_peak_rss_is_per_stage():
+    metrics = Metrics()
+    with metrics.stage('big') as big:
+        wav = np.ones(300 * 2**20 // 8)
+        time.sleep(0.2)
+        del wav
+    with metrics.stage('small') as small:
+        time.sleep(0.2)
+    assert big['peak_rss_mb'] > small['peak_rss_mb'] + 200
+
+
+def test_cpu_of_worker_processes():
+    metrics = Metrics()
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        # Workers started before the stage
+        list(executor.map(int, range(2)))
+        with metrics.stage('diarize') as record:
+            assert all(executor.map(spin, [0.5, 0.5]))
+    assert record['children_cpu'] > 0.8
+    assert record['cpu'] < 0.5
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import soundfile as sf
+
+from diarization import MockPipeline, ParallelDiarizer
+
+
+@pytest.fixture
+def parallel_diarizer():
+    diarizer = ParallelDiarizer(workers=2, torch_threads=1, pipeline_factory=MockPipeline)
+    yield diarizer
+    diarizer.close()
+
+
+def test_map_keeps_chunk_order(parallel_diarizer, tmp_path):
+    assert parallel_diarizer.warm_up()
+    durations = [23.0, 7.0, 12.5, 3.0, 18.0]
+    paths = []
+    for i, duration in enumerate(durations):
+        path = str(tmp_path / ('chunk-%03d.wav' % i))
+        sf.write(path, np.zeros(int(duration * 8000), dtype=np.float32), 8000)
+        paths.append(path)
+    paths.append(str(tmp_path / 'missing.wav'))
+    results = parallel_diarizer.map(paths)
+    assert results[-1] is False
+    for path, duration, result in zip(paths, durations, results):
+        assert result['uri'] == path.split('/')[-1]
+        assert result['content'][-1]['segment']['end'] == duration
+        assert len(result['content']) == int(np.ceil(duration / 5.0))
+
+
+def test_diarize_batch_keeps_chunk_order(parallel_diarizer):
+    pytest.importorskip('torch')
+    chunks = [('chunk-%03d' % i, np.zeros(int(d * 8000), dtype=np.float32)) for i, d in enumerate([9.0, 2.0, 14.0])]
+    results = list(parallel_diarizer.diarize_batch(chunks, 8000, batch_size=2))
+    assert [chunk_id for chunk_id, _, _ in results] == [chunk_id for chunk_id, _ in chunks]
+    assert [data['uri'] for _, _, data in results] == [chunk_id for chunk_id, _ in chunks]
@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pytest
+
+import main
+from benchmark import StubDiarizer, TonePipeline
+from cache import ResultCache
+from journal import Journal
+from speakers import MockEmbedding
+from turn_index import TurnIndex
+
+MODES = {
+    'files': {},
+    'in_memory': {'in_memory': True},
+    'streaming': {'streaming': True},
+    'windowed': {'windowed': True},
+}
+
+
+def run(link, mp3, diarizer, cache, in_memory=False, streaming=False, windowed=False, **kwargs):
+    return main.process_video(link, mp3, diarizer, in_memory, 4, False, False, 16000, streaming, 60.0, cache,
+                              splitter='numpy', windowed=windowed, **kwargs)
+
+
+@pytest.mark.parametrize('mode', list(MODES))
+def test_rerun_with_cache_and_timeline(mode, video, diarizer, tmp_path):
+    link, mp3, _ = video
+    cache = ResultCache(str(tmp_path / 'cache'))
+    assert run(link, mp3, diarizer, cache, timeline=True, **MODES[mode])
+    timeline_path = os.path.join(os.path.dirname(mp3), 'timeline.csv')
+    with open(timeline_path) as f:
+        timeline = f.read()
+    assert timeline
+    # Second run: export cache hit, the timeline of the first run is kept
+    assert run(link, mp3, diarizer, cache, timeline=True, **MODES[mode])
+    with open(timeline_path) as f:
+        assert f.read() == timeline
+
+
+@pytest.mark.parametrize('mode', ['files', 'in_memory'])
+def test_same_audio_videos_do_not_share_exports(mode, video, diarizer, tmp_path):
+    link, mp3, _ = video
+    cache = ResultCache(str(tmp_path / 'cache'))
+    # Re-upload: same audio, other video id
+    folder = tmp_path / 'videos' / 'BBB'
+    folder.mkdir()
+    copy = str(folder / 'BBB.mp3')
+    with open(mp3, 'rb') as src, open(copy, 'wb') as dst:
+        dst.write(src.read())
+    assert run(link, mp3, diarizer, cache, **MODES[mode])
+    assert run('https://www.youtube.com/watch?v=BBB', copy, diarizer, cache, **MODES[mode])
+    files = os.listdir(str(folder / 'result'))
+    assert files and all(f.startswith('BBB-') for f in files)
+
+
+def test_windowed_turns_are_linked_and_indexed(video, diarizer, tmp_path):
+    link, mp3, _ = video
+    turn_index = TurnIndex(str(tmp_path / 'index'))
+    assert run(link, mp3, diarizer, None, windowed=True, embedding_model=MockEmbedding(), turn_index=turn_index)
+    turns = turn_index.turns(video_id='AAA')
+    assert turns and all(turn['label'].startswith('SPK') for turn in turns)
+    # The stitched turns get the embeddings of their window turns (only the short ones may have none)
+    embedded = [turn_index.embedding(turn) for turn in turn_index.turns(video_id='AAA', min_duration=0.5)]
+    assert embedded and all(embedding is not None for embedding in embedded)
+    np.testing.assert_allclose(np.linalg.norm(embedded, axis=1), 1.0, rtol=1e-5)
+    turn_index.close()
+
+
+class FailingPipeline(TonePipeline):
+    """
+    TonePipeline failing from its second window on.
+    """
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def __call__(self, audio):
+        self.calls += 1
+        if self.calls > 1:
+            raise RuntimeError('window failed')
+        return super().__call__(audio)
+
+
+def test_windowed_failure_marks_the_video_failed(video, tmp_path):
+    link, mp3, _ = video
+    journal = Journal(str(tmp_path / 'journal.db'))
+    assert run(link, mp3, StubDiarizer(FailingPipeline(), model_name='tone'), None, windowed=True, journal=journal)
+    assert journal.status()['videos'] == {'failed': 1}
+    assert not journal.done('AAA', 'done')
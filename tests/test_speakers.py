@@ -0,0 +1,95 @@
+import numpy as np
+
+from audio_segmentation import SegmentTable
+from speakers import MockEmbedding, SpeakerIndex, SpeakerLinker
+from synthetic import synthetic_audio
+
+SAMPLE_RATE = 16000
+
+
+def voice(*pitches, duration=1.0):
+    '''
+    Embedding of a sum of (pitch, amplitude) tones.
+    '''
+    t = np.arange(int(duration * SAMPLE_RATE), dtype=np.float32) / SAMPLE_RATE
+    return MockEmbedding()(sum(amplitude * np.sin(2 * np.pi * pitch * t) for pitch, amplitude in pitches), SAMPLE_RATE)
+
+
+def test_assignment_is_one_to_one():
+    index = SpeakerIndex(threshold=0.5)
+    assert index.assign([voice((120, 1.0)), voice((600, 1.0))]) == [0, 1]
+    # Both local speakers are close to the first global one: only the closest gets it, the other is a new speaker
+    close, closest = voice((120, 1.0), (180, 0.3)), voice((120, 1.0))
+    assert index.similarity(close)[0, 0] > 0.5
+    assert index.assign([close, closest]) == [2, 0]
+    assert len(index) == 3
+
+
+def test_threshold():
+    index = SpeakerIndex(threshold=0.5)
+    index.assign([voice((120, 1.0))])
+    near, far = voice((120, 1.0), (180, 0.5)), voice((120, 1.0), (180, 2.5))
+    assert index.similarity(near)[0, 0] >= 0.5 > index.similarity(far)[0, 0]
+    assert index.assign([far]) == [1]
+    assert index.assign([near]) == [0]
+    # A lower threshold matches it to the known speaker
+    loose = SpeakerIndex(threshold=0.2)
+    loose.assign([voice((120, 1.0))])
+    assert loose.assign([far]) == [0]
+
+
+def test_new_speakers_and_known_assignments():
+    index = SpeakerIndex(threshold=0.5, prefix='SPK')
+    assert index.assign([voice((120, 1.0))]) == [0]
+    # Unknown voices become new speakers, whatever the growth of the matrices
+    pitches = np.geomspace(300, 3500, 20)
+    assert index.assign([voice((pitch, 1.0)) for pitch in pitches]) == list(range(1, 21))
+    assert len(index) == 21 and index.speaker_id(20) == 'SPK0020'
+    # Given assignments are kept, and their speaker is not given to another local speaker
+    assert index.assign([voice((120, 1.0)), voice((pitches[0], 1.0))], assigned=[None, 0]) == [21, 0]
+
+
+def chunk(seed, swap=False):
+    '''
+    Synthetic chunk and its ground truth segments table (ms), the local labels swapped if swap.
+    '''
+    wav, turns = synthetic_audio(30, SAMPLE_RATE, speakers=2, max_gap=1.0, seed=seed)
+    labels = [label for _, _, label in turns]
+    if swap:
+        labels = ['SPEAKER_01' if label == 'SPEAKER_00' else 'SPEAKER_00' for label in labels]
+    segments = SegmentTable(np.array([b for b, _, _ in turns]) * 1000, np.array([e for _, e, _ in turns]) * 1000, labels)
+    return wav, segments, [label for _, _, label in turns]
+
+
+def test_linker_relabels_chunks_with_global_ids(tmp_path):
+    index_filepath = str(tmp_path / 'speakers.npz')
+    linker = SpeakerLinker(MockEmbedding(), index_filepath)
+    mapping = {}
+    for seed, swap in ((0, False), (1, True), (2, False)):
+        wav, segments, truth = chunk(seed, swap)
+        embeddings = linker.link(wav, SAMPLE_RATE, segments)
+        assert embeddings.shape == (len(segments), 32)
+        # Same true speaker, same global id, whatever its local label
+        for speaker, label in zip(truth, segments.label.tolist()):
+            assert mapping.setdefault(speaker, label) == label
+    assert sorted(mapping.values()) == ['SPK0000', 'SPK0001']
+    assert len(linker.index) == 2
+
+
+def test_index_save_and_reload(tmp_path):
+    index_filepath = str(tmp_path / 'speakers.npz')
+    linker = SpeakerLinker(MockEmbedding(), index_filepath)
+    wav, segments, _ = chunk(0)
+    linker.link(wav, SAMPLE_RATE, segments)
+    labels = segments.label.tolist()
+
+    reloaded = SpeakerIndex.load(index_filepath)
+    assert len(reloaded) == len(linker.index) and reloaded.threshold == 0.5 and reloaded.prefix == 'SPK'
+    np.testing.assert_allclose(reloaded.centroids, linker.index.centroids[:len(linker.index)])
+    np.testing.assert_allclose(reloaded.weights, linker.index.weights[:len(linker.index)])
+    assert SpeakerIndex.load(index_filepath, threshold=0.8).threshold == 0.8
+    # A new linker over the saved index gives the known speakers their ids
+    wav, segments, _ = chunk(0)
+    SpeakerLinker(MockEmbedding(), index_filepath).link(wav, SAMPLE_RATE, segments)
+    assert segments.label.tolist() == labels
+    assert len(SpeakerIndex.load(index_filepath)) == 2
@@ -0,0 +1,74 @@
+import librosa
+import numpy as np
+import pytest
+import soundfile as sf
+
+from audio_segmentation import build_segments_streaming, find_segments, load_manifest, split_numpy, stream_segments, stream_split
+from synthetic import synthetic_audio
+
+
+def assert_same_split(wav, threshold_db, frame_length=1024, hop_length=256):
+    expected = librosa.effects.split(wav, top_db=threshold_db, frame_length=frame_length, hop_length=hop_length)
+    intervals = split_numpy(wav, threshold_db, frame_length, hop_length)
+    np.testing.assert_array_equal(intervals.reshape((-1, 2)), expected.reshape((-1, 2)))
+    return intervals
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_split_numpy_matches_librosa(seed):
+    rng = np.random.default_rng(seed)
+    # Odd lengths, not a multiple of the hop length
+    duration = float(rng.uniform(5, 40)) + 1.0 / 16000
+    wav, _ = synthetic_audio(duration, 16000, speakers=3, max_gap=float(rng.uniform(0.3, 2.0)), seed=seed)
+    intervals = assert_same_split(wav, float(rng.uniform(20, 40)))
+    assert len(intervals) > 1
+
+
+@pytest.mark.parametrize('frame_length, hop_length', [(2048, 512), (1000, 300), (512, 512)])
+def test_split_numpy_matches_librosa_framings(frame_length, hop_length):
+    wav, _ = synthetic_audio(12.345, 22050, seed=1)
+    assert_same_split(wav, 28.0, frame_length, hop_length)
+
+
+def test_split_numpy_edge_cases():
+    rng = np.random.default_rng(0)
+    # All silence: the threshold is relative to the loudest frame, so librosa keeps the whole signal
+    assert assert_same_split(np.zeros(16001, dtype=np.float32), 28.0).tolist() == [[0, 16001]]
+    # No silence: the whole signal
+    noise = rng.standard_normal(16003).astype(np.float32)
+    assert assert_same_split(noise, 28.0).tolist() == [[0, 16003]]
+    # Shorter than a frame, speech up to the last sample
+    wav, _ = synthetic_audio(1.0, 16000, seed=2)
+    assert_same_split(wav[:777], 28.0)
+    assert_same_split(np.concatenate((np.zeros(5001, dtype=np.float32), noise[:3001])), 28.0)
+
+
+@pytest.mark.parametrize('block_duration', [0.01, 0.1, 1.0, 7.3, 100.0])
+def test_streaming_matches_split_numpy_and_find_segments(block_duration, tmp_path):
+    wav_filepath = str(tmp_path / 'AAA.wav')
+    wav, _ = synthetic_audio(45.0 + 3.0 / 16000, 16000, speakers=2, max_gap=1.5, seed=5)
+    sf.write(wav_filepath, wav, 16000, subtype='PCM_16')
+    # Same samples as the streamed ones
+    wav = sf.read(wav_filepath, dtype='float32')[0]
+    intervals = split_numpy(wav, 28.0)
+    streamed = list(stream_split(wav_filepath, 28.0, block_duration=block_duration))
+    assert streamed == [tuple(interval) for interval in intervals.tolist()]
+    # Intervals across a block boundary are not cut
+    block = max(1, int(block_duration * 16000))
+    assert block_duration >= 45 or any(begin // block != (end - 1) // block for begin, end in streamed)
+
+    segments = find_segments(wav_filepath, wav, 16000, 5, 10, 1.0, 28.0, splitter='numpy')
+    assert list(stream_segments(wav_filepath, 5, 10, 1.0, 28.0, block_duration)) == list(zip(segments.begin.tolist(), segments.end.tolist()))
+
+
+def test_build_segments_streaming_matches_find_segments(tmp_path):
+    wav_filepath = str(tmp_path / 'AAA.wav')
+    wav, _ = synthetic_audio(60.0, 16000, speakers=2, max_gap=1.5, seed=6)
+    sf.write(wav_filepath, wav, 16000, subtype='PCM_16')
+    wav = sf.read(wav_filepath, dtype='float32')[0]
+    segments = find_segments(wav_filepath, wav, 16000, 5, 10, 1.0, 28.0, splitter='numpy')
+    output_folder = str(tmp_path / 'wavs')
+    assert build_segments_streaming(wav_filepath, output_folder, 'AAA', 5, 10, 28.0, 1.0, block_duration=0.37) == len(segments)
+    manifest = load_manifest(output_folder)
+    assert manifest['begin'].tolist() == segments.begin.tolist()
+    assert manifest['end'].tolist() == segments.end.tolist()
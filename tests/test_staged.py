@@ -0,0 +1,61 @@
+import argparse
+import glob
+import os
+
+import soundfile as sf
+
+import main
+import pipeline
+from benchmark import StubDiarizer, TonePipeline
+from journal import Journal
+from synthetic import synthetic_audio
+
+
+def init_stub_diarize_stage(model_name, device):
+    pipeline._diarizer = StubDiarizer(TonePipeline())
+
+
+def fake_download(link, output_dir, wait=False):
+    video_id = link.split('v=')[1]
+    if video_id == 'BAD':
+        return False
+    os.makedirs(os.path.join(output_dir, video_id), exist_ok=True)
+    mp3 = os.path.join(output_dir, video_id, video_id + '.mp3')
+    wav, _ = synthetic_audio(120, 16000, speakers=2, max_gap=1.0, seed=3)
+    sf.write(mp3, wav, 16000, format='WAV', subtype='PCM_16')
+    fake_download.calls.append(link)
+    return mp3
+
+
+def run_staged(output_dir, journal, segment_params):
+    links = ['https://www.youtube.com/watch?v=AAA\n', 'https://www.youtube.com/watch?v=BAD\n']
+    return pipeline.execute_staged_pipeline(links, output_dir, {'download': 1, 'decode': 1, 'segment': 1, 'diarize': 1, 'export': 1},
+                                            sample_rate=16000, min_wait=0, max_wait=0, segment_params=segment_params, splitter='numpy', journal=journal)
+
+
+def test_staged_pipeline(tmp_path, monkeypatch):
+    fake_download.calls = []
+    monkeypatch.setattr(pipeline, 'download_from_youtube', fake_download)
+    monkeypatch.setattr(pipeline, 'decode_audio', lambda path, sample_rate: sf.read(path, dtype='float32')[0])
+    monkeypatch.setattr(pipeline, 'init_diarize_stage', init_stub_diarize_stage)
+    output_dir = str(tmp_path / 'videos')
+    journal = Journal(str(tmp_path / 'journal.db'))
+    segment_params = dict(main.SEGMENT_PARAMS, min_duration=5, max_duration=10)
+    staged = run_staged(output_dir, journal, segment_params)
+    # The failed download is an error
+    assert staged.errors == 1
+    assert journal.done('AAA', 'done') and not journal.done('BAD', 'done')
+    assert journal.status()['videos'] == {'done': 1, 'failed': 1}
+    # Chunks of at most max_duration seconds
+    assert len(journal.done_chunks('AAA')) >= 12
+    assert glob.glob(os.path.join(output_dir, 'AAA', 'result', '*.wav'))
+    assert not glob.glob(os.path.join(output_dir, '*', '*.npy'))
+    # Finished videos are skipped
+    run_staged(output_dir, journal, segment_params)
+    assert fake_download.calls == ['https://www.youtube.com/watch?v=AAA']
+
+
+def test_staged_rejects_unsupported_options(tmp_path):
+    args = argparse.Namespace(config='config.json', status=False, force=[], recalibrate=False)
+    args_data = {'videos_folder': str(tmp_path), 'youtube_list': str(tmp_path / 'links.txt'), 'staged': True, 'cache_dir': str(tmp_path / 'cache')}
+    assert main.run_command(args, args_data) is False
@@ -0,0 +1,39 @@
+import argparse
+import glob
+import json
+import os
+
+import soundfile as sf
+
+import main
+from synthetic import synthetic_audio
+
+
+def chunk_folder(tmp_path, n=5):
+    '''
+    Video folder whose wavs/ holds n segmented chunks of synthetic speech.
+    '''
+    folder = tmp_path / 'AAA'
+    (folder / 'wavs').mkdir(parents=True)
+    for i in range(n):
+        wav, _ = synthetic_audio(20 + 3 * i, 16000, speakers=2, max_gap=1.0, seed=i)
+        sf.write(str(folder / 'wavs' / ('AAA-%04d.wav' % i)), wav, 16000, subtype='PCM_16')
+    return str(folder)
+
+
+def test_diarize_then_export(tmp_path, diarizer, monkeypatch):
+    monkeypatch.setattr(main, 'open_diarizer', lambda args_data: diarizer)
+    folder = chunk_folder(tmp_path)
+    assert main.diarize_command(argparse.Namespace(input=[os.path.join(folder, 'wavs')], overwrite=False), {})
+    json_paths = sorted(glob.glob(os.path.join(folder, 'wavs', '*.json')))
+    assert [os.path.basename(path) for path in json_paths] == ['AAA-%04d.json' % i for i in range(5)]
+    for json_path in json_paths:
+        with open(json_path) as f:
+            assert json.load(f)['uri'] == os.path.basename(json_path).replace('.json', '.wav')
+
+    # segments.json left in wavs/ by older runs
+    with open(os.path.join(folder, 'wavs', 'segments.json'), 'w') as f:
+        json.dump({'uri': 'segments.wav', 'content': []}, f)
+    assert main.export_command(argparse.Namespace(input=[folder]), {})
+    files = os.listdir(os.path.join(folder, 'result'))
+    assert files and {f.split('-')[1] for f in files} == {'%04d' % i for i in range(5)}
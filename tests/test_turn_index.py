@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+
+from audio_segmentation import SegmentTable
+from turn_index import TurnIndex
+
+
+def chunk_turns(chunk_id, n):
+    return SegmentTable(np.arange(n) * 2000, np.arange(n) * 2000 + 1500, ['SPK%04d' % (i % 2) for i in range(n)], uri=chunk_id)
+
+
+def unit(rng, n, dimension=8):
+    vectors = rng.standard_normal((n, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_reindexed_turns_reuse_their_embedding_rows(tmp_path):
+    rng = np.random.default_rng(0)
+    index = TurnIndex(str(tmp_path / 'index'))
+    first = unit(rng, 3)
+    index.add('AAA', 'AAA-000', chunk_turns('AAA-000', 3), 'result', first)
+    index.add('AAA', 'AAA-001', chunk_turns('AAA-001', 2), 'result', unit(rng, 2))
+    # Chunk exported again (resumed run): same files, new embeddings
+    again = unit(rng, 3)
+    index.add('AAA', 'AAA-000', chunk_turns('AAA-000', 3), 'result', again)
+    assert len(index.matrix()) == 5
+    assert os.path.getsize(str(tmp_path / 'index' / 'embeddings.f32')) == 5 * 8 * 4
+    turns = index.turns(video_id='AAA')
+    assert len(turns) == 5
+    np.testing.assert_allclose(index.embedding(index.turn(chunk_turns('AAA-000', 3).filename(1))), again[1])
+    results = index.nearest(again[1], k=2)
+    assert len(results) == 2
+    assert results[0][1]['filename'] == chunk_turns('AAA-000', 3).filename(1)
+
+
+def test_nearest_skips_unused_rows(tmp_path):
+    rng = np.random.default_rng(1)
+    index = TurnIndex(str(tmp_path / 'index'))
+    embeddings = unit(rng, 4)
+    index.add('AAA', 'AAA-000', chunk_turns('AAA-000', 4), 'result', embeddings)
+    index.add('BBB', 'BBB-000', chunk_turns('BBB-000', 2), 'result', unit(rng, 2))
+    # Re-indexed without embeddings: the rows of AAA-000 are no longer referenced
+    index.add('AAA', 'AAA-000', chunk_turns('AAA-000', 4), 'result', None)
+    results = index.nearest(embeddings[0], k=2, block_rows=3)
+    assert len(results) == 2
+    assert all(turn['video_id'] == 'BBB' for _, turn in results)
@@ -0,0 +1,140 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import os
+from glob import glob
+from os.path import basename, exists, join
+import numpy as np
+from audio_segmentation import create_segments_list_from_json, load_manifest
+
+TURNS_FILE = 'turns.csv'
+TIMELINE_FILE = 'timeline.csv'
+
+
+def build_timeline(manifest, sample_rate, chunk_ids, begins, ends, labels, local_labels=True):
+    '''
+    Absolute timeline of the diarized turns of a video: every turn (begin/end in ms relative to its chunk)
+    is shifted by the begin (in samples) of its chunk in the manifest, joined on the chunk id.
+    Chunk-local labels (SPEAKER_00, ...) are prefixed with their chunk id, since they are unrelated across chunks.
+    Returns the begin, end (seconds), label and chunk columns, sorted by begin.
+    '''
+    chunk_ids = np.asarray(chunk_ids, dtype=str)
+    labels = np.asarray(labels, dtype=str)
+    order = np.argsort(manifest['id'], kind='stable')
+    ids = manifest['id'][order]
+    rows = np.searchsorted(ids, chunk_ids)
+    found = rows < len(ids)
+    found[found] = ids[rows[found]] == chunk_ids[found]
+    if not found.all():
+        print('Warning: {} turns of chunks missing from the manifest are left out.'.format(int((~found).sum())))
+    offsets = manifest['begin'][order][rows[found]] / sample_rate
+    begin = offsets + np.asarray(begins, dtype=np.float64)[found] / 1000
+    end = offsets + np.asarray(ends, dtype=np.float64)[found] / 1000
+    chunk_ids, labels = chunk_ids[found], labels[found]
+    if local_labels and len(labels):
+        labels = np.char.add(np.char.add(chunk_ids, '-'), labels)
+    order = np.lexsort((end, begin))
+    return {'begin': begin[order], 'end': end[order], 'label': labels[order], 'chunk': chunk_ids[order]}
+
+
+def merge_turns(timeline, max_gap=0.5):
+    '''
+    Merge the consecutive turns of a same speaker (ex. a turn cut by a chunk boundary) separated by at most
+    max_gap seconds of silence. The timeline must be sorted by begin. Merged turns keep the chunk of their first turn.
+    '''
+    begin, end, label = timeline['begin'], timeline['end'], timeline['label']
+    if len(begin) < 2:
+        return timeline
+    # Runs of consecutive turns of the same speaker, and the running max end inside every run
+    run = np.concatenate(([0], np.cumsum(label[1:] != label[:-1])))
+    span = end.max() - begin.min() + 1
+    running_end = np.maximum.accumulate(end + run * span) - run * span
+    start = np.ones(len(begin), dtype=bool)
+    start[1:] = (run[1:] != run[:-1]) | (begin[1:] - running_end[:-1] > max_gap)
+    starts = np.flatnonzero(start)
+    return {'begin': begin[starts], 'end': np.maximum.reduceat(end, starts), 'label': label[starts], 'chunk': timeline['chunk'][starts]}
+
+
+def write_rttm(timeline, uri, rttm_path):
+    '''
+    Write a timeline in the RTTM format (one SPEAKER line per turn).
+    '''
+    with open(rttm_path, 'w') as f:
+        f.write(''.join('SPEAKER %s 1 %.3f %.3f <NA> <NA> %s <NA> <NA>\n' % (uri, begin, duration, label)
+                        for begin, duration, label in zip(timeline['begin'], timeline['end'] - timeline['begin'], timeline['label'])))
+    return rttm_path
+
+
+def write_timeline(timeline, timeline_path):
+    with open(timeline_path, 'w') as f:
+        f.write(''.join('%.3f|%.3f|%s|%s\n' % row for row in zip(timeline['begin'], timeline['end'], timeline['label'], timeline['chunk'])))
+    return timeline_path
+
+
+class TimelineWriter:
+    """
+    Consolidated timeline of a video, built once all its chunks are diarized. The turns of every chunk
+    (times in ms relative to the chunk) are appended to <folder>/turns.csv as the chunks are exported,
+    so a resumed video still gets the turns of its chunks exported by the previous run.
+    """
+    def __init__(self, folder, resume=False):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.path = join(folder, TURNS_FILE)
+        self.f = open(self.path, 'a' if resume else 'w')
+
+    def add(self, chunk_id, segments):
+        self.f.write(''.join('%s|%d|%d|%s\n' % (chunk_id, begin, end, label) for begin, end, label in zip(segments.begin, segments.end, segments.label)))
+        self.f.flush()
+
+    def finish(self, manifest, sample_rate, uri, local_labels=True, max_gap=0.5):
+        '''
+        Join the recorded turns with the chunk offsets of the manifest, merge the turns across chunk boundaries,
+        and write <folder>/timeline.csv ("begin|end|label|chunk", seconds) and <folder>/<uri>.rttm.
+        Returns the timeline columns.
+        '''
+        self.f.close()
+        rows = set()
+        with open(self.path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('|')
+                # A chunk exported again by a resumed run is not duplicated
+                if len(fields) == 4:
+                    rows.add(tuple(fields))
+        rows = sorted(rows)
+        chunk_ids, begins, ends, labels = zip(*rows) if rows else ((), (), (), ())
+        timeline = build_timeline(manifest, sample_rate, chunk_ids, np.asarray(begins, dtype=np.int64), np.asarray(ends, dtype=np.int64), labels, local_labels)
+        timeline = merge_turns(timeline, max_gap)
+        write_timeline(timeline, join(self.folder, TIMELINE_FILE))
+        write_rttm(timeline, uri, join(self.folder, '%s.rttm' % uri))
+        return timeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the absolute timeline (timeline.csv and RTTM) of video folders diarized by "main.py diarize".')
+    parser.add_argument('input', nargs='+', help='Video folders, holding a diarized wavs/ folder (segments.csv and <chunk>.json files).')
+    parser.add_argument('--sample_rate', type=int, default=22050, help='Sample rate of the chunks.')
+    parser.add_argument('--max_gap', type=float, default=0.5, help='Maximum silence in seconds between two merged turns of a speaker.')
+    parser.add_argument('--global_labels', action='store_true', help='Labels are global speaker ids, not per-chunk labels.')
+    args = parser.parse_args()
+
+    for folder in args.input:
+        wavs_folder = join(folder, 'wavs')
+        if not exists(join(wavs_folder, 'segments.csv')):
+            print('Error: No segments.csv in {}.'.format(wavs_folder))
+            return False
+        writer = TimelineWriter(folder)
+        for json_path in sorted(glob(join(wavs_folder, '*.json'))):
+            writer.add(basename(json_path).split('.')[0], create_segments_list_from_json(json_path))
+        uri = basename(folder.rstrip('/'))
+        timeline = writer.finish(load_manifest(wavs_folder), args.sample_rate, uri, not args.global_labels, args.max_gap)
+        print('{}: {} turns, {} speakers'.format(uri, len(timeline['begin']), len(set(timeline['label'].tolist()))))
+    return True
+
+
+if __name__ == '__main__':
+    main()
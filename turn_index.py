@@ -0,0 +1,204 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# (C) 2021 Frederico Oliveira fred.santos.oliveira(at)gmail.com
+#
+#
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from os.path import exists, join
+import numpy as np
+
+COLUMNS = ['turn_id', 'video_id', 'chunk_id', 'filename', 'folder', 'begin', 'end', 'duration', 'label', 'track', 'embedding_row']
+
+
+class TurnIndex:
+    """
+    On-disk index of the exported speaker turns, filled as the pipeline runs.
+    Turn metadata is kept in a SQLite file (indexed by speaker and duration), and turn embeddings in a
+    float32 matrix file (embeddings.f32, one normalized row per embedded turn), memory mapped for the queries.
+    """
+    def __init__(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self.embeddings_path = join(index_dir, 'embeddings.f32')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(join(index_dir, 'turns.db'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS turns (turn_id INTEGER PRIMARY KEY, video_id TEXT, chunk_id TEXT, filename TEXT UNIQUE, '
+                        'folder TEXT, begin REAL, end REAL, duration REAL, label TEXT, track TEXT, embedding_row INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS turns_label ON turns (label, video_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS turns_duration ON turns (duration)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+        row = self.db.execute("SELECT value FROM meta WHERE key='dimension'").fetchone()
+        self.dimension = int(row[0]) if row else None
+        self._matrix = None
+        self._live = None
+
+    def add(self, video_id, chunk_id, segments, folder, embeddings=None):
+        '''
+        Record the exported turns of a chunk: a segments table (times in ms) and the folder of its files.
+        embeddings holds one row per turn (NaN rows for the turns without embedding), or is None.
+        Turns already indexed (same filename) are replaced, so re-exported chunks are not duplicated,
+        and their embedding row is rewritten in place.
+        '''
+        rows = [None] * len(segments)
+        filenames = [segments.filename(i) for i in range(len(segments))]
+        with self.lock:
+            count = self._committed_rows()
+            if embeddings is not None and np.size(embeddings):
+                embeddings = np.asarray(embeddings, dtype=np.float32)
+                embedded = np.flatnonzero(~np.isnan(embeddings).any(axis=1))
+                if len(embedded):
+                    if self.dimension is None:
+                        self.dimension = embeddings.shape[1]
+                        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('dimension', ?)", (str(self.dimension),))
+                    indexed = dict(self.db.execute('SELECT filename, embedding_row FROM turns WHERE embedding_row IS NOT NULL AND filename IN (%s)'
+                                                   % ','.join('?' * len(filenames)), filenames).fetchall())
+                    appended = []
+                    with open(self.embeddings_path, 'r+b' if exists(self.embeddings_path) else 'wb') as f:
+                        for i in embedded:
+                            if filenames[i] in indexed:
+                                rows[i] = indexed[filenames[i]]
+                                f.seek(rows[i] * self.dimension * 4)
+                                f.write(embeddings[i].tobytes())
+                            else:
+                                rows[i] = count + len(appended)
+                                appended.append(i)
+                        # Rows written after the last commit (by a crashed run) are overwritten
+                        f.seek(count * self.dimension * 4)
+                        f.write(np.ascontiguousarray(embeddings[appended]).tobytes())
+                        f.truncate()
+                    count += len(appended)
+                    self._matrix = None
+            begin = segments.begin / 1000
+            end = segments.end / 1000
+            self.db.executemany('INSERT OR REPLACE INTO turns (video_id, chunk_id, filename, folder, begin, end, duration, label, track, embedding_row) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(video_id, chunk_id, filenames[i], folder, float(begin[i]), float(end[i]), float(end[i] - begin[i]),
+                                  str(segments.label[i]), str(segments.track[i]), rows[i]) for i in range(len(segments))])
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('rows', ?)", (str(count),))
+            self.db.commit()
+            self._live = None
+
+    def _committed_rows(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key='rows'").fetchone()
+        return int(row[0]) if row else 0
+
+    def matrix(self):
+        '''
+        Memory mapped (rows x dimension) embedding matrix.
+        '''
+        if self._matrix is None:
+            rows = self._committed_rows()
+            if not rows:
+                return np.zeros((0, self.dimension or 0), dtype=np.float32)
+            self._matrix = np.memmap(self.embeddings_path, dtype=np.float32, mode='r', shape=(rows, self.dimension))
+        return self._matrix
+
+    def live_rows(self):
+        '''
+        Mask of the matrix rows referenced by an indexed turn (a re-indexed turn without embedding leaves its row unused).
+        '''
+        if self._live is None:
+            live = np.zeros(len(self.matrix()), dtype=bool)
+            with self.lock:
+                rows = [row for row, in self.db.execute('SELECT embedding_row FROM turns WHERE embedding_row IS NOT NULL')]
+            live[[row for row in rows if row < len(live)]] = True
+            self._live = live
+        return self._live
+
+    def turns(self, label=None, video_id=None, min_duration=None, max_duration=None, limit=None):
+        '''
+        Turns matching all the given filters, ex. all the turns of a speaker, or the turns longer than N seconds.
+        Returns a list of dicts (COLUMNS keys).
+        '''
+        where, params = [], []
+        for column, op, value in (('label', '=', label), ('video_id', '=', video_id), ('duration', '>=', min_duration), ('duration', '<=', max_duration)):
+            if value is not None:
+                where.append('%s %s ?' % (column, op))
+                params.append(value)
+        query = 'SELECT %s FROM turns' % ', '.join(COLUMNS)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY turn_id'
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        with self.lock:
+            return [dict(zip(COLUMNS, row)) for row in self.db.execute(query, params)]
+
+    def turn(self, filename):
+        with self.lock:
+            row = self.db.execute('SELECT %s FROM turns WHERE filename=?' % ', '.join(COLUMNS), (filename,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def embedding(self, turn):
+        return None if turn['embedding_row'] is None else np.array(self.matrix()[turn['embedding_row']])
+
+    def nearest(self, embedding, k=10, block_rows=1 << 16):
+        '''
+        k nearest turns of an embedding by cosine similarity, scanning the memory mapped matrix block by block.
+        Returns a list of (similarity, turn dict) pairs, most similar first.
+        '''
+        matrix = self.matrix()
+        live = self.live_rows()
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        query /= max(np.linalg.norm(query), 1e-12)
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_sims = np.zeros(0, dtype=np.float32)
+        for start in range(0, len(matrix), block_rows):
+            block = np.flatnonzero(live[start:start + block_rows])
+            # A block without unused rows is scanned in place, without gathering its rows
+            vectors = matrix[start:start + len(block)] if len(block) == min(block_rows, len(matrix) - start) else matrix[start + block]
+            sims = np.concatenate((best_sims, vectors @ query))
+            rows = np.concatenate((best_rows, start + block))
+            top = np.argpartition(-sims, min(k, len(sims)) - 1)[:k] if len(sims) > k else np.arange(len(sims))
+            best_sims, best_rows = sims[top], rows[top]
+        order = np.argsort(-best_sims)
+        best_rows, best_sims = best_rows[order], best_sims[order]
+        with self.lock:
+            turns = {row[-1]: dict(zip(COLUMNS, row)) for row in self.db.execute(
+                'SELECT %s FROM turns WHERE embedding_row IN (%s)' % (', '.join(COLUMNS), ','.join(str(int(r)) for r in best_rows)))}
+        return [(float(sim), turns[int(row)]) for sim, row in zip(best_sims, best_rows) if int(row) in turns]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the turn index of the exported speaker turns.')
+    parser.add_argument('--index', required=True, help='Turn index folder.')
+    parser.add_argument('--speaker', default=None, help='Turns of this speaker label (ex. SPK0003).')
+    parser.add_argument('--video', default=None, help='Turns of this video id.')
+    parser.add_argument('--min_duration', type=float, default=None, help='Turns of at least this duration in seconds.')
+    parser.add_argument('--max_duration', type=float, default=None, help='Turns of at most this duration in seconds.')
+    parser.add_argument('--nearest', default=None, help='Filename of a turn: list the turns with the closest voices.')
+    parser.add_argument('-k', type=int, default=10, help='Number of nearest turns.')
+    parser.add_argument('--limit', type=int, default=None, help='Maximum number of turns listed.')
+    args = parser.parse_args()
+
+    index = TurnIndex(args.index)
+    start = time.time()
+    if args.nearest:
+        turn = index.turn(args.nearest)
+        if turn is None or turn['embedding_row'] is None:
+            print('Error: No embedding for {}.'.format(args.nearest))
+            return False
+        for sim, neighbour in index.nearest(index.embedding(turn), args.k):
+            print('%.3f %s' % (sim, os.path.join(neighbour['folder'], neighbour['filename'])))
+    else:
+        turns = index.turns(args.speaker, args.video, args.min_duration, args.max_duration, args.limit)
+        for turn in turns:
+            print('%s %8.2f %s' % (turn['label'], turn['duration'], os.path.join(turn['folder'], turn['filename'])))
+        print('{} turns, {:.2f} hours'.format(len(turns), sum(turn['duration'] for turn in turns) / 3600))
+    print('Query time: {:.3f} sec'.format(time.time() - start))
+    return True
+
+
+if __name__ == '__main__':
+    main()